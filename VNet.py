@@ -16,7 +16,14 @@ import tqdm
 from volseg.unet_3d.model import UNet3d
 from volseg.example.brain_mri_dataset import BrainMRIDataset
 from volseg.loss.dice import DiceLoss
+from volseg.data.bucketing import BucketBatchSampler
+from volseg.data.normalization import InputNormalization
+from volseg.data.nifti_dataset import NiftiDataset, NiftiPaddingCollate
+from volseg.data.volume_store import VolumeStore
+from volseg.training.checkpoint import CheckpointManager
+from volseg.training.trainer import Trainer
 from volseg.utils.image_dimension_wrapper import ImageDimensionsWrapper
+from volseg.utils.statistics import RunningStatistics
 
 val_set = '/Users/nicole/Documents/Anatomical_mag_echo5/img/'
 train_set = '/Users/nicole/Documents/whole_liver_segmentation/'
@@ -29,38 +36,6 @@ def get_file_paths(image_directory, mask_directory):
 image_paths, mask_paths = get_file_paths(val_set, train_set)
 
 
-class NiftiDataset(Dataset):
-    def __init__(self, image_files, mask_files):
-        self.image_files = image_files
-        self.mask_files = mask_files
-
-    def __len__(self):
-        return len(self.image_files)
-
-    def __getitem__(self, idx):
-        # Load image and mask using nibabel
-        image = nib.load(self.image_files[idx]).get_fdata()
-        mask = nib.load(self.mask_files[idx]).get_fdata()
-
-        # Pad depth to 40 if not already
-        if image.shape[2] != 40:
-            image = self.pad_to_depth(image, 40)
-            mask = self.pad_to_depth(mask, 40)
-
-        # Convert numpy arrays to PyTorch tensors with dtype float32
-        image_tensor = torch.tensor(image, dtype=torch.float32).unsqueeze(0)  # Add channel dimension
-        mask_tensor = torch.tensor(mask, dtype=torch.float32).unsqueeze(0)    # Add channel dimension
-
-        return image_tensor, mask_tensor
-
-    def pad_to_depth(self, volume, target_depth):
-        current_depth = volume.shape[2]
-        if current_depth < target_depth:
-            pad_size = (target_depth - current_depth) // 2
-            pad_extra = (target_depth - current_depth) % 2
-            volume = np.pad(volume, ((0, 0), (0, 0), (pad_size, pad_size + pad_extra)), mode='constant', constant_values=0)
-        return volume
-
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels, dropout=0.1, res_connect=False):
         super(ConvBlock, self).__init__()
@@ -164,8 +139,18 @@ class VNet(nn.Module):
 model = VNet()
 print(model)
 
-dataset = NiftiDataset(image_paths, mask_paths)
-train_loader = DataLoader(dataset, batch_size=1, shuffle=True)
+# Volumes are parsed once in their on-disk dtype, later epochs read them memory-mapped from the store
+dataset = VolumeStore(
+    './volume_store',
+    {'image_files': image_paths, 'mask_files': mask_paths},
+).ensure_built(NiftiDataset(image_paths, mask_paths), image_dtype=None).open_dataset()
+# Scans of similar shape are batched together and padded to the largest one in their batch, and to a depth of at
+# least 40 slices as before
+train_loader = DataLoader(
+    dataset,
+    batch_sampler=BucketBatchSampler.from_dataset(dataset, batch_size=1),
+    collate_fn=NiftiPaddingCollate(target_depth=40),
+)
 
 # Set up the optimizer, loss function, and model
 optimizer = optim.Adam(model.parameters(), lr=0.001)
@@ -200,7 +185,8 @@ for epoch in range(num_epochs):
         outputs = UNet3d(num_classes=1, image_dimensions=image_dimensions).to(device)
         loss = criterion(outputs, masks)
 '''
-image_dimensions = ImageDimensionsWrapper((3, 96, 128, 128))
+# The NIfTI volumes have a single channel
+image_dimensions = ImageDimensionsWrapper((1, 96, 128, 128))
 
 model = UNet3d(num_classes=1, image_dimensions=image_dimensions).to(device)
 
@@ -210,63 +196,40 @@ terminate_after_no_improvement_epochs = 10
 criterion = DiceLoss()
 optimizer = torch.optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
 
-train_loader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=2)
-val_loader = torch.utils.data.DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers=2)
-
-training_history = []
-validation_history = []
-
-best_loss = float("inf")
-best_epoch = None
-best_state_dict = None
-
-for epoch in range(1, epochs + 1):
-    print(f"Epoch {epoch}")
-    total_training_loss = 0.0
-    for batch_number, data in tqdm.tqdm(enumerate(train_loader, start=1), total=len(train_loader)):
-        inputs, labels, _ = data
-
-        inputs = inputs.to(device)
-        labels = labels.to(device)
-        
-        optimizer.zero_grad()
-
-        outputs = model(inputs.float())
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-
-        total_training_loss += loss.item()
-    training_loss = total_training_loss / len(train_set)
-    training_history.append(training_loss)
-    print(f'[Training loss: {training_loss:.3f}')
-
-    total_validation_loss = 0.0
-    with torch.no_grad():
-        for batch_number, data in tqdm.tqdm(enumerate(val_loader, start=1), total=len(val_loader)):
-            inputs, labels, _ = data
-            inputs = (inputs - train_set.mean) / train_set.stdev
-
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-            
-            outputs = model(inputs.float())
-
-            total_validation_loss += criterion(outputs, labels).item()
-    validation_loss = total_validation_loss / len(val_set)
-    validation_history.append(validation_loss)
-    print(f'[Validation loss: {validation_loss:.3f}')
-
-    if validation_loss < best_loss:
-        best_epoch = epoch
-        best_loss = validation_loss
-        best_state_dict = model.state_dict().copy()
-        torch.save(best_state_dict, "./best_weights.pth")
-    elif terminate_after_no_improvement_epochs is not None:
-        epochs_without_improvement = epoch - best_epoch
-        if epochs_without_improvement >= terminate_after_no_improvement_epochs:
-            print(f"Stopping training after {epoch} epochs")
-            break
+# Stored volumes keep their on-disk intensities, so they are normalized at the model input with statistics of all of them
+statistics = None
+for idx in range(len(dataset)):
+    partial = RunningStatistics.from_array(dataset[idx][0].numpy())
+    statistics = partial if statistics is None else statistics.merge(partial)
+
+train_loader = DataLoader(
+    dataset,
+    batch_sampler=BucketBatchSampler.from_dataset(dataset, batch_size=batch_size),
+    collate_fn=NiftiPaddingCollate(target_depth=40),
+    num_workers=2,
+    pin_memory=torch.cuda.is_available(),
+)
+# There is no separate validation split, the training volumes are evaluated without shuffling
+val_loader = DataLoader(
+    dataset,
+    batch_sampler=BucketBatchSampler.from_dataset(dataset, batch_size=batch_size, shuffle=False),
+    collate_fn=NiftiPaddingCollate(target_depth=40),
+    num_workers=2,
+    pin_memory=torch.cuda.is_available(),
+)
+
+trainer = Trainer(
+    model,
+    criterion,
+    optimizer,
+    device=device,
+    terminate_after_no_improvement_epochs=terminate_after_no_improvement_epochs,
+    input_transform=InputNormalization(statistics.mean, statistics.stdev),
+    best_weights_path="./best_weights.pth",
+    checkpoint_manager=CheckpointManager("./checkpoints", keep_best=3),
+)
+trainer.resume()
+training_history, validation_history = trainer.fit(train_loader, val_loader, epochs=epochs)
 '''
         # Backward and optimize
         optimizer.zero_grad()
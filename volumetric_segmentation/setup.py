@@ -18,4 +18,10 @@ if __name__ == "__main__":
         author_email="bartek.wieciech@gmail.com",
         description="PyTorch implementation of VNet and 3D UNet for volumetric segmentation",
         python_requires=">=3.7.1",
+        entry_points={
+            "console_scripts": [
+                "volseg-bench=volseg.bench.__main__:main",
+                "volseg-infer=volseg.inference.cli:main",
+            ],
+        },
     )
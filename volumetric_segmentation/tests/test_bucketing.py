@@ -0,0 +1,35 @@
+import pytest
+
+from volseg.data.bucketing import BucketBatchSampler
+
+
+@pytest.mark.parametrize("num_samples", [0, 1, 3, 7, 16])
+@pytest.mark.parametrize("num_replicas", [1, 2, 4])
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_every_rank_yields_the_same_number_of_batches(
+    num_samples, num_replicas, drop_last
+):
+    shapes = [(8 + idx % 3, 16, 16) for idx in range(num_samples)]
+    samplers = [
+        BucketBatchSampler(
+            shapes,
+            batch_size=2,
+            drop_last=drop_last,
+            seed=0,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+        for rank in range(num_replicas)
+    ]
+    rank_batches = [list(sampler) for sampler in samplers]
+    for sampler, batches in zip(samplers, rank_batches):
+        assert len(batches) == len(sampler)
+    covered = {idx for batches in rank_batches for batch in batches for idx in batch}
+    expected = num_samples - num_samples % 2 if drop_last else num_samples
+    assert len(covered) == expected
+
+
+def test_batches_group_similar_shapes():
+    shapes = [(8, 16, 16), (32, 16, 16), (8, 16, 16), (32, 16, 16)]
+    for batch in BucketBatchSampler(shapes, batch_size=2, seed=0):
+        assert len({shapes[idx] for idx in batch}) == 1
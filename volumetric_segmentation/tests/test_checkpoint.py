@@ -0,0 +1,112 @@
+import os
+
+import pytest
+import torch
+import torch.utils.data
+
+from volseg.loss.dice import DiceLoss
+from volseg.training.checkpoint import CheckpointManager
+from volseg.training.trainer import Trainer
+
+
+def _save_epochs(manager, metrics, first_epoch=1):
+    for epoch, metric in enumerate(metrics, start=first_epoch):
+        manager.save({"epoch": torch.tensor(epoch)}, epoch, metric=metric)
+    manager.wait()
+
+
+def _get_epochs(manager):
+    index = manager.get_checkpoints()
+    return index["latest"]["epoch"], [item["epoch"] for item in index["best"]]
+
+
+def _get_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".pt"))
+
+
+@pytest.mark.parametrize("mode, best_epochs", [("min", [4, 2]), ("max", [1, 3])])
+def test_keeps_top_k_and_latest_checkpoints(tmp_path, mode, best_epochs):
+    manager = CheckpointManager(tmp_path, keep_best=2, mode=mode)
+    _save_epochs(manager, [5.0, 2.0, 4.0, 1.0, 3.0, None])
+    manager.close()
+
+    assert _get_epochs(manager) == (6, best_epochs)
+    kept_epochs = sorted(best_epochs + [6])
+    assert _get_files(tmp_path) == [f"epoch_{epoch:04d}.pt" for epoch in kept_epochs]
+    assert manager.load_latest()["epoch"].item() == 6
+    assert manager.load_best()["epoch"].item() == best_epochs[0]
+
+
+def test_index_survives_a_restart(tmp_path):
+    manager = CheckpointManager(tmp_path, keep_best=2)
+    _save_epochs(manager, [3.0, 1.0, 2.0])
+    manager.close()
+
+    restarted = CheckpointManager(tmp_path, keep_best=2)
+    assert restarted.get_checkpoints() == manager.get_checkpoints()
+    assert restarted.get_best_path() == os.path.join(tmp_path, "epoch_0002.pt")
+
+    # Checkpoints written before the restart are ranked and pruned like new ones
+    _save_epochs(restarted, [1.5, 4.0], first_epoch=4)
+    restarted.close()
+    assert _get_epochs(restarted) == (5, [2, 4])
+    assert _get_files(tmp_path) == ["epoch_0002.pt", "epoch_0004.pt", "epoch_0005.pt"]
+
+
+def _create_trainer(checkpoint_manager=None):
+    model = torch.nn.Sequential(
+        torch.nn.Conv3d(1, 4, 3, padding=1),
+        torch.nn.BatchNorm3d(4),
+        torch.nn.ReLU(),
+        # Dropout makes the result depend on the restored random number generator state
+        torch.nn.Dropout3d(0.2),
+        torch.nn.Conv3d(4, 1, 1),
+        torch.nn.Sigmoid(),
+    )
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+    return Trainer(
+        model,
+        DiceLoss(),
+        optimizer,
+        scheduler=torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5),
+        checkpoint_manager=checkpoint_manager,
+    )
+
+
+def _create_loaders():
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randn(8, 1, 6, 6, 6, generator=generator)
+    masks = (images > 0.5).float()
+    dataset = torch.utils.data.TensorDataset(images, masks)
+    # Shuffling draws from the global generator, which a checkpoint restores
+    return (
+        torch.utils.data.DataLoader(dataset, batch_size=2, shuffle=True),
+        torch.utils.data.DataLoader(dataset, batch_size=4),
+    )
+
+
+def test_resumed_training_equals_uninterrupted_training(tmp_path):
+    torch.manual_seed(0)
+    trainer = _create_trainer()
+    trainer.fit(*_create_loaders(), epochs=4)
+
+    torch.manual_seed(0)
+    manager = CheckpointManager(tmp_path / "checkpoints")
+    interrupted = _create_trainer(manager)
+    interrupted.fit(*_create_loaders(), epochs=2)
+    manager.close()
+
+    # A new process would start with other weights and random number generator states
+    torch.manual_seed(1)
+    manager = CheckpointManager(tmp_path / "checkpoints")
+    resumed = _create_trainer(manager)
+    assert resumed.resume()
+    resumed.fit(*_create_loaders(), epochs=4)
+    manager.close()
+
+    assert resumed.training_history == trainer.training_history
+    assert resumed.validation_history == trainer.validation_history
+    assert resumed.best_epoch == trainer.best_epoch
+    resumed_state = resumed.model.state_dict()
+    for name, value in trainer.model.state_dict().items():
+        assert torch.equal(resumed_state[name], value), name
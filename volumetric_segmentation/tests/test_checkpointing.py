@@ -0,0 +1,30 @@
+import copy
+
+import pytest
+import torch
+
+from volseg.unet_3d.model import UNet3d
+from volseg.vnet.model import VNet
+
+
+@pytest.mark.parametrize("model_class", [UNet3d, VNet])
+def test_checkpointing_updates_batch_norm_statistics_once(model_class):
+    torch.manual_seed(0)
+    model = model_class(num_classes=1, image_dimensions=(1, 16, 16, 16)).train()
+    checkpointed = copy.deepcopy(model)
+    checkpointed.set_checkpoint_levels(checkpointed.get_checkpointable_levels())
+    inputs = torch.rand(2, 1, 16, 16, 16)
+
+    for _ in range(2):
+        model(inputs).mean().backward()
+        checkpointed(inputs).mean().backward()
+
+    buffers = dict(model.named_buffers())
+    checkpointed_buffers = dict(checkpointed.named_buffers())
+    assert buffers.keys() == checkpointed_buffers.keys()
+    for name, buffer in buffers.items():
+        assert torch.allclose(buffer, checkpointed_buffers[name]), name
+    for name, parameter in model.named_parameters():
+        assert torch.allclose(
+            parameter.grad, checkpointed.get_parameter(name).grad, atol=1e-6
+        ), name
@@ -0,0 +1,100 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from volseg.loss.dice import DiceLoss, DiceMetric, TverskyLoss
+
+NUM_CLASSES = 3
+
+
+def _pooled_dice_loss(output, target):
+    # DiceLoss before per-sample and per-class statistics: a single index over the whole batch
+    if torch.sum(target) == 0:
+        output = 1.0 - output
+        target = 1.0 - target
+    dice_score = 2 * torch.sum(output * target) / torch.sum(output + target + 1e-7)
+    return 1.0 - dice_score
+
+
+def _create_batch(num_classes=NUM_CLASSES, batch_size=2):
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.randn(batch_size, num_classes, 4, 5, 6, generator=generator)
+    labels = torch.randint(0, num_classes, (batch_size, 4, 5, 6), generator=generator)
+    return logits, labels
+
+
+@pytest.mark.parametrize("empty_target", [False, True])
+def test_batch_dice_matches_pooled_loss(empty_target):
+    logits, labels = _create_batch(num_classes=1)
+    output = torch.sigmoid(logits)
+    target = (labels > 0).float().unsqueeze(1)
+    if empty_target:
+        target.zero_()
+
+    loss = DiceLoss(batch_dice=True)(output, target)
+    assert torch.allclose(loss, _pooled_dice_loss(output, target), atol=1e-6)
+
+
+def test_empty_targets_are_scored_on_complements():
+    output = torch.zeros(2, 1, 4, 4, 4)
+    target = torch.zeros(2, 1, 4, 4, 4)
+    output[1] = 1
+    target[1, :, :2] = 1
+    # The first sample predicts its empty target perfectly, the second over-segments half of its volume
+    per_sample = DiceLoss()(output, target)
+    assert torch.allclose(per_sample, torch.tensor(0.5 * (1 - 2 / 3)), atol=1e-6)
+
+    # Predicting everything for an empty target is as wrong as it gets
+    assert torch.allclose(
+        DiceLoss()(torch.ones(1, 1, 4, 4, 4), target[:1]), torch.tensor(1.0)
+    )
+    # With alpha=0 only false negatives count, which false positives on an empty target become on the complements
+    tversky = TverskyLoss(alpha=0.0, beta=1.0)(
+        torch.full((1, 1, 4, 4, 4), 0.25), target[:1]
+    )
+    assert torch.allclose(tversky, torch.tensor(0.25), atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "loss", [DiceLoss(), DiceLoss(batch_dice=True), TverskyLoss(alpha=0.3, beta=0.7)]
+)
+def test_label_and_one_hot_targets_are_equivalent(loss):
+    logits, labels = _create_batch()
+    # Class 2 is missing from the first sample, so its index comes from the complements
+    labels[0][labels[0] == 2] = 0
+    one_hot = F.one_hot(labels, NUM_CLASSES).permute(0, 4, 1, 2, 3).float()
+
+    losses, gradients = [], []
+    for target in (labels, labels.unsqueeze(1), one_hot):
+        output = logits.clone().requires_grad_()
+        value = loss(torch.softmax(output, dim=1), target)
+        value.backward()
+        losses.append(value.detach())
+        gradients.append(output.grad)
+    for value, gradient in zip(losses[1:], gradients[1:]):
+        assert torch.allclose(value, losses[0], atol=1e-6)
+        assert torch.allclose(gradient, gradients[0], atol=1e-6)
+
+
+def test_dice_metric_with_label_and_one_hot_targets():
+    logits, labels = _create_batch()
+    one_hot = F.one_hot(labels, NUM_CLASSES).permute(0, 4, 1, 2, 3)
+    prediction = logits.argmax(dim=1)
+
+    expected = []
+    for class_index in range(NUM_CLASSES):
+        predicted, actual = prediction == class_index, labels == class_index
+        intersection = (predicted & actual).sum(dim=(1, 2, 3)).float()
+        sizes = (predicted.sum(dim=(1, 2, 3)) + actual.sum(dim=(1, 2, 3))).float()
+        expected.append((2 * intersection / sizes).mean())
+    for target in (labels, one_hot):
+        metric = DiceMetric()
+        metric.update(logits[:1], target[:1])
+        metric.update(logits[1:], target[1:])
+        assert torch.allclose(metric.compute(), torch.stack(expected), atol=1e-6)
+
+
+def test_dice_metric_scores_empty_prediction_and_target_as_perfect():
+    metric = DiceMetric()
+    metric.update(torch.zeros(1, 1, 4, 4, 4), torch.zeros(1, 4, 4, 4))
+    assert metric.compute().tolist() == [1.0]
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing
+
+from volseg.training.distributed import SyncBatchNorm3d
+
+CHANNELS = 3
+
+
+def _create_inputs(batch_size):
+    generator = torch.Generator().manual_seed(0)
+    inputs = 2 * torch.randn(batch_size, CHANNELS, 4, 5, 6, generator=generator) + 1
+    output_weights = torch.randn(inputs.shape, generator=generator)
+    return inputs, output_weights
+
+
+def _create_batch_norm():
+    batch_norm = torch.nn.BatchNorm3d(CHANNELS)
+    with torch.no_grad():
+        batch_norm.weight.copy_(torch.linspace(0.5, 1.5, CHANNELS))
+        batch_norm.bias.copy_(torch.linspace(-1, 1, CHANNELS))
+    return batch_norm
+
+
+def _run_steps(batch_norm, inputs, output_weights, steps=2):
+    """
+    :return: (outputs, input gradients) of the last step
+    """
+    for _ in range(steps):
+        x = inputs.clone().requires_grad_()
+        batch_norm.zero_grad()
+        y = batch_norm(x)
+        (y * output_weights).sum().backward()
+    return y.detach(), x.grad
+
+
+def _run_rank(rank, world_size, init_method, result_path):
+    dist.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    try:
+        inputs, output_weights = _create_inputs(2 * world_size)
+        shard = slice(2 * rank, 2 * rank + 2)
+        synced = SyncBatchNorm3d.convert(_create_batch_norm())
+        outputs, input_grad = _run_steps(synced, inputs[shard], output_weights[shard])
+        torch.save(
+            {
+                "outputs": outputs,
+                "input_grad": input_grad,
+                "weight_grad": synced.weight.grad,
+                "bias_grad": synced.bias.grad,
+                "state": synced.state_dict(),
+            },
+            f"{result_path}.{rank}",
+        )
+    finally:
+        dist.destroy_process_group()
+
+
+def _assert_matches_reference(results, world_size):
+    inputs, output_weights = _create_inputs(2 * world_size)
+    reference = _create_batch_norm()
+    outputs, input_grad = _run_steps(reference, inputs, output_weights)
+
+    assert torch.allclose(
+        torch.cat([result["outputs"] for result in results]), outputs, atol=1e-5
+    )
+    assert torch.allclose(
+        torch.cat([result["input_grad"] for result in results]), input_grad, atol=1e-5
+    )
+    # Parameter gradients stay local until DistributedDataParallel averages them
+    for name in ("weight", "bias"):
+        assert torch.allclose(
+            sum(result[f"{name}_grad"] for result in results),
+            getattr(reference, name).grad,
+            atol=1e-4,
+        )
+    for result in results:
+        for name, buffer in reference.state_dict().items():
+            assert torch.allclose(result["state"][name], buffer, atol=1e-6), name
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="requires torch.distributed")
+@pytest.mark.parametrize("world_size", [1, 2])
+def test_sync_batch_norm_matches_batch_norm_over_the_full_batch(tmp_path, world_size):
+    init_method = f"file://{os.path.join(tmp_path, 'store')}"
+    result_path = os.path.join(tmp_path, "result")
+    if world_size == 1:
+        _run_rank(0, 1, init_method, result_path)
+    else:
+        torch.multiprocessing.spawn(
+            _run_rank, args=(world_size, init_method, result_path), nprocs=world_size
+        )
+    results = [torch.load(f"{result_path}.{rank}") for rank in range(world_size)]
+    _assert_matches_reference(results, world_size)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import torch
+
+from volseg.utils.resampling import resize_labels
+
+
+@pytest.mark.parametrize("mode", ["linear", "nearest"])
+def test_resized_labels_are_a_subset_of_the_input_labels(mode):
+    generator = np.random.default_rng(0)
+    labels = generator.choice(np.array([0, 2, 7], dtype=np.uint8), size=(2, 9, 11, 13))
+
+    resized = resize_labels(labels, (6, 16, 8), mode)
+    assert resized.dtype == np.uint8 and resized.shape == (2, 6, 16, 8)
+    assert set(np.unique(resized)) <= {0, 2, 7}
+
+
+def test_linear_mode_thresholds_binary_masks_at_half():
+    # Halving the depth averages pairs of slices, so a single slice covers half of an output voxel
+    thin = torch.zeros((1, 16, 8, 8), dtype=torch.bool)
+    thin[0, 5] = True
+    assert not resize_labels(thin, (8, 8, 8)).any()
+
+    thick = torch.zeros((1, 16, 8, 8), dtype=torch.bool)
+    thick[0, 4:6] = True
+    resized = resize_labels(thick, (8, 8, 8))
+    assert resized.dtype == torch.bool
+    assert resized[0, :, 0, 0].tolist() == [i == 2 for i in range(8)]
+
+
+def test_linear_mode_keeps_thin_structures_when_upsampling():
+    mask = np.zeros((1, 8, 8, 8), dtype=np.uint8)
+    mask[0, 3] = 1
+    resized = resize_labels(mask, (16, 16, 16))
+    assert resized[0, :, 0, 0].tolist() == [0] * 6 + [1, 1] + [0] * 8
+    assert resized.sum() == 2 * 16 * 16
+
+
+def test_adjacent_labels_are_not_blended():
+    labels = np.zeros((1, 16, 4, 4), dtype=np.uint8)
+    labels[0, 4:6] = 2
+    labels[0, 6:8] = 7
+    resized = resize_labels(labels, (8, 4, 4))
+    # Averaging 2 and 7 in one interpolation would give labels such as 4
+    assert resized[0, :, 0, 0].tolist() == [0, 0, 2, 7, 0, 0, 0, 0]
@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+import pytest
+import torch
+
+from volseg.data.shared_cache import SharedMemoryCache, collate_cached
+
+ENTRY_BYTES = 64
+
+
+def _entry(value):
+    return (np.full(ENTRY_BYTES // 4, value, dtype=np.float32),)
+
+
+def _put_entries(cache, keys):
+    for key in keys:
+        cache.put(key, _entry(key))
+
+
+@pytest.fixture
+def cache_factory():
+    caches = []
+
+    def create(**kwargs):
+        cache = SharedMemoryCache(**kwargs)
+        caches.append(cache)
+        return cache
+
+    yield create
+    for cache in caches:
+        cache.close()
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="requires fork"
+)
+def test_entries_put_by_another_process_are_hits(cache_factory):
+    cache = cache_factory(max_bytes=10 * ENTRY_BYTES)
+    process = multiprocessing.get_context("fork").Process(
+        target=_put_entries, args=(cache, [1, 2])
+    )
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    (first,) = cache.get(1)
+    (second,) = cache.get(2)
+    assert np.all(first == 1) and np.all(second == 2)
+    assert not first.flags.writeable
+    assert cache.get(3) is None
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 2)
+
+
+@pytest.mark.parametrize("policy, evicted", [("lru", "a"), ("lfu", "b")])
+def test_eviction_respects_byte_budget_and_policy(cache_factory, policy, evicted):
+    cache = cache_factory(max_bytes=2 * ENTRY_BYTES, policy=policy)
+    cache.put("a", _entry(0))
+    cache.put("b", _entry(1))
+    # "a" is used more often, "b" more recently
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    cache.put("c", _entry(2))
+
+    assert evicted not in cache
+    assert "c" in cache and len(cache) == 2
+    stats = cache.get_stats()
+    assert stats["bytes"] <= 2 * ENTRY_BYTES
+    assert stats["evictions"] == 1
+
+
+def test_entries_larger_than_budget_are_not_cached(cache_factory):
+    cache = cache_factory(max_bytes=ENTRY_BYTES)
+    (array,) = cache.put("large", (np.zeros(ENTRY_BYTES, dtype=np.float32),))
+    assert array.flags.writeable
+    assert "large" not in cache
+
+
+def test_empty_entries_are_cached(cache_factory):
+    cache = cache_factory(max_bytes=ENTRY_BYTES)
+    assert cache.put("empty", ()) == ()
+    assert cache.get("empty") == ()
+
+
+def test_collate_cached_stacks_read_only_views(cache_factory):
+    cache = cache_factory(max_bytes=10 * ENTRY_BYTES)
+    samples = [
+        cache.put(key, _entry(key) + (np.full(3, key, dtype=np.uint8),))
+        for key in range(3)
+    ]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        arrays, masks = collate_cached(samples)
+    assert arrays.shape == (3, ENTRY_BYTES // 4) and masks.shape == (3, 3)
+    assert arrays[:, 0].tolist() == [0, 1, 2]
+    assert masks.dtype == torch.uint8 and masks[:, 0].tolist() == [0, 1, 2]
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="requires /dev/shm")
+def test_close_unlinks_segments_and_keeps_views_valid():
+    before = set(os.listdir("/dev/shm"))
+    cache = SharedMemoryCache(max_bytes=10 * ENTRY_BYTES)
+    _put_entries(cache, range(3))
+    (view,) = cache.get(1)
+    assert len(set(os.listdir("/dev/shm")) - before) == 3
+
+    cache.close()
+    assert set(os.listdir("/dev/shm")) - before == set()
+    assert np.all(view == 1)
@@ -0,0 +1,260 @@
+import abc
+import math
+
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+
+from volseg.utils.timing import TimingMixin, get_synchronized_time
+
+
+class BatchTransform(abc.ABC):
+    """
+    Base class of augmentations applied to whole batches. Images are (batch, channels, depth, height, width) and are
+    converted to float, masks have the same layout or lack the channel axis. Every sample is augmented with the given
+    probability, image and mask of a sample always get the same random parameters.
+    """
+
+    def __init__(self, probability):
+        if not 0 <= probability <= 1:
+            raise ValueError(f"probability must be within [0, 1], got {probability}")
+        self.probability = probability
+
+    def __call__(self, images, masks):
+        if not images.is_floating_point():
+            images = images.float()
+        selected = (torch.rand(images.shape[0]) < self.probability).nonzero()[:, 0]
+        if len(selected) == 0:
+            return images, masks
+        if len(selected) == images.shape[0]:
+            return self.apply(images, masks)
+        selected = selected.to(images.device)
+        images, masks = images.clone(), masks.clone()
+        images[selected], masks[selected] = self.apply(
+            images[selected], masks[selected]
+        )
+        return images, masks
+
+    @abc.abstractmethod
+    def apply(self, images, masks):
+        """
+        Augments every sample of the batch, which only holds the selected samples.
+        :return: (images, masks) tuple
+        """
+
+
+class RandomFlip(BatchTransform):
+    def __init__(self, axes=(0, 1, 2), probability=0.5):
+        """
+        :param axes: spatial axes (0 = depth, 1 = height, 2 = width), each is flipped independently
+        """
+        super().__init__(probability)
+        self.axes = axes
+
+    def apply(self, images, masks):
+        images, masks = images.clone(), masks.clone()
+        for axis in self.axes:
+            flipped = (torch.rand(images.shape[0]) < 0.5).nonzero()[:, 0]
+            if len(flipped) == 0:
+                continue
+            flipped = flipped.to(images.device)
+            images[flipped] = images[flipped].flip(_spatial_dim(images, axis))
+            masks[flipped] = masks[flipped].flip(_spatial_dim(masks, axis))
+        return images, masks
+
+
+class RandomRotate90(BatchTransform):
+    def __init__(self, plane=(1, 2), probability=0.5):
+        """
+        Rotates by a random multiple of 90 degrees. Planes that are not square are only rotated by 180 degrees, so the
+        batch keeps its shape.
+        :param plane: pair of spatial axes (0 = depth, 1 = height, 2 = width) spanning the rotation plane
+        """
+        super().__init__(probability)
+        self.plane = plane
+
+    def apply(self, images, masks):
+        sizes = [images.shape[_spatial_dim(images, axis)] for axis in self.plane]
+        quarter_turns = (
+            torch.randint(1, 4, (images.shape[0],))
+            if sizes[0] == sizes[1]
+            else torch.full((images.shape[0],), 2)
+        )
+        images, masks = images.clone(), masks.clone()
+        for k in quarter_turns.unique().tolist():
+            rotated = (quarter_turns == k).nonzero()[:, 0].to(images.device)
+            images[rotated] = images[rotated].rot90(
+                k, [_spatial_dim(images, axis) for axis in self.plane]
+            )
+            masks[rotated] = masks[rotated].rot90(
+                k, [_spatial_dim(masks, axis) for axis in self.plane]
+            )
+        return images, masks
+
+
+class RandomSpatialTransform(BatchTransform):
+    def __init__(
+        self,
+        rotation_degrees=(15, 15, 15),
+        scale_range=(0.9, 1.1),
+        translation=0.05,
+        elastic_magnitude=0.0,
+        elastic_control_points=4,
+        probability=0.5,
+    ):
+        """
+        Random affine and elastic deformation resampled in a single grid_sample call. Images are interpolated
+        trilinearly and masks with nearest neighbours, so label values are preserved.
+        :param rotation_degrees: maximum rotation around the (depth, height, width) axes
+        :param scale_range: range of the isotropic zoom factor
+        :param translation: maximum shift as a fraction of the volume size
+        :param elastic_magnitude: standard deviation of the elastic displacement as a fraction of the volume size, 0 to
+                                  disable elastic deformation
+        :param elastic_control_points: number of control points per axis of the coarse displacement field, which is
+                                       upsampled to the volume size
+        """
+        super().__init__(probability)
+        self.rotation_degrees = rotation_degrees
+        self.scale_range = scale_range
+        self.translation = translation
+        self.elastic_magnitude = elastic_magnitude
+        self.elastic_control_points = elastic_control_points
+
+    def apply(self, images, masks):
+        grid = self.create_grid(images.shape[0], tuple(images.shape[-3:])).to(
+            images.device
+        )
+        images = F.grid_sample(
+            images, grid, mode="bilinear", padding_mode="zeros", align_corners=False
+        )
+        mask_has_channels = masks.dim() == images.dim()
+        resampled = F.grid_sample(
+            (masks if mask_has_channels else masks.unsqueeze(1)).to(images.dtype),
+            grid,
+            mode="nearest",
+            padding_mode="zeros",
+            align_corners=False,
+        ).to(masks.dtype)
+        return images, resampled if mask_has_channels else resampled[:, 0]
+
+    def create_grid(self, batch_size, spatial_shape):
+        """
+        :return: (batch, depth, height, width, 3) sampling grid in the normalized coordinates of grid_sample
+        """
+        # grid_sample orders coordinates as (x, y, z) = (width, height, depth)
+        sizes = torch.tensor(spatial_shape[::-1], dtype=torch.float)
+        angles = [
+            (torch.rand(batch_size) * 2 - 1) * math.radians(degrees)
+            for degrees in self.rotation_degrees[::-1]
+        ]
+        rotation = (
+            _rotation_matrix(angles[0], 1, 2)
+            @ _rotation_matrix(angles[1], 0, 2)
+            @ _rotation_matrix(angles[2], 0, 1)
+        )
+        scale = torch.empty(batch_size).uniform_(*self.scale_range)
+        # Rotating in voxel units keeps angles correct for volumes that are not cubic
+        linear = (torch.diag(1 / sizes) @ rotation @ torch.diag(sizes)) / scale.view(
+            -1, 1, 1
+        )
+        shift = (torch.rand(batch_size, 3) * 2 - 1) * 2 * self.translation
+        theta = torch.cat([linear, shift.unsqueeze(-1)], dim=-1)
+        grid = F.affine_grid(
+            theta, (batch_size, 1, *spatial_shape), align_corners=False
+        )
+
+        if self.elastic_magnitude > 0:
+            displacement = torch.randn(
+                batch_size, 3, *(self.elastic_control_points,) * 3
+            ) * (2 * self.elastic_magnitude)
+            displacement = F.interpolate(
+                displacement, size=spatial_shape, mode="trilinear", align_corners=True
+            )
+            grid = grid + displacement.permute(0, 2, 3, 4, 1)
+        return grid
+
+
+class RandomIntensity(BatchTransform):
+    def __init__(
+        self,
+        scale_range=(0.9, 1.1),
+        shift_range=(-0.1, 0.1),
+        noise_std=0.0,
+        probability=0.5,
+    ):
+        """
+        Random per-sample contrast scaling, brightness shift and additive Gaussian noise of the images. Masks are left
+        unchanged.
+        """
+        super().__init__(probability)
+        self.scale_range = scale_range
+        self.shift_range = shift_range
+        self.noise_std = noise_std
+
+    def apply(self, images, masks):
+        shape = (images.shape[0],) + (1,) * (images.dim() - 1)
+        scale = torch.empty(shape).uniform_(*self.scale_range).to(images.device)
+        shift = torch.empty(shape).uniform_(*self.shift_range).to(images.device)
+        images = torch.addcmul(shift, images, scale)
+        if self.noise_std > 0:
+            images.add_(torch.randn_like(images), alpha=self.noise_std)
+        return images, masks
+
+
+class AugmentationPipeline(TimingMixin):
+    def __init__(self, transforms, measure_time=False):
+        """
+        Applies batch transforms in sequence, e.g. as Trainer(batch_transform=...) on the training device or inside
+        DataLoader workers through AugmentingCollate.
+        :param transforms: list of BatchTransform
+        :param measure_time: accumulate the time spent in every transform, which synchronizes CUDA after each of them
+        """
+        self.transforms = transforms
+        self.measure_time = measure_time
+        self.reset_timings()
+
+    def __call__(self, images, masks):
+        for transform in self.transforms:
+            if not self.measure_time:
+                images, masks = transform(images, masks)
+                continue
+            start = get_synchronized_time(images)
+            images, masks = transform(images, masks)
+            self.record_time(
+                transform.__class__.__name__, get_synchronized_time(images) - start
+            )
+        return images, masks
+
+
+class AugmentingCollate:
+    def __init__(
+        self, pipeline, collate_fn=torch.utils.data.dataloader.default_collate
+    ):
+        """
+        Collates a batch and augments it, so the augmentation runs inside DataLoader workers. Elements of samples past
+        (image, mask), such as names, are passed through.
+        """
+        self.pipeline = pipeline
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        collated = self.collate_fn(batch)
+        images, masks = self.pipeline(collated[0], collated[1])
+        return (images, masks, *collated[2:])
+
+
+def _spatial_dim(tensor, axis):
+    return tensor.dim() - 3 + axis
+
+
+def _rotation_matrix(angles, first, second):
+    """
+    :return: (batch, 3, 3) rotations by the given angles in the plane of the two coordinate axes
+    """
+    matrix = torch.eye(3).repeat(len(angles), 1, 1)
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    matrix[:, first, first] = cos
+    matrix[:, first, second] = -sin
+    matrix[:, second, first] = sin
+    matrix[:, second, second] = cos
+    return matrix
@@ -0,0 +1,85 @@
+import argparse
+import json
+import sys
+
+from volseg.bench.benchmark import (
+    DTYPES,
+    compare_results,
+    create_configs,
+    run_benchmarks,
+)
+from volseg.model.registry import MODELS
+from volseg.utils.image_dimension_wrapper import parse_dimensions
+from volseg.utils.io_utils import print_info_message
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="volseg-bench",
+        description="Measures CPU forward/backward/training step throughput and peak RSS of VNet and UNet3d.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run a benchmark sweep")
+    run_parser.add_argument(
+        "--models", nargs="+", choices=sorted(MODELS), default=sorted(MODELS)
+    )
+    run_parser.add_argument(
+        "--image-dimensions",
+        nargs="+",
+        type=parse_dimensions,
+        default=[(1, 32, 64, 64)],
+        help="channels x depth x height x width, e.g. 1x32x64x64",
+    )
+    run_parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1])
+    run_parser.add_argument("--threads", nargs="+", type=int, default=[1])
+    run_parser.add_argument(
+        "--dtypes", nargs="+", choices=sorted(DTYPES), default=["float32"]
+    )
+    run_parser.add_argument("--num-classes", type=int, default=1)
+    run_parser.add_argument("--repeats", type=int, default=5)
+    run_parser.add_argument("--warmup", type=int, default=2)
+    run_parser.add_argument("--output", help="path of the JSON results file")
+    run_parser.add_argument("--baseline", help="JSON results to compare against")
+    run_parser.add_argument("--threshold", type=float, default=0.1)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        configs = create_configs(
+            args.models,
+            args.image_dimensions,
+            args.batch_sizes,
+            args.threads,
+            args.dtypes,
+            num_classes=args.num_classes,
+        )
+        current = run_benchmarks(configs, repeats=args.repeats, warmup=args.warmup)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+            print_info_message(f"Results saved to {args.output}")
+        baseline_path = args.baseline
+    else:
+        with open(args.current, "r") as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+
+    if baseline_path is None:
+        return 0
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    regressions = compare_results(baseline, current, threshold=args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print_info_message("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
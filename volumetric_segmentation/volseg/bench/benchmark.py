@@ -0,0 +1,171 @@
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from volseg.model.registry import MODELS
+from volseg.utils.memory import get_peak_rss_bytes
+
+DTYPES = {"float32": None, "bfloat16": torch.bfloat16}
+METRICS = ("forward", "backward", "train_step")
+
+
+def create_configs(models, image_dimensions, batch_sizes, threads, dtypes, **extra):
+    """
+    :return: list of configs covering the cartesian product of all axes
+    """
+    return [
+        {
+            "model": model,
+            "image_dimensions": list(dims),
+            "batch_size": batch_size,
+            "threads": num_threads,
+            "dtype": dtype,
+            **extra,
+        }
+        for model, dims, batch_size, num_threads, dtype in itertools.product(
+            models, image_dimensions, batch_sizes, threads, dtypes
+        )
+    ]
+
+
+def run_benchmarks(configs, repeats=5, warmup=2):
+    """
+    Runs every config in a fresh process, so that peak RSS is attributable to that config alone.
+    :return: JSON-serializable dict with environment info and one result per config
+    """
+    results = []
+    for config in configs:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(run_config, config, repeats, warmup).result()
+        print(format_result(result), flush=True)
+        results.append(result)
+    return {"environment": get_environment(), "results": results}
+
+
+def run_config(config, repeats=5, warmup=2):
+    torch.set_num_threads(config["threads"])
+    torch.manual_seed(0)
+    model = MODELS[config["model"]](
+        num_classes=config.get("num_classes", 1),
+        image_dimensions=tuple(config["image_dimensions"]),
+        **config.get("model_kwargs", {}),
+    )
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9)
+    inputs = torch.rand(config["batch_size"], *config["image_dimensions"])
+    autocast_dtype = DTYPES[config["dtype"]]
+
+    def autocast():
+        if autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type="cpu", dtype=autocast_dtype)
+
+    timings = {metric: [] for metric in METRICS}
+    for iteration in range(warmup + repeats):
+        optimizer.zero_grad(set_to_none=True)
+        start = time.perf_counter()
+        with autocast():
+            loss = model(inputs).float().mean()
+        forward_end = time.perf_counter()
+        loss.backward()
+        backward_end = time.perf_counter()
+        optimizer.step()
+        step_end = time.perf_counter()
+        if iteration >= warmup:
+            timings["forward"].append(forward_end - start)
+            timings["backward"].append(backward_end - forward_end)
+            timings["train_step"].append(step_end - start)
+
+    voxels = inputs.shape[0] * inputs[0, 0].numel()
+    result = dict(config)
+    for metric, values in timings.items():
+        seconds = statistics.median(values)
+        result[f"{metric}_seconds"] = seconds
+        result[f"{metric}_voxels_per_second"] = voxels / seconds
+    result["parameters"] = sum(p.numel() for p in model.parameters())
+    result["peak_rss_bytes"] = get_peak_rss_bytes()
+    return result
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Flags configs whose throughput dropped or whose peak RSS grew by more than the threshold relative to the baseline.
+    :param baseline: dict as returned by run_benchmarks
+    :param current: dict as returned by run_benchmarks
+    :param threshold: relative change tolerated before a difference counts as a regression
+    :return: list of regression descriptions
+    """
+    baseline_results = {
+        get_config_key(result): result for result in baseline["results"]
+    }
+    regressions = []
+    for result in current["results"]:
+        key = get_config_key(result)
+        reference = baseline_results.get(key)
+        if reference is None:
+            continue
+        for metric in METRICS:
+            field = f"{metric}_voxels_per_second"
+            change = result[field] / reference[field] - 1
+            if change < -threshold:
+                regressions.append(f"{key}: {field} {change:+.1%}")
+        if result["peak_rss_bytes"] is None or reference["peak_rss_bytes"] is None:
+            continue
+        change = result["peak_rss_bytes"] / reference["peak_rss_bytes"] - 1
+        if change > threshold:
+            regressions.append(f"{key}: peak_rss_bytes {change:+.1%}")
+    return regressions
+
+
+def get_config_key(result):
+    return json.dumps(
+        {
+            key: value
+            for key, value in result.items()
+            if not key.endswith(("_seconds", "_per_second", "_bytes"))
+            and key != "parameters"
+        },
+        sort_keys=True,
+    )
+
+
+def format_result(result):
+    dims = "x".join(str(size) for size in result["image_dimensions"])
+    throughput = ", ".join(
+        f"{metric} {result[f'{metric}_voxels_per_second'] / 1e6:.2f} Mvox/s"
+        for metric in METRICS
+    )
+    model = result["model"]
+    model_kwargs = result.get("model_kwargs") or {}
+    if model_kwargs:
+        arguments = ", ".join(f"{k}={v}" for k, v in sorted(model_kwargs.items()))
+        model = f"{model}({arguments})"
+    peak_rss = (
+        f"{result['peak_rss_bytes'] / 2**20:.0f} MiB"
+        if result["peak_rss_bytes"] is not None
+        else "unknown"
+    )
+    return (
+        f"{model} {dims} batch={result['batch_size']} threads={result['threads']} {result['dtype']}: "
+        f"{throughput}, peak RSS {peak_rss}"
+    )
+
+
+def get_environment():
+    return {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
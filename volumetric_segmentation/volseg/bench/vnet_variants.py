@@ -0,0 +1,241 @@
+import argparse
+import json
+import sys
+
+import torch
+import torch.utils.data
+
+from volseg.bench.benchmark import create_configs, get_environment, run_benchmarks
+from volseg.export.quantization import evaluate_dice
+from volseg.loss.dice import DiceLoss
+from volseg.model.profiling import get_multiply_adds
+from volseg.training.trainer import Trainer
+from volseg.utils.image_dimension_wrapper import parse_dimensions
+from volseg.utils.io_utils import print_info_message
+from volseg.vnet.model import VNet
+from volseg.vnet.parts import CONV_BLOCKS
+
+
+def compare_conv_blocks(
+    image_dimensions=(1, 32, 64, 64),
+    conv_blocks=CONV_BLOCKS,
+    batch_size=1,
+    threads=(1,),
+    dtypes=("float32",),
+    num_classes=1,
+    repeats=5,
+    warmup=2,
+    train_loader=None,
+    val_loader=None,
+    epochs=10,
+    learning_rate=1e-3,
+    input_transform=None,
+):
+    """
+    Benchmarks VNet conv block variants against each other and, given data, trains every variant with the same seed
+    and budget to compare their accuracy.
+    :param train_loader: loader of (inputs, labels, ...) batches, None to skip the accuracy comparison
+    :param val_loader: loader the Dice scores are computed on
+    :return: JSON-serializable dict with environment info and one result per variant and benchmark config, where
+             speedup is relative to the "dense" result of the same config
+    """
+    configs = [
+        config
+        for conv_block in conv_blocks
+        for config in create_configs(
+            ["vnet"],
+            [image_dimensions],
+            [batch_size],
+            threads,
+            dtypes,
+            num_classes=num_classes,
+            model_kwargs={"conv_block": conv_block},
+        )
+    ]
+    results = run_benchmarks(configs, repeats=repeats, warmup=warmup)["results"]
+    multiply_adds = {
+        conv_block: count_multiply_adds(
+            VNet(num_classes, image_dimensions, conv_block=conv_block)
+        )
+        for conv_block in conv_blocks
+    }
+    dice = {}
+    if train_loader is not None:
+        for conv_block in conv_blocks:
+            dice[conv_block] = train_and_evaluate(
+                conv_block,
+                image_dimensions,
+                num_classes,
+                train_loader,
+                val_loader,
+                epochs,
+                learning_rate,
+                input_transform,
+            )
+
+    dense_seconds = {
+        (result["threads"], result["dtype"]): result["forward_seconds"]
+        for result in results
+        if result["model_kwargs"]["conv_block"] == "dense"
+    }
+    for result in results:
+        conv_block = result["model_kwargs"]["conv_block"]
+        result["conv_block"] = conv_block
+        result["multiply_adds"] = multiply_adds[conv_block]
+        reference = dense_seconds.get((result["threads"], result["dtype"]))
+        if reference is not None:
+            result["speedup"] = reference / result["forward_seconds"]
+        if conv_block in dice:
+            result["dice"] = dice[conv_block]
+        print_info_message(format_comparison(result))
+    return {"environment": get_environment(), "results": results}
+
+
+def train_and_evaluate(
+    conv_block,
+    image_dimensions,
+    num_classes,
+    train_loader,
+    val_loader,
+    epochs=10,
+    learning_rate=1e-3,
+    input_transform=None,
+    seed=0,
+):
+    """
+    :return: per-class Dice of the variant on val_loader after training it for the given number of epochs
+    """
+    torch.manual_seed(seed)
+    model = VNet(num_classes, image_dimensions, conv_block=conv_block)
+    trainer = Trainer(
+        model,
+        DiceLoss(),
+        torch.optim.Adam(model.parameters(), lr=learning_rate),
+        input_transform=input_transform,
+    )
+    print_info_message(f"Training VNet with {conv_block} conv blocks")
+    trainer.fit(train_loader, epochs=epochs)
+    model.eval()
+    return evaluate_dice(model, val_loader, input_transform).tolist()
+
+
+def count_multiply_adds(model):
+    """
+    :return: multiply-adds of the convolutions of a single forward pass on one sample of the model's image_dimensions
+    """
+    total = 0
+
+    def hook(module, inputs, output):
+        nonlocal total
+        total += get_multiply_adds(module, inputs, output)
+
+    handles = [
+        module.register_forward_hook(hook)
+        for module in model.modules()
+        if isinstance(module, (torch.nn.Conv3d, torch.nn.ConvTranspose3d))
+    ]
+    try:
+        with torch.no_grad():
+            model.eval()(torch.zeros(1, *model.image_dimensions.get()))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total
+
+
+def format_comparison(result):
+    text = (
+        f"{result['conv_block']}: threads={result['threads']} {result['dtype']}, "
+        f"{result['parameters'] / 1e6:.2f} M parameters, {result['multiply_adds'] / 1e9:.1f} GMAC, "
+        f"forward {1000 * result['forward_seconds']:.0f} ms, train step {1000 * result['train_step_seconds']:.0f} ms"
+    )
+    if "speedup" in result:
+        text += f" ({result['speedup']:.2f}x)"
+    if "dice" in result:
+        text += f", Dice {[round(score, 3) for score in result['dice']]}"
+    return text
+
+
+def create_synthetic_dataset(image_dimensions, num_cases, seed=0):
+    """
+    Noisy volumes containing one random ellipsoid each, segmented by its mask. Enough to compare how quickly variants
+    learn, not a substitute for real data.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    channels, *dhw = image_dimensions
+    grid = torch.stack(
+        torch.meshgrid(
+            *(torch.linspace(-1, 1, size) for size in dhw),
+            indexing="ij",
+        )
+    )
+    images, masks = [], []
+    for _ in range(num_cases):
+        center = (torch.rand(3, generator=generator) - 0.5).view(3, 1, 1, 1)
+        radii = (0.2 + 0.3 * torch.rand(3, generator=generator)).view(3, 1, 1, 1)
+        mask = (((grid - center) / radii) ** 2).sum(dim=0) <= 1
+        image = mask.float() + 0.5 * torch.randn(channels, *dhw, generator=generator)
+        images.append(image)
+        masks.append(mask[None].float())
+    return torch.utils.data.TensorDataset(torch.stack(images), torch.stack(masks))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m volseg.bench.vnet_variants",
+        description="Compares speed and accuracy of the VNet conv block variants.",
+    )
+    parser.add_argument(
+        "--conv-blocks", nargs="+", choices=CONV_BLOCKS, default=list(CONV_BLOCKS)
+    )
+    parser.add_argument(
+        "--image-dimensions",
+        type=parse_dimensions,
+        default=(1, 32, 64, 64),
+        help="channels x depth x height x width, e.g. 1x32x64x64",
+    )
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--threads", nargs="+", type=int, default=[1])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=0,
+        help="epochs of training on synthetic data for the accuracy comparison, 0 to skip it",
+    )
+    parser.add_argument("--cases", type=int, default=16)
+    parser.add_argument("--output", help="path of the JSON results file")
+    args = parser.parse_args(argv)
+
+    train_loader = val_loader = None
+    if args.epochs > 0:
+        train_loader = torch.utils.data.DataLoader(
+            create_synthetic_dataset(args.image_dimensions, args.cases, seed=0),
+            batch_size=args.batch_size,
+            shuffle=True,
+        )
+        val_loader = torch.utils.data.DataLoader(
+            create_synthetic_dataset(args.image_dimensions, args.cases // 4, seed=1),
+            batch_size=args.batch_size,
+        )
+    results = compare_conv_blocks(
+        image_dimensions=args.image_dimensions,
+        conv_blocks=args.conv_blocks,
+        batch_size=args.batch_size,
+        threads=args.threads,
+        repeats=args.repeats,
+        warmup=args.warmup,
+        train_loader=train_loader,
+        val_loader=val_loader,
+        epochs=args.epochs,
+    )
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print_info_message(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import math
+import random
+
+import numpy as np
+import torch.utils.data
+
+from volseg.utils.padding import pad_stack
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(
+        self,
+        shapes,
+        batch_size,
+        shuffle=True,
+        drop_last=False,
+        seed=None,
+        num_replicas=1,
+        rank=0,
+    ):
+        """
+        Batches volumes of similar spatial shape together, so padding them to a common shape wastes little compute.
+        Volumes are ordered by shape with random tie-breaking and cut into batches, whose order is then shuffled.
+        :param shapes: spatial shape of every sample of the dataset
+        :param seed: seed of the shuffling, None for a random one
+        :param num_replicas: number of distributed processes the batches are sharded over, e.g.
+                             volseg.training.distributed.get_world_size(). Every process gets the same number of
+                             batches, some are repeated if they do not divide evenly
+        :param rank: index of this process among num_replicas
+        """
+        if num_replicas > 1 and shuffle and seed is None:
+            raise ValueError(
+                "A seed is required to shuffle consistently across distributed processes"
+            )
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank must be within [0, {num_replicas}), got {rank}")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, **kwargs):
+        """
+        :param dataset: dataset implementing get_spatial_shape(idx), e.g. NiftiDataset or MemoryMappedVolumeDataset
+        """
+        shapes = [dataset.get_spatial_shape(idx) for idx in range(len(dataset))]
+        return cls(shapes, batch_size, **kwargs)
+
+    def __iter__(self):
+        indices = list(range(len(self.shapes)))
+        if self.shuffle:
+            self.random.shuffle(indices)
+        # sort() is stable, so samples of equal shape stay in shuffled order
+        indices.sort(key=lambda idx: self.shapes[idx])
+        batches = [
+            indices[start : start + self.batch_size]
+            for start in range(0, len(indices), self.batch_size)
+        ]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            self.random.shuffle(batches)
+        if self.num_replicas > 1 and batches:
+            # Repeated cyclically like DistributedSampler, as there may be fewer batches than processes
+            total = len(self) * self.num_replicas
+            batches = (batches * math.ceil(total / len(batches)))[:total]
+            batches = batches[self.rank :: self.num_replicas]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.shapes) // self.batch_size
+        else:
+            num_batches = math.ceil(len(self.shapes) / self.batch_size)
+        return math.ceil(num_batches / self.num_replicas)
+
+    def get_padding_overhead(self):
+        """
+        :return: fraction of voxels in the padded batches that are padding, for the current bucketing
+        """
+        padded_voxels, voxels = 0, 0
+        for batch in self:
+            shapes = [self.shapes[idx] for idx in batch]
+            padded_voxels += len(batch) * int(
+                np.prod([max(sizes) for sizes in zip(*shapes)])
+            )
+            voxels += sum(int(np.prod(shape)) for shape in shapes)
+        return 1 - voxels / max(padded_voxels, 1)
+
+
+class PaddingCollate:
+    def __init__(self, multiple_of=1, minimum_shape=None):
+        """
+        Zero-pads the images and masks of a batch around their centers to the largest spatial shape in the batch and
+        stacks them in one copy. Further elements of the samples, such as names, are collated as usual.
+        :param multiple_of: round the padded shape up to a multiple of this, per spatial axis or for all of them
+        :param minimum_shape: smallest padded spatial shape, None to only pad to the largest sample
+        """
+        self.multiple_of = (
+            tuple(multiple_of)
+            if hasattr(multiple_of, "__len__")
+            else (multiple_of,) * 3
+        )
+        self.minimum_shape = (
+            tuple(minimum_shape) if minimum_shape is not None else (1, 1, 1)
+        )
+
+    def __call__(self, batch):
+        images = [sample[0] for sample in batch]
+        masks = [sample[1] for sample in batch]
+        spatial_shape = [
+            math.ceil(max(*sizes, minimum) / multiple) * multiple
+            for sizes, minimum, multiple in zip(
+                zip(*[image.shape[-3:] for image in images]),
+                self.minimum_shape,
+                self.multiple_of,
+            )
+        ]
+        collated = (pad_stack(images, spatial_shape), pad_stack(masks, spatial_shape))
+        if len(batch[0]) > 2:
+            collated += tuple(
+                torch.utils.data.dataloader.default_collate(
+                    [sample[2:] for sample in batch]
+                )
+            )
+        return collated
@@ -0,0 +1,100 @@
+import nibabel as nib
+import numpy as np
+import torch.utils.data
+
+from volseg.data.bucketing import PaddingCollate
+from volseg.data.patch_sampler import compute_foreground_coordinates
+
+# torch has no unsigned integer types wider than 8 bits, so such arrays are widened to the next signed type
+_TORCH_COMPATIBLE_DTYPES = {
+    np.dtype(np.uint16): np.dtype(np.int32),
+    np.dtype(np.uint32): np.dtype(np.int64),
+}
+
+
+class NiftiDataset(torch.utils.data.Dataset):
+    def __init__(self, image_files, mask_files, mask_dtype=np.uint8):
+        """
+        Reads NIfTI volumes through nibabel's lazy array proxies, so a sample costs one read of the requested voxels in
+        their on-disk dtype instead of a float64 copy of the whole volume. Samples are not padded, use
+        NiftiPaddingCollate to bring a batch to a common shape.
+        :param image_files: paths of the image volumes
+        :param mask_files: paths of the corresponding masks
+        :param mask_dtype: dtype masks are converted to, None to keep the on-disk dtype
+        """
+        if len(image_files) != len(mask_files):
+            raise ValueError(
+                f"Got {len(image_files)} image files but {len(mask_files)} mask files"
+            )
+        self.image_files = image_files
+        self.mask_files = mask_files
+        self.mask_dtype = mask_dtype
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, idx):
+        """
+        :return: (image, mask) tensors of shape (1, *spatial_shape)
+        """
+        return self.read_region(idx, None)
+
+    def get_spatial_shape(self, idx):
+        """
+        :return: spatial shape of the image, read from the header only
+        """
+        return tuple(nib.load(self.image_files[idx]).shape[:3])
+
+    def get_foreground_coordinates(self, idx):
+        """
+        :return: (N, 3) array of subsampled foreground voxel coordinates of the mask
+        """
+        return compute_foreground_coordinates(self.__read(self.mask_files[idx], None))
+
+    def read_region(self, idx, spatial_slices):
+        """
+        Reads only the voxels inside the given region from disk.
+        :param spatial_slices: tuple of slices, one per spatial axis, or None for the whole volume
+        :return: (image, mask) tensors of shape (1, *region_shape)
+        """
+        image = self.__read(self.image_files[idx], spatial_slices)
+        mask = self.__read(self.mask_files[idx], spatial_slices)
+        if self.mask_dtype is not None:
+            mask = mask.astype(self.mask_dtype, copy=False)
+        return _to_tensor(image).unsqueeze(0), _to_tensor(mask).unsqueeze(0)
+
+    @staticmethod
+    def __read(path, spatial_slices):
+        proxy = nib.load(path).dataobj
+        if spatial_slices is None:
+            spatial_slices = (slice(None),) * 3
+        # Volumes without scaling factors keep their on-disk dtype, scaled ones become floating point
+        return np.asarray(proxy[tuple(spatial_slices)])
+
+
+class NiftiPaddingCollate(PaddingCollate):
+    def __init__(self, target_depth=None, depth_axis=2):
+        """
+        PaddingCollate that pads the depth axis to at least target_depth.
+        :param target_depth: minimum depth of the batch, None to only pad to the deepest sample
+        :param depth_axis: index of the depth axis among the spatial axes
+        """
+        minimum_shape = [1, 1, 1]
+        if target_depth is not None:
+            minimum_shape[depth_axis] = target_depth
+        super().__init__(minimum_shape=minimum_shape)
+        self.target_depth = target_depth
+        self.depth_axis = depth_axis
+
+
+def _to_tensor(array):
+    dtype = _TORCH_COMPATIBLE_DTYPES.get(
+        array.dtype.newbyteorder("="), array.dtype.newbyteorder("=")
+    )
+    if array.dtype != dtype:
+        # Big-endian and unsigned 16/32 bit arrays cannot be wrapped by torch as they are
+        array = array.astype(dtype)
+    elif not array.flags.writeable:
+        # Regions of memory-mapped volumes are read-only views, copying them reads just the region from disk
+        array = array.copy()
+    return torch.from_numpy(array)
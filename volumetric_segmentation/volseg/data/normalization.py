@@ -0,0 +1,65 @@
+import torch
+
+
+class InputNormalization:
+    def __init__(
+        self,
+        mean=0.0,
+        stdev=1.0,
+        dtype=torch.float32,
+        memory_format=torch.contiguous_format,
+    ):
+        """
+        Turns compact batches, e.g. uint8 or float16 images, into normalized model inputs at the model boundary, so
+        datasets, caches, DataLoader workers and host-to-device copies only handle the compact dtype. Meant as
+        Trainer(input_transform=...) or applied right before the forward pass, see to_model_input.
+        :param mean: scalar or per-channel sequence subtracted from the inputs
+        :param stdev: scalar or per-channel sequence the inputs are divided by
+        :param dtype: floating point dtype of the model inputs
+        :param memory_format: e.g. torch.channels_last_3d, the cast writes the inputs in this layout directly
+        """
+        self.mean = mean
+        self.stdev = stdev
+        self.dtype = dtype
+        self.memory_format = memory_format
+        self.scale, self.shift = _get_scale_and_shift(mean, stdev)
+
+    def __call__(self, inputs):
+        return to_model_input(
+            inputs, self.scale, self.shift, self.dtype, self.memory_format
+        )
+
+
+def to_model_input(
+    inputs,
+    scale=1.0,
+    shift=0.0,
+    dtype=torch.float32,
+    memory_format=torch.contiguous_format,
+):
+    """
+    Casts inputs into a newly allocated tensor and computes inputs * scale + shift in place, as a single fused
+    multiply-add. Compared to (inputs.float() - mean) / stdev, no intermediate tensors are allocated.
+    :param inputs: (batch, channels, depth, height, width) tensor of any dtype
+    :param scale: scalar or per-channel tensor, 1 / stdev for a normalization
+    :param shift: scalar or per-channel tensor, -mean / stdev for a normalization
+    """
+    output = torch.empty_like(inputs, dtype=dtype, memory_format=memory_format)
+    output.copy_(inputs)
+    scale = torch.as_tensor(scale, dtype=dtype, device=output.device)
+    shift = torch.as_tensor(shift, dtype=dtype, device=output.device)
+    if scale.dim() == 1:
+        # Per-channel values broadcast over the spatial axes
+        scale, shift = scale.view(-1, 1, 1, 1), shift.view(-1, 1, 1, 1)
+    return torch.addcmul(shift, output, scale, out=output)
+
+
+def _get_scale_and_shift(mean, stdev):
+    """
+    :return: (1 / stdev, -mean / stdev) as float64 tensors of shape () or (channels,)
+    """
+    mean = torch.as_tensor(mean, dtype=torch.float64)
+    stdev = torch.as_tensor(stdev, dtype=torch.float64)
+    if torch.any(stdev == 0):
+        raise ValueError(f"stdev must not be zero, got {stdev.tolist()}")
+    return 1.0 / stdev, -mean / stdev
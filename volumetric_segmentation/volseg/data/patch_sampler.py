@@ -0,0 +1,96 @@
+import random
+
+import numpy as np
+import torch.utils.data
+import tqdm
+
+from volseg.utils.image_dimension_wrapper import ImageDimensionsWrapper
+from volseg.utils.io_utils import print_info_message
+from volseg.utils.padding import pad_to_shape
+
+DEFAULT_MAX_FOREGROUND_COORDINATES = 10000
+
+
+class PatchSamplingDataset(torch.utils.data.Dataset):
+    def __init__(
+        self,
+        source,
+        image_dimensions,
+        foreground_probability=0.5,
+        samples_per_epoch=None,
+    ):
+        """
+        Draws random patches of the model's input size from the volumes of a source dataset. A patch is centered on a
+        foreground voxel with foreground_probability and placed uniformly otherwise. Only the patch region is read from
+        the source, so the memory of a sample does not depend on the size of the scan.
+        :param source: dataset implementing get_spatial_shape(idx), read_region(idx, spatial_slices) and
+                       get_foreground_coordinates(idx), e.g. MemoryMappedVolumeDataset or NiftiDataset. Its spatial
+                       axes are the last three axes of the arrays it returns
+        :param image_dimensions: (channels, depth, height, width) of the model, the last three set the patch size
+        :param foreground_probability: fraction of patches containing foreground, cases without any foreground always
+                                       get uniformly placed patches
+        :param samples_per_epoch: number of patches per epoch, defaults to one per case
+        """
+        if not 0 <= foreground_probability <= 1:
+            raise ValueError(
+                f"foreground_probability must be within [0, 1], got {foreground_probability}"
+            )
+        self.source = source
+        self.patch_dhw = ImageDimensionsWrapper(image_dimensions).get_dhw()
+        self.foreground_probability = foreground_probability
+        self.samples_per_epoch = (
+            samples_per_epoch if samples_per_epoch is not None else len(source)
+        )
+        print_info_message(f"Collecting foreground coordinates of {len(source)} cases")
+        self.spatial_shapes = []
+        self.foreground_coordinates = []
+        for idx in tqdm.tqdm(range(len(source))):
+            self.spatial_shapes.append(tuple(source.get_spatial_shape(idx)))
+            self.foreground_coordinates.append(source.get_foreground_coordinates(idx))
+
+    def __len__(self):
+        return self.samples_per_epoch
+
+    def __getitem__(self, idx):
+        """
+        :return: (image, mask) patches, padded with zeros where the volume is smaller than the patch
+        """
+        case = idx % len(self.source)
+        slices = self.sample_patch_slices(case)
+        image, mask = self.source.read_region(case, slices)[:2]
+        return pad_to_shape(image, self.patch_dhw), pad_to_shape(mask, self.patch_dhw)
+
+    def sample_patch_slices(self, case):
+        shape = self.spatial_shapes[case]
+        coordinates = self.foreground_coordinates[case]
+        if len(coordinates) > 0 and random.random() < self.foreground_probability:
+            center = coordinates[random.randrange(len(coordinates))]
+            starts = [
+                min(max(int(c) - size // 2, 0), max(dim - size, 0))
+                for c, size, dim in zip(center, self.patch_dhw, shape)
+            ]
+        else:
+            starts = [
+                random.randint(0, max(dim - size, 0))
+                for size, dim in zip(self.patch_dhw, shape)
+            ]
+        return tuple(
+            slice(start, start + size) for start, size in zip(starts, self.patch_dhw)
+        )
+
+
+def compute_foreground_coordinates(
+    mask, max_coordinates=DEFAULT_MAX_FOREGROUND_COORDINATES
+):
+    """
+    :param mask: array whose last three axes are spatial, leading axes are reduced with any()
+    :param max_coordinates: the coordinates are subsampled with a regular stride to at most this many
+    :return: (N, 3) int32 array of foreground voxel coordinates
+    """
+    mask = np.asarray(mask)
+    foreground = mask.reshape(-1, *mask.shape[-3:]).any(axis=0)
+    coordinates = np.argwhere(foreground).astype(np.int32)
+    if max_coordinates is not None and len(coordinates) > max_coordinates:
+        stride = -(-len(coordinates) // max_coordinates)
+        coordinates = coordinates[::stride]
+    return np.ascontiguousarray(coordinates)
@@ -0,0 +1,282 @@
+import ctypes
+import threading
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+import torch.utils.data
+
+from volseg.utils.padding import stack_arrays
+
+ALIGNMENT = 64
+
+
+class SharedMemoryCache:
+    def __init__(self, max_bytes, policy="lru"):
+        """
+        Byte-budgeted cache of array tuples kept in shared memory, so DataLoader workers share a single copy.
+        Hits return read-only views of that copy, which keep their segment mapped until the last of them is released.
+        Collate them with collate_cached, which stacks them into the batch without torch's non-writable array warning.
+        The index, usage statistics and counters live in a manager process, entries in named shared memory segments.
+        :param max_bytes: total size of cached arrays above which entries are evicted
+        :param policy: "lru" evicts the least recently used entry, "lfu" the least frequently used one
+        """
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        self.__manager = _CacheManager()
+        self.__manager.start()
+        self.__index = self.__manager.CacheIndex(max_bytes, policy)
+        # Segments this process has mapped, each alive as long as views of it are
+        self.__mappings = weakref.WeakValueDictionary()
+        # Workers forked before the resource tracker starts would launch trackers of their own, which unlink every
+        # segment the worker created as soon as it exits. Starting it here makes all workers share this one.
+        resource_tracker.ensure_running()
+        self.__finalizer = weakref.finalize(
+            self, SharedMemoryCache.__release, self.__manager, self.__index
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Workers receive the index proxy only: the manager and the finalizer belong to the process that created the cache
+        for attribute in ("mappings", "manager", "finalizer"):
+            state.pop(f"_SharedMemoryCache__{attribute}")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__mappings = weakref.WeakValueDictionary()
+        self.__manager = None
+        self.__finalizer = None
+
+    def get(self, key):
+        """
+        :return: tuple of read-only arrays backed by shared memory, or None on a miss
+        """
+        entry = self.__index.lookup(key)
+        if entry is None:
+            return None
+        name, layout = entry
+        return self.__attach(name).create_views(layout)
+
+    def put(self, key, arrays):
+        """
+        Stores the arrays, evicting other entries if needed to stay within the byte budget.
+        :return: tuple of read-only arrays backed by shared memory, or the original arrays if they do not fit
+        """
+        arrays = tuple(np.ascontiguousarray(array) for array in arrays)
+        layout, nbytes = SharedMemoryCache.__get_layout(arrays)
+        if nbytes > self.max_bytes:
+            return arrays
+
+        mapping = _SegmentMapping(
+            shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        )
+        for view, array in zip(mapping.create_views(layout, writeable=True), arrays):
+            view[...] = array
+        stored, evicted_names = self.__index.insert(
+            key, mapping.segment.name, layout, nbytes
+        )
+        if stored:
+            self.__mappings[mapping.segment.name] = mapping
+        else:
+            # Another worker cached the same entry in the meantime, this copy lives on only as long as its views
+            evicted_names.append(mapping.segment.name)
+        for name in evicted_names:
+            self.__unlink(name)
+        return mapping.create_views(layout)
+
+    def __contains__(self, key):
+        return self.__index.contains(key)
+
+    def __len__(self):
+        return self.__index.size()
+
+    def get_stats(self):
+        """
+        :return: dict with hits, misses, evictions, cached bytes and number of entries, aggregated over all workers
+        """
+        return self.__index.get_stats()
+
+    def clear(self):
+        for name in self.__index.clear():
+            self.__unlink(name)
+
+    def close(self):
+        """
+        Unlinks all segments and stops the manager process. Views returned earlier stay valid until released.
+        """
+        if self.__finalizer is None:
+            raise RuntimeError("Only the process that created the cache can close it")
+        self.__finalizer()
+
+    def __attach(self, name):
+        mapping = self.__mappings.get(name)
+        if mapping is None:
+            mapping = _SegmentMapping(shared_memory.SharedMemory(name=name))
+            self.__mappings[name] = mapping
+        return mapping
+
+    def __unlink(self, name):
+        try:
+            # Processes that still map the segment keep its memory until their views are released
+            self.__attach(name).segment.unlink()
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def __get_layout(arrays):
+        layout = []
+        offset = 0
+        for array in arrays:
+            layout.append((array.dtype.str, array.shape, offset))
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        return layout, offset
+
+    @staticmethod
+    def __release(manager, index):
+        try:
+            for name in index.clear():
+                try:
+                    segment = shared_memory.SharedMemory(name=name)
+                except FileNotFoundError:
+                    continue
+                segment.unlink()
+                segment.close()
+        except (OSError, EOFError):
+            pass
+        manager.shutdown()
+
+
+def collate_cached(batch):
+    """
+    default_collate for samples holding read-only arrays, such as those returned by SharedMemoryCache. Arrays are
+    copied straight into the batch, in shared memory inside DataLoader workers, instead of being wrapped as tensors,
+    which torch only does for writable arrays.
+    """
+    sample = batch[0]
+    if isinstance(sample, np.ndarray):
+        return stack_arrays(batch)
+    if isinstance(sample, (tuple, list)):
+        return [collate_cached(list(samples)) for samples in zip(*batch)]
+    return torch.utils.data.default_collate(batch)
+
+
+class _SegmentMapping:
+    def __init__(self, segment):
+        """
+        Views address the mapped segment directly instead of exporting its buffer, and hold a reference to this
+        mapping. The segment is therefore closed exactly when the last view is released, never with views alive, and
+        closing it cannot raise BufferError.
+        """
+        self.segment = segment
+        probe = np.frombuffer(segment.buf, dtype=np.uint8)
+        self.address = probe.ctypes.data
+        del probe
+
+    def create_views(self, layout, writeable=False):
+        views = []
+        for dtype, shape, offset in layout:
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            memory = (ctypes.c_char * nbytes).from_address(self.address + offset)
+            memory.owner = self
+            view = np.frombuffer(memory, dtype=dtype).reshape(shape)
+            view.setflags(write=writeable)
+            views.append(view)
+        return tuple(views)
+
+    def __del__(self):
+        self.segment.close()
+
+
+class _CacheIndex:
+    def __init__(self, max_bytes, policy):
+        """
+        Lives in the manager process, so every operation of a worker is a single round trip.
+        """
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = {}  # key -> (segment name, layout, nbytes)
+        self.usage = {}  # key -> (last access tick, access count)
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+        self.tick = 0
+        # The manager serves every worker's connection on a thread of its own
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        :return: (segment name, layout) of the entry, or None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            self.__touch(key)
+            return entry[:2]
+
+    def insert(self, key, name, layout, nbytes):
+        """
+        :return: (whether the entry was stored, names of the segments of evicted entries)
+        """
+        with self.lock:
+            if key in self.entries:
+                return False, []
+            evicted_names = self.__evict(required_bytes=nbytes)
+            self.entries[key] = (name, layout, nbytes)
+            self.counters["bytes"] += nbytes
+            self.__touch(key)
+            return True, evicted_names
+
+    def contains(self, key):
+        return key in self.entries
+
+    def size(self):
+        return len(self.entries)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+    def clear(self):
+        """
+        :return: names of the segments of all removed entries
+        """
+        with self.lock:
+            names = [name for name, _, _ in self.entries.values()]
+            self.entries.clear()
+            self.usage.clear()
+            self.counters["bytes"] = 0
+            return names
+
+    def __evict(self, required_bytes):
+        names = []
+        while self.usage and self.counters["bytes"] + required_bytes > self.max_bytes:
+            if self.policy == "lru":
+                victim = min(self.usage, key=lambda key: self.usage[key][0])
+            else:
+                victim = min(
+                    self.usage, key=lambda key: (self.usage[key][1], self.usage[key][0])
+                )
+            name, _, nbytes = self.entries.pop(victim)
+            del self.usage[victim]
+            self.counters["bytes"] -= nbytes
+            self.counters["evictions"] += 1
+            names.append(name)
+        return names
+
+    def __touch(self, key):
+        self.tick += 1
+        _, count = self.usage.get(key, (0, 0))
+        self.usage[key] = (self.tick, count + 1)
+
+
+class _CacheManager(BaseManager):
+    pass
+
+
+_CacheManager.register("CacheIndex", _CacheIndex)
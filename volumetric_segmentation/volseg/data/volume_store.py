@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import torch.utils.data
+import tqdm
+
+from volseg.data.patch_sampler import compute_foreground_coordinates
+from volseg.utils.io_utils import hash_parameters, print_info_message
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+class VolumeStore:
+    def __init__(self, root, parameters):
+        """
+        On-disk store of preprocessed volumes and masks, one .npy chunk per array. Each set of preprocessing
+        parameters gets its own directory, so changing any of them results in a rebuild instead of stale data.
+        :param root: directory holding stores built with different preprocessing parameters
+        :param parameters: JSON-serializable dict of everything that affects the stored arrays
+        """
+        self.parameters = parameters
+        self.path = os.path.join(root, f"volume_store_{hash_parameters(parameters)}")
+
+    def is_built(self):
+        return os.path.isfile(os.path.join(self.path, MANIFEST_FILENAME))
+
+    def ensure_built(self, dataset, **build_kwargs):
+        if self.is_built():
+            print_info_message(f"Using preprocessed volumes from {self.path}")
+        else:
+            self.build(dataset, **build_kwargs)
+        return self
+
+    def build(
+        self, dataset, num_workers=0, image_dtype=np.float32, mask_dtype=np.uint8
+    ):
+        """
+        Runs every sample of the dataset through its preprocessing once and writes the results to the store.
+        :param dataset: dataset returning (image, mask) or (image, mask, name) tuples of arrays or tensors
+        :param num_workers: number of DataLoader processes decoding samples in parallel
+        :param image_dtype: dtype images are stored in, None to keep the dtype returned by the dataset
+        :param mask_dtype: dtype masks are stored in, None to keep the dtype returned by the dataset
+        """
+        print_info_message(f"Preprocessing {len(dataset)} volumes into {self.path}")
+        partial_path = f"{self.path}.partial"
+        shutil.rmtree(partial_path, ignore_errors=True)
+        os.makedirs(partial_path)
+
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=None, shuffle=False, num_workers=num_workers
+        )
+        cases = []
+        for index, sample in enumerate(tqdm.tqdm(loader, total=len(dataset))):
+            name = str(sample[2]) if len(sample) > 2 else str(index)
+            case = {"name": name}
+            for key, array, dtype in (
+                ("image", sample[0], image_dtype),
+                ("mask", sample[1], mask_dtype),
+            ):
+                array = np.ascontiguousarray(np.asarray(array), dtype=dtype)
+                filename = f"{index:06d}_{key}.npy"
+                np.save(os.path.join(partial_path, filename), array)
+                case[key] = filename
+            filename = f"{index:06d}_foreground.npy"
+            np.save(
+                os.path.join(partial_path, filename),
+                compute_foreground_coordinates(sample[1]),
+            )
+            case["foreground"] = filename
+            cases.append(case)
+
+        with open(os.path.join(partial_path, MANIFEST_FILENAME), "w") as f:
+            json.dump({"parameters": self.parameters, "cases": cases}, f, indent=2)
+        # The manifest is written last and the directory renamed at once, so an interrupted build is never used
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(partial_path, self.path)
+
+    def open_dataset(self):
+        return MemoryMappedVolumeDataset(self.path)
+
+
+class MemoryMappedVolumeDataset(torch.utils.data.Dataset):
+    def __init__(self, path):
+        """
+        Serves volumes written by VolumeStore. Arrays are memory-mapped and wrapped in tensors without copying,
+        so reading a sample costs only the page faults of the data actually touched.
+        :param path: directory of a built VolumeStore
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILENAME), "r") as f:
+            manifest = json.load(f)
+        self.parameters = manifest["parameters"]
+        self.cases = manifest["cases"]
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __getitem__(self, idx):
+        case = self.cases[idx]
+        return self.load_array(idx, "image"), self.load_array(idx, "mask"), case["name"]
+
+    def get_spatial_shape(self, idx):
+        return tuple(self.load_array(idx, "image").shape[-3:])
+
+    def get_foreground_coordinates(self, idx):
+        """
+        :return: (N, 3) array of subsampled foreground voxel coordinates, computed at build time
+        """
+        case = self.cases[idx]
+        if "foreground" in case:
+            return np.load(os.path.join(self.path, case["foreground"]))
+        # Stores built before foreground coordinates were recorded
+        return compute_foreground_coordinates(self.load_array(idx, "mask").numpy())
+
+    def read_region(self, idx, spatial_slices):
+        """
+        :param spatial_slices: tuple of slices for the last three axes
+        :return: (image, mask, name), where only the pages of the region are read from disk
+        """
+        region = (Ellipsis,) + tuple(spatial_slices)
+        return (
+            self.load_array(idx, "image")[region],
+            self.load_array(idx, "mask")[region],
+            self.cases[idx]["name"],
+        )
+
+    def load_array(self, idx, key):
+        # A copy-on-write mapping keeps tensors writable (torch warns about read-only arrays) without touching the file
+        array = np.load(os.path.join(self.path, self.cases[idx][key]), mmap_mode="c")
+        return torch.from_numpy(array)
@@ -1,13 +1,22 @@
-import math
 import os
 import random
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import cv2
 import numpy as np
 import torch.utils.data
-import tqdm
-from skimage.transform import resize
+
+from volseg.data.normalization import InputNormalization
+from volseg.data.shared_cache import SharedMemoryCache
+from volseg.example.slice_loader import load_slices
 from volseg.utils.io_utils import print_info_message
+from volseg.utils.resampling import resize_case, resize_images
+from volseg.utils.statistics import (
+    RunningStatistics,
+    get_statistics_cache_path,
+    load_statistics,
+    save_statistics,
+)
 
 file_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -22,13 +31,51 @@ class BrainMRIDataset(torch.utils.data.Dataset):
         autoscale=False,
         autoscale_using_n_images=None,
         seed=None,
+        statistics_num_workers=None,
+        statistics_cache_dir=None,
+        cache_max_bytes=2 * 1024**3,
+        cache_policy="lru",
+        decode_threads=None,
+        normalize=True,
     ):
+        """
+        Samples are (image, mask, folder) with a (3, depth, height, width) image and a (depth, height, width) uint8
+        mask of zeros and ones.
+        :param reshape_dhw: (depth, height, width) every case is resized to. Masks are interpolated linearly and
+                            thresholded at 0.5, so structures thinner than half an output voxel are dropped instead of
+                            dilated to a whole voxel, see volseg.utils.resampling.resize_labels
+        :param decode_threads: number of threads decoding the slices of a case, defaults to the number of cores divided
+                               among DataLoader workers or statistics processes
+        :param cache_loaded_images: keep loaded samples in shared memory, so all DataLoader workers share one copy.
+                                    Samples are then read-only arrays, collate them with
+                                    volseg.data.shared_cache.collate_cached
+        :param cache_max_bytes: memory budget of the cache, least recently (or frequently) used samples are evicted
+        :param cache_policy: "lru" or "lfu"
+        :param statistics_num_workers: number of processes computing autoscale statistics, defaults to all cores
+        :param statistics_cache_dir: where computed autoscale statistics are persisted, defaults to path_to_root
+        :param normalize: if autoscale is set, whether images are normalized to float32 here. If False, they stay
+                          uint8, which keeps cached samples and worker-to-main transfers 4x smaller, and are
+                          normalized on the device by get_input_normalization()
+        """
         self.path_to_root = path_to_root
         self.folders = folders
         self.reshape_dhw = reshape_dhw
         self.cache_loaded_images = cache_loaded_images
-        self.cache = {}
+        self.cache = (
+            SharedMemoryCache(max_bytes=cache_max_bytes, policy=cache_policy)
+            if cache_loaded_images
+            else None
+        )
         self.autoscale = autoscale
+        self.decode_threads = decode_threads
+        self.normalize = normalize
+        self.statistics_num_workers = statistics_num_workers
+        self.statistics_cache_dir = (
+            statistics_cache_dir if statistics_cache_dir is not None else path_to_root
+        )
+        self.statistics = None
+        # Statistics computed by this instance, by cache path, in case they could not be persisted
+        self.__computed_statistics = {}
         if autoscale:
             self.mean, self.stdev = self.get_scale(
                 use_n_images=autoscale_using_n_images, seed=seed
@@ -38,52 +85,50 @@ class BrainMRIDataset(torch.utils.data.Dataset):
         return len(self.folders)
 
     def __getitem__(self, idx):
-        if self.cache_loaded_images and idx in self.cache:
-            image, mask = self.cache[idx]
-            return image.copy(), mask.copy(), self.folders[idx]
+        if self.cache_loaded_images:
+            cached = self.cache.get(idx)
+            if cached is not None:
+                image, mask = cached
+                return image, mask, self.folders[idx]
 
         path = os.path.join(self.path_to_root, self.folders[idx])
-        image = BrainMRIDataset.__load_image(path, is_mask=False)
-        mask = BrainMRIDataset.__load_image(path, is_mask=True)
+        image, mask = load_slices(path, num_threads=self.decode_threads)
 
         if self.reshape_dhw is not None:
-            image = (255 * resize(image, (image.shape[0], *self.reshape_dhw))).astype(
-                int
-            )
-            mask = resize(mask, self.reshape_dhw)
-        mask = (mask > 0).astype(int)
+            image, mask = resize_case(image, mask, self.reshape_dhw)
+        mask = (mask > 0).view(np.uint8)
 
-        if self.autoscale:
-            image = (image - self.mean) / self.stdev
-        if self.cache_loaded_images:
-            self.cache[idx] = (image, mask)
-        return image.copy(), mask.copy(), self.folders[idx]
-
-    @staticmethod
-    def __load_image(path_to_directory, is_mask):
-        if is_mask:
-            return np.array(
-                [
-                    cv2.imread(
-                        os.path.join(path_to_directory, filename), cv2.IMREAD_GRAYSCALE
-                    )
-                    for filename in sorted(os.listdir(path_to_directory))
-                    if "mask" in filename
-                ]
+        if self.autoscale and self.normalize:
+            image = ((image - np.float32(self.mean)) / np.float32(self.stdev)).astype(
+                np.float32, copy=False
             )
-        else:
-            image = np.array(
-                [
-                    cv2.cvtColor(
-                        cv2.imread(os.path.join(path_to_directory, filename)),
-                        cv2.COLOR_BGR2RGB,
-                    )
-                    for filename in sorted(os.listdir(path_to_directory))
-                    if "mask" not in filename
-                ]
-            )
-            image = np.moveaxis(image, -1, 0)
-            return image
+        if self.cache_loaded_images:
+            image, mask = self.cache.put(idx, (image, mask))
+        return image, mask, self.folders[idx]
+
+    def get_preprocessing_parameters(self):
+        """
+        :return: JSON-serializable dict of everything that determines the returned samples, e.g. to key a VolumeStore
+        """
+        return {
+            "dataset": self.__class__.__name__,
+            "path_to_root": os.path.abspath(self.path_to_root),
+            "folders": list(self.folders),
+            "reshape_dhw": (
+                list(self.reshape_dhw) if self.reshape_dhw is not None else None
+            ),
+            "mean": self.mean if self.autoscale and self.normalize else None,
+            "stdev": self.stdev if self.autoscale and self.normalize else None,
+        }
+
+    def get_input_normalization(self, **kwargs):
+        """
+        :param kwargs: see volseg.data.normalization.InputNormalization
+        :return: InputNormalization with the autoscale mean and stdev, e.g. for Trainer(input_transform=...)
+        """
+        if not self.autoscale:
+            raise RuntimeError("get_input_normalization() requires autoscale=True")
+        return InputNormalization(self.mean, self.stdev, **kwargs)
 
     def get_scale(self, use_n_images=None, seed=None):
         rnd = random.Random(seed)
@@ -92,37 +137,98 @@ class BrainMRIDataset(torch.utils.data.Dataset):
             if use_n_images is not None
             else self.folders
         )
-        print_info_message("Calculating mean")
-        mean = self.get_mean(folders)
-        print_info_message("Calculating standard deviation")
-        stdev = self.get_stdev(folders, mean)
-        return mean, stdev
+        self.statistics = self.get_statistics(folders)
+        return self.statistics.mean, self.statistics.stdev
+
+    def get_statistics(self, folders):
+        """
+        Computes intensity statistics of the given folders in a single pass, reusing persisted results if available.
+        Persisted results are keyed by the size and modification time of every image slice, so edited files are not
+        served stale statistics.
+        :return: RunningStatistics
+        """
+        cache_path = get_statistics_cache_path(
+            self.statistics_cache_dir,
+            folders=sorted(folders),
+            files=self.__get_file_signatures(folders),
+            reshape_dhw=(
+                list(self.reshape_dhw) if self.reshape_dhw is not None else None
+            ),
+            resampling="interpolate",
+        )
+        statistics = self.__computed_statistics.get(cache_path)
+        if statistics is not None:
+            return statistics
+        statistics = load_statistics(cache_path)
+        if statistics is not None:
+            print_info_message(f"Loaded dataset statistics from {cache_path}")
+            return statistics
+
+        print_info_message("Calculating dataset statistics")
+        num_workers = self.statistics_num_workers or os.cpu_count() or 1
+        decode_threads = self.decode_threads or max(
+            1, (os.cpu_count() or 1) // num_workers
+        )
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    _get_image_statistics,
+                    os.path.join(self.path_to_root, folder),
+                    self.reshape_dhw,
+                    decode_threads,
+                )
+                for folder in folders
+            ]
+            for future in _progress(as_completed(futures), total=len(futures)):
+                partial = future.result()
+                statistics = (
+                    partial if statistics is None else statistics.merge(partial)
+                )
+
+        self.__computed_statistics[cache_path] = statistics
+        try:
+            save_statistics(statistics, cache_path)
+        except OSError as e:
+            print_info_message(f"Could not persist dataset statistics: {e}")
+        return statistics
 
     def get_mean(self, folders):
-        accum = 0
-        count = 0
-        for folder in tqdm.tqdm(folders):
-            path = os.path.join(self.path_to_root, folder)
-            image = BrainMRIDataset.__load_image(path, is_mask=False)
-            if self.reshape_dhw is not None:
-                image = (
-                    255 * resize(image, (image.shape[0], *self.reshape_dhw))
-                ).astype(int)
-            accum += image.sum()
-            count += np.prod(image.shape)
-        return accum / count
-
-    def get_stdev(self, folders, mean):
-        accum = 0
-        count = 0
-        for folder in tqdm.tqdm(folders):
-            path = os.path.join(self.path_to_root, folder)
-            image = BrainMRIDataset.__load_image(path, is_mask=False)
-            if self.reshape_dhw is not None:
-                image = (
-                    255 * resize(image, (image.shape[0], *self.reshape_dhw))
-                ).astype(int)
-            stdev_parts = np.vectorize(lambda pixel: (pixel - mean) ** 2)
-            accum += sum(stdev_parts(image.flatten()))
-            count += np.prod(image.shape)
-        return math.sqrt(accum / (count - 1))
+        return self.get_statistics(folders).mean
+
+    def get_stdev(self, folders, mean=None):
+        """
+        :param mean: deprecated and ignored, the mean is computed alongside the standard deviation
+        """
+        if mean is not None:
+            warnings.warn(
+                "The mean argument of get_stdev is deprecated and ignored",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+        return self.get_statistics(folders).stdev
+
+    def __get_file_signatures(self, folders):
+        signatures = []
+        for folder in sorted(folders):
+            directory = os.path.join(self.path_to_root, folder)
+            for filename in sorted(os.listdir(directory)):
+                if "mask" in filename:
+                    continue
+                stat = os.stat(os.path.join(directory, filename))
+                signatures.append([folder, filename, stat.st_size, stat.st_mtime_ns])
+        return signatures
+
+
+def _progress(iterable, total):
+    import tqdm
+
+    return tqdm.tqdm(iterable, total=total)
+
+
+def _get_image_statistics(path_to_directory, reshape_dhw, decode_threads):
+    image, _ = load_slices(
+        path_to_directory, load_mask=False, num_threads=decode_threads
+    )
+    if reshape_dhw is not None:
+        image = resize_images(image[None], reshape_dhw)[0]
+    return RunningStatistics.from_array(image)
@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_executor = None
+_executor_key = None
+# Values of cv2.IMREAD_COLOR and cv2.IMREAD_GRAYSCALE, cv2 is only imported once a slice is decoded
+_IMREAD_COLOR = 1
+_IMREAD_GRAYSCALE = 0
+
+
+def load_slices(path_to_directory, load_image=True, load_mask=True, num_threads=None):
+    """
+    Decodes the 2D slices of a case concurrently and writes them straight into preallocated volumes. cv2 releases
+    the GIL while decoding, so threads scale with the number of cores.
+    :param path_to_directory: directory with one image and one "*mask*" file per slice
+    :param num_threads: number of decoding threads, defaults to get_default_num_threads()
+    :return: (image, mask) tuple of a (3, depth, height, width) RGB and a (depth, height, width) uint8 volume,
+             either of them None if not requested
+    """
+    filenames = sorted(os.listdir(path_to_directory))
+    executor = _get_executor(num_threads)
+    image = mask = None
+    futures = []
+    if load_image:
+        image_paths = [
+            os.path.join(path_to_directory, filename)
+            for filename in filenames
+            if "mask" not in filename
+        ]
+        first_slice = _read(image_paths[0], _IMREAD_COLOR)
+        image = np.empty((3, len(image_paths), *first_slice.shape[:2]), dtype=np.uint8)
+        _write_rgb_slice(image, 0, first_slice)
+        futures += [
+            executor.submit(_decode_rgb_slice, image, depth, path)
+            for depth, path in enumerate(image_paths[1:], start=1)
+        ]
+    if load_mask:
+        mask_paths = [
+            os.path.join(path_to_directory, filename)
+            for filename in filenames
+            if "mask" in filename
+        ]
+        first_slice = _read(mask_paths[0], _IMREAD_GRAYSCALE)
+        mask = np.empty((len(mask_paths), *first_slice.shape), dtype=np.uint8)
+        mask[0] = first_slice
+        futures += [
+            executor.submit(_decode_grayscale_slice, mask, depth, path)
+            for depth, path in enumerate(mask_paths[1:], start=1)
+        ]
+    for future in futures:
+        future.result()
+    return image, mask
+
+
+def _decode_rgb_slice(image, depth, path):
+    _write_rgb_slice(image, depth, _read(path, _IMREAD_COLOR))
+
+
+def _decode_grayscale_slice(mask, depth, path):
+    mask[depth] = _read(path, _IMREAD_GRAYSCALE)
+
+
+def _write_rgb_slice(image, depth, bgr_slice):
+    # BGR -> RGB and HWC -> CHW in the same copy
+    image[:, depth] = np.moveaxis(bgr_slice[..., ::-1], -1, 0)
+
+
+def _read(path, flags):
+    import cv2
+
+    decoded = cv2.imread(path, flags)
+    if decoded is None:
+        raise IOError(f"Could not decode {path}")
+    return decoded
+
+
+def _get_executor(num_threads):
+    global _executor, _executor_key
+    # Thread pools do not survive fork, so DataLoader workers and pool processes each create their own
+    key = (os.getpid(), num_threads)
+    if _executor_key != key:
+        if _executor is not None and _executor_key[0] == key[0]:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(
+            max_workers=num_threads or get_default_num_threads()
+        )
+        _executor_key = key
+    return _executor
+
+
+def get_default_num_threads():
+    """
+    :return: number of cores in the main process, the cores divided among DataLoader workers inside one of them and 1
+             inside other child processes, e.g. of a process pool, so parallel workers do not oversubscribe the cores
+    """
+    # torch is only needed to detect DataLoader workers, which already imported it
+    from torch.utils.data import get_worker_info
+
+    cpu_count = os.cpu_count() or 1
+    worker_info = get_worker_info()
+    if worker_info is not None:
+        return max(1, cpu_count // worker_info.num_workers)
+    if multiprocessing.current_process().name != "MainProcess":
+        return 1
+    return cpu_count
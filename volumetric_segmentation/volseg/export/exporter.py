@@ -0,0 +1,207 @@
+import copy
+import inspect
+import statistics
+import time
+
+import torch
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from volseg.utils.io_utils import print_info_message
+
+BACKENDS = ("torchscript", "compile", "eager")
+_DROPOUT_TYPES = (
+    torch.nn.Dropout,
+    torch.nn.Dropout2d,
+    torch.nn.Dropout3d,
+    torch.nn.AlphaDropout,
+)
+
+
+def prepare_for_inference(model):
+    """
+    :return: eval-mode copy of the model with BatchNorm folded into the preceding convolutions, dropout removed,
+             activation checkpointing disabled and gradients turned off
+    """
+    model = copy.deepcopy(model).eval()
+    if hasattr(model, "checkpoint_levels"):
+        model.checkpoint_levels = set()
+    fold_batch_norms(model)
+    remove_dropout(model)
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    return model
+
+
+def fold_batch_norms(module):
+    """
+    Folds every BatchNorm3d that directly follows a Conv3d inside a Sequential into the convolution, in place. Only
+    valid in eval mode, where BatchNorm applies its running statistics.
+    :return: number of folded BatchNorm layers
+    """
+    folded = 0
+    for child in module.children():
+        folded += fold_batch_norms(child)
+    if not isinstance(module, torch.nn.Sequential):
+        return folded
+    names = list(module._modules)
+    for conv_name, bn_name in zip(names, names[1:]):
+        conv, bn = module._modules[conv_name], module._modules[bn_name]
+        if isinstance(conv, torch.nn.Conv3d) and isinstance(bn, torch.nn.BatchNorm3d):
+            module._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+            module._modules[bn_name] = torch.nn.Identity()
+            folded += 1
+    return folded
+
+
+def remove_dropout(module):
+    """
+    Replaces all dropout layers with identities, in place.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, _DROPOUT_TYPES):
+            setattr(module, name, torch.nn.Identity())
+        else:
+            remove_dropout(child)
+
+
+def compile_for_inference(model, example_input, backend="torchscript"):
+    """
+    :param model: model prepared with prepare_for_inference
+    :param example_input: batch the graph is traced with. Traced graphs are specialized to its spatial shape
+    :param backend: "torchscript" traces and freezes the model, "compile" uses torch.compile, "eager" keeps the model
+    """
+    if backend == "eager":
+        return model
+    if backend == "compile":
+        if not hasattr(torch, "compile"):
+            raise RuntimeError(
+                f"torch.compile requires PyTorch 2.0 or newer, got {torch.__version__}"
+            )
+        return torch.compile(model)
+    if backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_input)
+        # Freezing inlines parameters and submodules, which removes the ModuleDict lookups from the graph
+        return torch.jit.freeze(traced)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+
+def export_onnx(model, example_input, path, opset_version=13):
+    """
+    Exports the model to ONNX with a dynamic batch dimension.
+    """
+    kwargs = {}
+    # Newer PyTorch versions default to the dynamo-based exporter, which needs the onnxscript package
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            example_input,
+            path,
+            opset_version=opset_version,
+            input_names=["volume"],
+            output_names=["segmentation"],
+            dynamic_axes={"volume": {0: "batch"}, "segmentation": {0: "batch"}},
+            **kwargs,
+        )
+    print_info_message(f"ONNX model saved to {path}")
+
+
+def measure_latency(model, example_input, repeats=10, warmup=3):
+    """
+    :return: median seconds per forward pass
+    """
+    timings = []
+    with torch.no_grad():
+        for iteration in range(warmup + repeats):
+            start = time.perf_counter()
+            model(example_input)
+            if iteration >= warmup:
+                timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def export_for_inference(
+    model,
+    example_input=None,
+    backend="torchscript",
+    path=None,
+    onnx_path=None,
+    atol=1e-4,
+    repeats=10,
+):
+    """
+    Turns a trained model into an inference artifact, checks that it matches the eager model and measures the speedup.
+    :param example_input: batch used for tracing, the parity check and timing, defaults to one random sample of the
+                          model's image_dimensions
+    :param backend: see compile_for_inference
+    :param path: where to save the TorchScript module, requires the "torchscript" backend
+    :param onnx_path: where to save an ONNX export of the folded model, None to skip it
+    :param atol: maximum absolute difference to the eager model, a RuntimeError is raised when it is exceeded
+    :return: (exported model, report dict). The training mode of model is left unchanged
+    """
+    if path is not None and backend != "torchscript":
+        raise ValueError(
+            f"Only TorchScript modules can be saved to path, got backend {backend}"
+        )
+    was_training = model.training
+    model.eval()
+    try:
+        if example_input is None:
+            example_input = torch.rand(
+                1,
+                *model.image_dimensions.get(),
+                device=next(model.parameters()).device,
+            )
+        prepared = prepare_for_inference(model)
+        exported = compile_for_inference(prepared, example_input, backend)
+
+        with torch.no_grad():
+            expected = model(example_input)
+            difference = (exported(example_input) - expected).abs().max().item()
+        if difference > atol:
+            raise RuntimeError(
+                f"Exported model differs from the eager model by {difference:.2e} > {atol:.2e}"
+            )
+        eager_latency = measure_latency(model, example_input, repeats)
+    finally:
+        model.train(was_training)
+
+    exported_latency = measure_latency(exported, example_input, repeats)
+    report = {
+        "backend": backend,
+        "max_abs_difference": difference,
+        "eager_seconds": eager_latency,
+        "exported_seconds": exported_latency,
+        "speedup": eager_latency / exported_latency,
+    }
+    print_info_message(
+        f"Exported with {backend}: max abs difference {difference:.2e}, "
+        f"{1000 * eager_latency:.1f} ms -> {1000 * exported_latency:.1f} ms ({report['speedup']:.2f}x)"
+    )
+
+    if path is not None:
+        torch.jit.save(exported, path)
+        print_info_message(f"TorchScript model saved to {path}")
+    if onnx_path is not None:
+        export_onnx(prepared, example_input, onnx_path)
+        report["onnx_max_abs_difference"] = _check_onnx_parity(
+            onnx_path, example_input, expected
+        )
+    return exported, report
+
+
+def _check_onnx_parity(onnx_path, example_input, expected):
+    try:
+        import onnxruntime
+    except ImportError:
+        print_info_message(
+            "onnxruntime is not installed, skipping the ONNX parity check"
+        )
+        return None
+    session = onnxruntime.InferenceSession(onnx_path)
+    (output,) = session.run(None, {"volume": example_input.cpu().numpy()})
+    difference = float(abs(output - expected.cpu().numpy()).max())
+    print_info_message(f"ONNX max abs difference {difference:.2e}")
+    return difference
@@ -0,0 +1,182 @@
+import inspect
+import io
+
+import torch
+
+from volseg.export.exporter import measure_latency, prepare_for_inference
+from volseg.loss.dice import DiceMetric
+from volseg.utils.devices import get_module_device
+from volseg.utils.io_utils import print_info_message
+
+try:
+    import torch.ao.quantization as quantization
+    import torch.ao.quantization.quantize_fx as quantize_fx
+except ImportError:  # PyTorch < 1.10
+    import torch.quantization as quantization
+    import torch.quantization.quantize_fx as quantize_fx
+
+
+def get_quantization_backend():
+    """
+    :return: best quantized engine available on this CPU
+    """
+    supported_engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in supported_engines:
+            return engine
+    raise RuntimeError(f"No quantized engine available, got {supported_engines}")
+
+
+def quantize_static(
+    model,
+    calibration_loader,
+    num_calibration_batches=10,
+    input_transform=None,
+    backend=None,
+):
+    """
+    Post-training static int8 quantization through FX graph mode. Weights are quantized per channel, activation ranges
+    are calibrated on batches of the loader. Skip concatenations and the size matching of upsampled tensors run on
+    dequantized tensors. PReLU stays in float on PyTorch versions without a quantized PReLU, and so do grouped
+    convolutions such as the depthwise ones of separable VNet blocks, whose quantized 3D kernels corrupt memory on
+    small inputs.
+    :param calibration_loader: loader yielding (inputs, labels, ...) batches representative of inference data
+    :param input_transform: callable applied to every input batch, e.g. the normalization used in training
+    :param backend: quantized engine, defaults to get_quantization_backend()
+    :return: quantized GraphModule running on CPU
+    """
+    backend = backend or get_quantization_backend()
+    torch.backends.quantized.engine = backend
+    model = prepare_for_inference(model).cpu()
+    _materialize_same_padding(model)
+
+    qconfig_mapping = _create_qconfig_mapping(backend, model)
+    example_inputs = (torch.zeros(1, *model.image_dimensions.get()),)
+    if "example_inputs" in inspect.signature(quantize_fx.prepare_fx).parameters:
+        prepared = quantize_fx.prepare_fx(
+            model, qconfig_mapping, example_inputs=example_inputs
+        )
+    else:
+        prepared = quantize_fx.prepare_fx(model, qconfig_mapping)
+
+    print_info_message(f"Calibrating on {num_calibration_batches} batches")
+    with torch.no_grad():
+        for batch_number, data in enumerate(calibration_loader):
+            if batch_number >= num_calibration_batches:
+                break
+            prepared(_prepare_inputs(data[0], input_transform))
+    return quantize_fx.convert_fx(prepared)
+
+
+def evaluate_dice(model, loader, input_transform=None, threshold=0.5):
+    """
+    :return: per-class mean Dice of the model on the loader
+    """
+    metric = DiceMetric(threshold=threshold)
+    device = get_module_device(model)
+    with torch.no_grad():
+        for data in loader:
+            outputs = model(_prepare_inputs(data[0], input_transform, device))
+            metric.update(outputs.float().cpu(), data[1])
+    return metric.compute()
+
+
+def compare_quantized(
+    model, quantized, val_loader, input_transform=None, path=None, repeats=5
+):
+    """
+    Reports the accuracy cost and the gains of a quantized model relative to its float model.
+    :param path: where to save the quantized model as TorchScript traced for the model's image_dimensions, None to not
+                 save it
+    :return: report dict with Dice per class, latency and serialized weight sizes of both models
+    """
+    model = prepare_for_inference(model).cpu()
+    float_dice = evaluate_dice(model, val_loader, input_transform)
+    quantized_dice = evaluate_dice(quantized, val_loader, input_transform)
+
+    example_input = torch.rand(1, *model.image_dimensions.get())
+    float_latency = measure_latency(model, example_input, repeats)
+    quantized_latency = measure_latency(quantized, example_input, repeats)
+    report = {
+        "float_dice": float_dice.tolist(),
+        "quantized_dice": quantized_dice.tolist(),
+        "dice_change": (quantized_dice - float_dice).tolist(),
+        "float_seconds": float_latency,
+        "quantized_seconds": quantized_latency,
+        "speedup": float_latency / quantized_latency,
+        "float_bytes": _get_serialized_size(model.state_dict()),
+        "quantized_bytes": _get_serialized_size(quantized.state_dict()),
+    }
+    print_info_message(
+        f"Dice {report['float_dice']} -> {report['quantized_dice']}, "
+        f"{1000 * float_latency:.1f} ms -> {1000 * quantized_latency:.1f} ms ({report['speedup']:.2f}x), "
+        f"weights {report['float_bytes'] / 2**20:.1f} MiB -> {report['quantized_bytes'] / 2**20:.1f} MiB"
+    )
+    if path is not None:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(quantized, example_input), path)
+        print_info_message(f"Quantized model saved to {path}")
+    return report
+
+
+def _create_qconfig_mapping(backend, model):
+    keep_prelu_in_float = not _has_quantized_prelu()
+    grouped_convolutions = [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Conv3d) and module.groups > 1
+    ]
+    if hasattr(quantization, "get_default_qconfig_mapping"):
+        qconfig_mapping = quantization.get_default_qconfig_mapping(backend)
+        if keep_prelu_in_float:
+            qconfig_mapping = qconfig_mapping.set_object_type(torch.nn.PReLU, None)
+        for name in grouped_convolutions:
+            qconfig_mapping = qconfig_mapping.set_module_name(name, None)
+        return qconfig_mapping
+    # PyTorch < 1.13 takes a qconfig dict
+    qconfig_dict = {"": quantization.get_default_qconfig(backend)}
+    if keep_prelu_in_float:
+        qconfig_dict["object_type"] = [(torch.nn.PReLU, None)]
+    qconfig_dict["module_name"] = [(name, None) for name in grouped_convolutions]
+    return qconfig_dict
+
+
+def _has_quantized_prelu():
+    try:
+        from torch.ao.nn.quantized import PReLU
+    except ImportError:
+        return False
+    return True
+
+
+def _materialize_same_padding(model):
+    """
+    Quantized convolutions only accept numeric paddings, "same" is equivalent to symmetric padding for the odd
+    kernels used in both models.
+    """
+    for module in model.modules():
+        if isinstance(module, torch.nn.Conv3d) and module.padding == "same":
+            if any(
+                (size - 1) * dilation % 2
+                for size, dilation in zip(module.kernel_size, module.dilation)
+            ):
+                raise ValueError(
+                    f"Cannot quantize {module} with asymmetric 'same' padding"
+                )
+            module.padding = tuple(
+                (size - 1) * dilation // 2
+                for size, dilation in zip(module.kernel_size, module.dilation)
+            )
+
+
+def _prepare_inputs(inputs, input_transform, device="cpu"):
+    inputs = inputs.to(device)
+    if input_transform is not None:
+        inputs = input_transform(inputs)
+    return inputs.float()
+
+
+def _get_serialized_size(state_dict):
+    buffer = io.BytesIO()
+    torch.save(state_dict, buffer)
+    return buffer.tell()
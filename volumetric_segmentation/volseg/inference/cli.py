@@ -0,0 +1,136 @@
+import argparse
+import json
+import sys
+
+import torch
+
+from volseg.inference.pipeline import InferencePipeline, list_nifti_files
+from volseg.inference.sliding_window import SlidingWindowInference
+from volseg.inference.tta import TestTimeAugmentation, create_views
+from volseg.model.artifact import load_model as load_artifact_model
+from volseg.model.registry import MODELS
+from volseg.utils.image_dimension_wrapper import (
+    ImageDimensionsWrapper,
+    parse_dimensions,
+)
+from volseg.utils.io_utils import print_info_message
+from volseg.utils.serialization import torch_load
+
+# Arguments of create_views per --tta choice
+TTA_VIEWS = {"flip": {}, "flip-rot90": {"rotation_plane": (1, 2)}}
+
+
+def load_model(args):
+    """
+    :return: (model, patch_dhw), the model is loaded once and shared by all cases
+    """
+    if args.artifact is not None:
+        model = load_artifact_model(args.artifact)
+        return model, model.image_dimensions.get_dhw()
+    image_dimensions = ImageDimensionsWrapper(args.image_dimensions)
+    if args.torchscript is not None:
+        model = torch.jit.load(args.torchscript, map_location="cpu")
+    else:
+        model = MODELS[args.model](
+            num_classes=args.num_classes, image_dimensions=image_dimensions
+        )
+        if args.weights is not None:
+            model.load_state_dict(torch_load(args.weights))
+    return model.eval(), image_dimensions.get_dhw()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="volseg-infer",
+        description="Segments every NIfTI volume of a directory, overlapping reading, inference and writing.",
+    )
+    parser.add_argument("input_dir", help="directory of .nii/.nii.gz volumes")
+    parser.add_argument("output_dir", help="directory the masks are written to")
+    parser.add_argument("--model", choices=sorted(MODELS), default="unet3d")
+    parser.add_argument("--num-classes", type=int, default=1)
+    parser.add_argument(
+        "--image-dimensions",
+        type=parse_dimensions,
+        help="patch size as channels x depth x height x width, e.g. 1x32x64x64, read from --artifact if given",
+    )
+    weights_group = parser.add_mutually_exclusive_group(required=True)
+    weights_group.add_argument("--weights", help="state_dict saved during training")
+    weights_group.add_argument(
+        "--torchscript", help="TorchScript model saved by volseg.export"
+    )
+    weights_group.add_argument(
+        "--artifact",
+        help="model saved by volseg.model.artifact.save_artifact, architecture and patch size included",
+    )
+    parser.add_argument(
+        "--mean",
+        type=float,
+        help="mean subtracted from the inputs, defaults to the artifact's metadata or 0",
+    )
+    parser.add_argument(
+        "--stdev",
+        type=float,
+        help="stdev the inputs are divided by, defaults to the artifact's metadata or 1",
+    )
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--threads", type=int, help="intra-op threads of the model")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--suffix", default="_mask")
+    parser.add_argument(
+        "--tta",
+        choices=sorted(TTA_VIEWS),
+        help="average predictions over the 8 flipped views (flip) or 16 flipped and rotated views (flip-rot90), "
+        "batched into one forward pass",
+    )
+    parser.add_argument(
+        "--tta-batch-size",
+        type=int,
+        help="largest number of patches and views per forward pass, defaults to all views of a batch",
+    )
+    parser.add_argument("--report", help="path of the JSON throughput report")
+    args = parser.parse_args(argv)
+    if args.artifact is None and args.image_dimensions is None:
+        parser.error("--image-dimensions is required unless --artifact is given")
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model, patch_dhw = load_model(args)
+    metadata = getattr(model, "metadata", {})
+    mean = args.mean if args.mean is not None else metadata.get("mean", 0.0)
+    stdev = args.stdev if args.stdev is not None else metadata.get("stdev", 1.0)
+    if args.tta is not None:
+        if args.tta == "flip-rot90" and patch_dhw[1] != patch_dhw[2]:
+            parser.error("--tta flip-rot90 requires patches of equal height and width")
+        model = TestTimeAugmentation(
+            model,
+            create_views(**TTA_VIEWS[args.tta]),
+            max_batch_size=args.tta_batch_size,
+        )
+    inference = SlidingWindowInference(
+        model, overlap=args.overlap, batch_size=args.batch_size, patch_dhw=patch_dhw
+    )
+    pipeline = InferencePipeline(
+        inference,
+        num_readers=args.readers,
+        num_writers=args.writers,
+        queue_size=args.queue_size,
+        input_transform=lambda volume: (volume - mean) / stdev,
+        threshold=args.threshold,
+        suffix=args.suffix,
+    )
+    input_paths = list_nifti_files(args.input_dir)
+    print_info_message(f"Segmenting {len(input_paths)} volumes from {args.input_dir}")
+    report = pipeline.run(input_paths, args.output_dir)
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print_info_message(f"Report saved to {args.report}")
+    return 1 if report["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
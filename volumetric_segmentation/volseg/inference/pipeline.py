@@ -0,0 +1,299 @@
+import os
+import queue
+import threading
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from volseg.utils.io_utils import print_info_message
+
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+_END_OF_STREAM = None
+
+
+class InferencePipeline:
+    def __init__(
+        self,
+        inference,
+        num_readers=2,
+        num_writers=2,
+        queue_size=4,
+        input_transform=None,
+        threshold=0.5,
+        suffix="_mask",
+    ):
+        """
+        Segments NIfTI files in three concurrent stages connected by bounded queues: reader threads decode and
+        preprocess volumes, the calling thread runs the model on batches of patches that may span several cases, and
+        writer threads save masks with the affine and header of their input. Decoding and compression release the GIL,
+        so they overlap with the model.
+        :param inference: SlidingWindowInference used for patching, prediction and blending
+        :param queue_size: maximum number of decoded volumes waiting for the model and of predictions waiting to be
+                           written, which bounds memory
+        :param input_transform: callable applied to every (1, *spatial) float32 tensor read from disk, e.g. the
+                                normalization used in training
+        :param threshold: binarization threshold of single-class outputs, multi-class outputs are reduced by argmax
+        :param suffix: appended to the input file name, before its extension, to name the output
+        """
+        self.inference = inference
+        self.num_readers = num_readers
+        self.num_writers = num_writers
+        self.queue_size = queue_size
+        self.input_transform = input_transform
+        self.threshold = threshold
+        self.suffix = suffix
+
+    def run(self, input_paths, output_directory):
+        """
+        :return: dict of per-stage statistics: cases, busy seconds, cases and voxels per busy second, plus failures
+        """
+        os.makedirs(output_directory, exist_ok=True)
+        paths = queue.Queue()
+        for path in input_paths:
+            paths.put(path)
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        self.statistics = {
+            stage: _StageStatistics() for stage in ("read", "compute", "write")
+        }
+        self.failures = []
+        self.lock = threading.Lock()
+
+        start = time.perf_counter()
+        readers = [
+            threading.Thread(target=self.__read_worker, args=(paths, read_queue))
+            for _ in range(self.num_readers)
+        ]
+        writers = [
+            threading.Thread(
+                target=self.__write_worker, args=(write_queue, output_directory)
+            )
+            for _ in range(self.num_writers)
+        ]
+        for thread in readers + writers:
+            thread.daemon = True
+            thread.start()
+        try:
+            self.__compute(read_queue, write_queue)
+        finally:
+            for _ in writers:
+                write_queue.put(_END_OF_STREAM)
+            for thread in writers:
+                thread.join()
+        wall_seconds = time.perf_counter() - start
+
+        report = {
+            stage: statistics.to_dict() for stage, statistics in self.statistics.items()
+        }
+        report["wall_seconds"] = wall_seconds
+        report["cases_per_second"] = self.statistics["write"].cases / wall_seconds
+        report["failures"] = list(self.failures)
+        for stage in ("read", "compute", "write"):
+            print_info_message(f"{stage}: {self.statistics[stage]}")
+        print_info_message(
+            f"{self.statistics['write'].cases} cases in {wall_seconds:.1f} s "
+            f"({report['cases_per_second']:.2f} cases/s), {len(self.failures)} failed"
+        )
+        return report
+
+    def get_output_path(self, input_path, output_directory):
+        name = os.path.basename(input_path)
+        for extension in NIFTI_EXTENSIONS[::-1]:
+            if name.endswith(extension):
+                return os.path.join(
+                    output_directory, name[: -len(extension)] + self.suffix + extension
+                )
+        return os.path.join(output_directory, name + self.suffix)
+
+    def __read_worker(self, paths, read_queue):
+        try:
+            while True:
+                try:
+                    path = paths.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                try:
+                    image = nib.load(path)
+                    volume = np.asarray(image.dataobj, dtype=np.float32)[None]
+                    volume = self.__transform(volume)
+                except Exception as e:
+                    self.__fail(path, e)
+                    continue
+                self.statistics["read"].add(
+                    self.lock, time.perf_counter() - start, 1, volume[0].numel()
+                )
+                read_queue.put((path, image, volume))
+        finally:
+            read_queue.put(_END_OF_STREAM)
+
+    def __transform(self, volume):
+        volume = torch.from_numpy(volume)
+        if self.input_transform is not None:
+            volume = self.input_transform(volume)
+        return volume
+
+    def __compute(self, read_queue, write_queue):
+        """
+        Fills every batch with patches of as many cases as needed, so small volumes do not leave batches half empty.
+        """
+        active_readers = self.num_readers
+        cases = []
+        while active_readers > 0 or cases:
+            batch = []
+            while len(batch) < self.inference.batch_size:
+                case = next((case for case in cases if case.patches is not None), None)
+                if case is None:
+                    if active_readers == 0:
+                        break
+                    try:
+                        # Only wait for the readers when there is nothing to compute
+                        item = read_queue.get(block=not batch)
+                    except queue.Empty:
+                        break
+                    if item is _END_OF_STREAM:
+                        active_readers -= 1
+                        continue
+                    path, image, volume = item
+                    try:
+                        case = _Case(
+                            path, image, self.inference.create_accumulator(volume)
+                        )
+                    except Exception as e:
+                        self.__fail(path, e)
+                        continue
+                    cases.append(case)
+                try:
+                    patch = next(case.patches, None)
+                except Exception as e:
+                    self.__drop(cases, [case], e)
+                    batch = [item for item in batch if item[0] is not case]
+                    continue
+                if patch is None:
+                    case.patches = None
+                    continue
+                case.pending += 1
+                batch.append((case, patch))
+
+            start = time.perf_counter()
+            if batch:
+                try:
+                    predictions = self.inference.predict_patches(
+                        [patch for _, (_, patch) in batch]
+                    )
+                    for (case, (patch_start, _)), prediction in zip(batch, predictions):
+                        case.accumulator.add(patch_start, prediction)
+                        case.pending -= 1
+                except Exception as e:
+                    # The batch cannot be attributed to one case, so every case with a patch in it is dropped
+                    self.__drop(cases, [case for case, _ in batch], e)
+            # A case is only known to be exhausted after its last patch was computed, possibly in an earlier batch
+            finished = [
+                case for case in cases if case.patches is None and case.pending == 0
+            ]
+            if not batch and not finished:
+                continue
+            results = []
+            for case in list(finished):
+                try:
+                    results.append(case.accumulator.result())
+                except Exception as e:
+                    self.__drop(cases, [case], e)
+                    finished.remove(case)
+            self.statistics["compute"].add(
+                self.lock,
+                time.perf_counter() - start,
+                len(finished),
+                sum(result[0].numel() for result in results),
+            )
+            for case, result in zip(finished, results):
+                cases.remove(case)
+                write_queue.put((case.path, case.image, result))
+
+    def __write_worker(self, write_queue, output_directory):
+        while True:
+            item = write_queue.get()
+            if item is _END_OF_STREAM:
+                return
+            path, image, prediction = item
+            start = time.perf_counter()
+            try:
+                if prediction.shape[0] == 1:
+                    mask = (prediction[0] > self.threshold).numpy().astype(np.uint8)
+                else:
+                    mask = prediction.argmax(dim=0).numpy().astype(np.uint8)
+                header = image.header.copy()
+                header.set_data_dtype(np.uint8)
+                # Masks hold labels, so the intensity scaling of the input must not be applied to them
+                header.set_slope_inter(1, 0)
+                output = nib.Nifti1Image(mask, image.affine, header)
+                nib.save(output, self.get_output_path(path, output_directory))
+            except Exception as e:
+                self.__fail(path, e)
+                continue
+            self.statistics["write"].add(
+                self.lock, time.perf_counter() - start, 1, mask.size
+            )
+
+    def __drop(self, cases, failed_cases, error):
+        """
+        Records a failure of every case in failed_cases and discards their remaining patches, so other cases proceed.
+        """
+        for case in failed_cases:
+            if case in cases:
+                cases.remove(case)
+                self.__fail(case.path, error)
+
+    def __fail(self, path, error):
+        print_info_message(f"Failed to process {path}: {error}")
+        with self.lock:
+            self.failures.append(path)
+
+
+class _Case:
+    def __init__(self, path, image, accumulator):
+        self.path = path
+        self.image = image
+        self.accumulator = accumulator
+        # Set to None once all patches are batched
+        self.patches = accumulator.patches()
+        self.pending = 0
+
+
+class _StageStatistics:
+    def __init__(self):
+        self.cases = 0
+        self.seconds = 0.0
+        self.voxels = 0
+
+    def add(self, lock, seconds, cases, voxels):
+        with lock:
+            self.cases += cases
+            self.seconds += seconds
+            self.voxels += voxels
+
+    def to_dict(self):
+        seconds = max(self.seconds, 1e-9)
+        return {
+            "cases": self.cases,
+            "busy_seconds": self.seconds,
+            "cases_per_second": self.cases / seconds,
+            "voxels_per_second": self.voxels / seconds,
+        }
+
+    def __str__(self):
+        statistics = self.to_dict()
+        return (
+            f"{self.cases} cases, {self.seconds:.1f} s busy, {statistics['cases_per_second']:.2f} cases/s, "
+            f"{statistics['voxels_per_second'] / 1e6:.2f} Mvox/s"
+        )
+
+
+def list_nifti_files(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(NIFTI_EXTENSIONS)
+    )
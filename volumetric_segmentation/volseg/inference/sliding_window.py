@@ -0,0 +1,162 @@
+import itertools
+
+import torch
+
+from volseg.utils.devices import get_module_device
+from volseg.utils.padding import pad_to_shape
+
+
+class SlidingWindowInference:
+    def __init__(
+        self, model, overlap=0.5, batch_size=1, sigma_scale=0.125, patch_dhw=None
+    ):
+        """
+        Runs a model on volumes of any size by splitting them into overlapping patches of the model's native shape.
+        Overlapping predictions are blended with a Gaussian window, so patch borders get less weight than centers.
+        :param model: VNet, UNet3d or any module mapping (N, C, D, H, W) to (N, num_classes, D, H, W)
+        :param overlap: fraction of a patch shared with its neighbour along each axis, in [0, 1)
+        :param batch_size: number of patches passed through the model at once (trades memory for latency)
+        :param sigma_scale: standard deviation of the blending window relative to the patch size
+        :param patch_dhw: (depth, height, width) of a patch, defaults to the model's image_dimensions
+        """
+        if not 0 <= overlap < 1:
+            raise ValueError(f"overlap must be in [0, 1), got {overlap}")
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+        self.model = model
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.patch_dhw = tuple(
+            patch_dhw if patch_dhw is not None else model.image_dimensions.get_dhw()
+        )
+        self.importance_map = SlidingWindowInference.__gaussian_importance_map(
+            self.patch_dhw, sigma_scale
+        )
+
+    def __call__(self, volume):
+        """
+        :param volume: (channels, depth, height, width) array or tensor of any spatial size
+        :return: (num_classes, depth, height, width) float32 CPU tensor of blended model outputs
+        """
+        accumulator = self.create_accumulator(volume)
+        patches = accumulator.patches()
+        while True:
+            chunk = list(itertools.islice(patches, self.batch_size))
+            if not chunk:
+                break
+            starts, inputs = zip(*chunk)
+            for start, prediction in zip(starts, self.predict_patches(inputs)):
+                accumulator.add(start, prediction)
+        return accumulator.result()
+
+    def create_accumulator(self, volume):
+        return PatchAccumulator(
+            volume, self.patch_dhw, self.overlap, self.importance_map
+        )
+
+    def predict_patches(self, patches):
+        """
+        :param patches: sequence of (channels, *patch_dhw) tensors, possibly coming from different volumes
+        :return: (len(patches), num_classes, *patch_dhw) CPU tensor
+        """
+        batch = torch.stack(tuple(patches)).to(
+            device=get_module_device(self.model), dtype=torch.float32
+        )
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                return self.model(batch).float().cpu()
+        finally:
+            self.model.train(was_training)
+
+    @staticmethod
+    def __gaussian_importance_map(patch_dhw, sigma_scale):
+        axes = []
+        for size in patch_dhw:
+            coordinates = torch.arange(size, dtype=torch.float32) - (size - 1) / 2
+            sigma = max(size * sigma_scale, 1e-3)
+            axes.append(torch.exp(-(coordinates**2) / (2 * sigma**2)))
+        importance_map = (
+            axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]
+        )
+        importance_map /= importance_map.max()
+        # Patch borders must keep a non-zero weight, otherwise voxels covered only by borders would divide by zero
+        return importance_map.clamp_(min=1e-3)
+
+
+class PatchAccumulator:
+    def __init__(self, volume, patch_dhw, overlap, importance_map):
+        """
+        Holds a single volume split into patches along with the running, weighted sum of patch predictions.
+        :param volume: (channels, depth, height, width) array or tensor
+        """
+        volume = torch.as_tensor(volume)
+        if volume.dim() != 4:
+            raise ValueError(
+                f"Expected a (channels, depth, height, width) volume, got shape {tuple(volume.shape)}"
+            )
+        self.original_dhw = tuple(volume.shape[1:])
+        self.patch_dhw = patch_dhw
+        self.importance_map = importance_map
+
+        # Volumes smaller than a patch along some axis are zero-padded at the end and cropped back in result()
+        volume = pad_to_shape(volume, patch_dhw)
+        self.volume = volume
+        self.starts = list(
+            itertools.product(
+                *(
+                    PatchAccumulator.__get_starts(size, patch, overlap)
+                    for size, patch in zip(volume.shape[1:], patch_dhw)
+                )
+            )
+        )
+        self.output = None
+        self.weights = torch.zeros(volume.shape[1:], dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def patches(self):
+        for start in self.starts:
+            yield start, self.volume[(slice(None), *self.__get_slices(start))]
+
+    def add(self, start, prediction):
+        """
+        :param start: (depth, height, width) patch origin as yielded by patches()
+        :param prediction: (num_classes, *patch_dhw) model output for that patch
+        """
+        if self.output is None:
+            self.output = torch.zeros(
+                (prediction.shape[0], *self.volume.shape[1:]), dtype=torch.float32
+            )
+        slices = self.__get_slices(start)
+        self.output[(slice(None), *slices)].addcmul_(prediction, self.importance_map)
+        self.weights[slices].add_(self.importance_map)
+
+    def result(self):
+        """
+        :return: (num_classes, depth, height, width) weighted average of the patch predictions, leaving the
+                 accumulated sums untouched so further patches can still be added
+        """
+        if self.output is None:
+            raise RuntimeError("No patch predictions have been added")
+        depth, height, width = self.original_dhw
+        return (
+            self.output[:, :depth, :height, :width]
+            / self.weights[:depth, :height, :width]
+        )
+
+    def __get_slices(self, start):
+        return tuple(
+            slice(origin, origin + size) for origin, size in zip(start, self.patch_dhw)
+        )
+
+    @staticmethod
+    def __get_starts(size, patch, overlap):
+        step = max(int(patch * (1 - overlap)), 1)
+        starts = list(range(0, size - patch + 1, step))
+        if starts[-1] != size - patch:
+            starts.append(size - patch)
+        return starts
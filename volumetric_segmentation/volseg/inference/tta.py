@@ -0,0 +1,157 @@
+import itertools
+
+import torch
+
+from volseg.utils.timing import TimingMixin, get_synchronized_time
+
+_AXIS_NAMES = "dhw"
+
+
+class View:
+    def __init__(self, flip_axes=(), quarter_turns=0, rotation_plane=(1, 2)):
+        """
+        Flip followed by a rotation by a multiple of 90 degrees, both invertible without loss.
+        :param flip_axes: spatial axes (0 = depth, 1 = height, 2 = width) that are flipped
+        :param quarter_turns: number of 90 degree rotations in rotation_plane, odd ones require a square plane
+        :param rotation_plane: pair of spatial axes spanning the rotation plane
+        """
+        self.flip_axes = tuple(flip_axes)
+        self.quarter_turns = quarter_turns % 4
+        self.rotation_plane = tuple(rotation_plane)
+        name = []
+        if self.flip_axes:
+            name.append("flip_" + "".join(_AXIS_NAMES[axis] for axis in self.flip_axes))
+        if self.quarter_turns:
+            plane = "".join(_AXIS_NAMES[axis] for axis in self.rotation_plane)
+            name.append(f"rot{90 * self.quarter_turns}_{plane}")
+        self.name = "_".join(name) or "identity"
+
+    def __repr__(self):
+        return self.name
+
+    def apply(self, tensor):
+        """
+        :param tensor: (batch, channels, depth, height, width)
+        """
+        if self.flip_axes:
+            tensor = tensor.flip([2 + axis for axis in self.flip_axes])
+        if self.quarter_turns:
+            tensor = tensor.rot90(
+                self.quarter_turns, [2 + axis for axis in self.rotation_plane]
+            )
+        return tensor
+
+    def invert(self, tensor):
+        if self.quarter_turns:
+            tensor = tensor.rot90(
+                -self.quarter_turns, [2 + axis for axis in self.rotation_plane]
+            )
+        if self.flip_axes:
+            tensor = tensor.flip([2 + axis for axis in self.flip_axes])
+        return tensor
+
+
+def create_views(flip_axes=(0, 1, 2), rotation_plane=None):
+    """
+    Flips along all three axes alone give 8 views. Adding rotations in a plane gives 16 distinct views, since a 180
+    degree rotation equals flipping both in-plane axes and 270 degrees equals 90 degrees followed by that flip.
+    Combinations that compose to the same transform as an earlier view are skipped.
+    :param flip_axes: every subset of these axes is flipped in one of the views
+    :param rotation_plane: if given, every flip is also combined with rotations by 90, 180 and 270 degrees
+    :return: list of distinct View, the identity first
+    """
+    flips = [
+        subset
+        for count in range(len(flip_axes) + 1)
+        for subset in itertools.combinations(flip_axes, count)
+    ]
+    rotations = range(4) if rotation_plane is not None else (0,)
+    # A symmetry of the cube is determined by where it moves the corners of a 2x2x2 volume
+    corners = torch.arange(8).reshape(1, 1, 2, 2, 2)
+    views = {}
+    for quarter_turns in rotations:
+        for axes in flips:
+            view = View(axes, quarter_turns, rotation_plane or (1, 2))
+            views.setdefault(tuple(view.apply(corners).flatten().tolist()), view)
+    return list(views.values())
+
+
+class TestTimeAugmentation(TimingMixin, torch.nn.Module):
+    def __init__(self, model, views=None, max_batch_size=None, measure_time=False):
+        """
+        Averages the outputs of a model over augmented views of its inputs. The views of a batch are stacked along the
+        batch axis and run through the model in one forward pass, or in as few passes of at most max_batch_size samples
+        as possible. Outputs are mapped back by the inverse of their view and summed into a single output tensor in
+        place. The wrapper is a module itself, so it can be used wherever the model is, e.g. in SlidingWindowInference.
+        :param model: VNet, UNet3d or any module mapping (N, C, D, H, W) to (N, num_classes, D, H, W)
+        :param views: list of View, defaults to the 8 combinations of flips along depth, height and width, see
+                      create_views for the number of views of other settings
+        :param max_batch_size: largest number of samples per forward pass, bounds the activation memory, which grows
+                               linearly with it. None to run all views at once
+        :param measure_time: accumulate the time spent on every view, which synchronizes CUDA after each step. The
+                             forward pass of a chunk is attributed to its views in equal parts
+        """
+        super().__init__()
+        self.model = model
+        self.views = list(views) if views is not None else create_views()
+        if not self.views:
+            raise ValueError("At least one view is required")
+        if max_batch_size is not None and max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        self.max_batch_size = max_batch_size
+        self.measure_time = measure_time
+        if hasattr(model, "image_dimensions"):
+            self.image_dimensions = model.image_dimensions
+        self.reset_timings()
+
+    def forward(self, x):
+        """
+        :param x: (batch, channels, depth, height, width)
+        :return: mean of the model outputs over all views, in the orientation of x
+        """
+        for view in self.views:
+            if view.quarter_turns % 2 == 1:
+                sizes = [x.shape[2 + axis] for axis in view.rotation_plane]
+                if sizes[0] != sizes[1]:
+                    raise ValueError(
+                        f"View {view} rotates a non-square {sizes[0]}x{sizes[1]} plane"
+                    )
+        # A batch larger than max_batch_size still runs in one pass per view
+        views_per_pass = (
+            len(self.views)
+            if self.max_batch_size is None
+            else max(self.max_batch_size // x.shape[0], 1)
+        )
+        output = None
+        for first in range(0, len(self.views), views_per_pass):
+            views = self.views[first : first + views_per_pass]
+            start = self.__now(x)
+            inputs = torch.cat([view.apply(x) for view in views])
+            self.__add_time(views, start, x)
+
+            start = self.__now(x)
+            outputs = self.model(inputs)
+            self.__add_time(views, start, x)
+
+            for view, view_outputs in zip(views, outputs.split(x.shape[0])):
+                start = self.__now(x)
+                inverted = view.invert(view_outputs)
+                if output is None:
+                    output = inverted.clone(memory_format=torch.contiguous_format)
+                else:
+                    output.add_(inverted)
+                self.__add_time([view], start, x, calls=1)
+        return output.div_(len(self.views))
+
+    def __now(self, x):
+        return get_synchronized_time(x) if self.measure_time else None
+
+    def __add_time(self, views, start, x, calls=0):
+        """
+        Splits the time since start equally among views, calls is added to their call counts.
+        """
+        if not self.measure_time:
+            return
+        seconds = (self.__now(x) - start) / len(views)
+        for view in views:
+            self.record_time(view.name, seconds, calls)
@@ -3,11 +3,180 @@ import torch
 # Based on: https://github.com/lyakaap/pytorch-template/blob/master/src/losses.py
 
 
-class DiceLoss(torch.nn.Module):
+class TverskyLoss(torch.nn.Module):
+    def __init__(self, alpha=0.5, beta=0.5, batch_dice=False, eps=1e-7):
+        """
+        1 - Tversky index, TP / (TP + alpha * FP + beta * FN), computed per sample and class in one vectorized pass.
+        For a (sample, class) pair with an empty target, the index is computed on the complements of output and target
+        instead, so that predicting nothing is rewarded rather than yielding 0 / 0.
+        :param alpha: weight of false positives
+        :param beta: weight of false negatives
+        :param batch_dice: if True, statistics are summed over the batch before computing the index
+        """
+        super().__init__()
+        self.alpha = alpha
+        self.beta = beta
+        self.batch_dice = batch_dice
+        self.eps = eps
+
     def forward(self, output, target):
-        if torch.sum(target) == 0:
-            output = 1.0 - output
-            target = 1.0 - target
+        """
+        :param output: (batch, classes, depth, height, width) probabilities
+        :param target: tensor of the same shape (binary or one-hot), a (batch, depth, height, width) binary mask if
+                       there is a single class, or (batch, [1,] depth, height, width) integer class labels
+        """
+        true_positives, output_sums, target_sums, voxels = get_overlap_statistics(
+            output, target
+        )
+        if self.batch_dice:
+            true_positives, output_sums, target_sums = (
+                true_positives.sum(dim=0),
+                output_sums.sum(dim=0),
+                target_sums.sum(dim=0),
+            )
+            voxels = voxels * output.shape[0]
+
+        true_positives, output_sums, target_sums = complement_empty_targets(
+            true_positives, output_sums, target_sums, voxels
+        )
+        false_positives = output_sums - true_positives
+        false_negatives = target_sums - true_positives
+        tversky_index = true_positives / (
+            true_positives
+            + self.alpha * false_positives
+            + self.beta * false_negatives
+            + self.eps
+        )
+        return 1.0 - tversky_index.mean()
+
+
+class DiceLoss(TverskyLoss):
+    def __init__(self, batch_dice=False, eps=1e-7):
+        super().__init__(alpha=0.5, beta=0.5, batch_dice=batch_dice, eps=eps)
+
+
+class DiceMetric:
+    def __init__(self, threshold=0.5):
+        """
+        Accumulates hard Dice scores per class over an epoch. Sums stay on the device of the outputs, so update() never
+        synchronizes; only compute() does.
+        :param threshold: binarization threshold for single-class outputs, multi-class outputs use argmax
+        """
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.dice_sum = None
+        self.count = None
+
+    @torch.no_grad()
+    def update(self, output, target):
+        num_classes = output.shape[1]
+        if num_classes == 1:
+            prediction = (output > self.threshold).to(output.dtype)
+        else:
+            prediction = output.argmax(dim=1)
+            if target.dim() == output.dim() and target.shape[1] == num_classes:
+                target = target.argmax(dim=1)
+        true_positives, prediction_sums, target_sums, _ = get_overlap_statistics(
+            prediction, target, num_classes=num_classes
+        )
+        denominator = prediction_sums + target_sums
+        # Both prediction and target empty is a perfect score
+        dice = torch.where(
+            denominator > 0,
+            2 * true_positives / denominator.clamp(min=1),
+            torch.ones_like(denominator),
+        )
+        if self.dice_sum is None:
+            self.dice_sum = dice.sum(dim=0)
+            self.count = torch.zeros((), dtype=torch.long, device=dice.device)
+        else:
+            self.dice_sum += dice.sum(dim=0)
+        self.count += dice.shape[0]
+
+    def compute(self):
+        """
+        :return: (classes,) tensor of mean Dice scores
+        """
+        if self.dice_sum is None:
+            raise RuntimeError("DiceMetric.compute() called before any update()")
+        return self.dice_sum / self.count
+
+
+def get_overlap_statistics(output, target, num_classes=None):
+    """
+    :param output: (batch, classes, ...) probabilities, or (batch, ...) integer labels if num_classes is given
+    :param target: see TverskyLoss.forward
+    :return: true positives, output sums and target sums of shape (batch, classes), and voxels per sample
+    """
+    output_is_labels = num_classes is not None
+    if not output_is_labels:
+        num_classes = output.shape[1]
+    batch_size = output.shape[0]
+    voxels = output[0].numel() // (1 if output_is_labels else num_classes)
+
+    if num_classes == 1:
+        output = output.reshape(batch_size, 1, -1).float()
+        target = target.reshape(batch_size, 1, -1).to(output.dtype)
+        return (
+            (output * target).sum(dim=2),
+            output.sum(dim=2),
+            target.sum(dim=2),
+            voxels,
+        )
+
+    if (
+        not output_is_labels
+        and target.dim() == output.dim()
+        and target.shape[1] == num_classes
+    ):
+        # One-hot target
+        output = output.reshape(batch_size, num_classes, -1).float()
+        target = target.reshape(batch_size, num_classes, -1).to(output.dtype)
+        return (
+            (output * target).sum(dim=2),
+            output.sum(dim=2),
+            target.sum(dim=2),
+            voxels,
+        )
+
+    # Integer labels: per-class sums are scattered by label, so no one-hot tensor is ever materialized
+    labels = target.reshape(batch_size, -1).long()
+    target_sums = _count_labels(labels, num_classes)
+    if output_is_labels:
+        predicted_labels = output.reshape(batch_size, -1).long()
+        output_sums = _count_labels(predicted_labels, num_classes)
+        true_positive_values = (predicted_labels == labels).float()
+    else:
+        output = output.reshape(batch_size, num_classes, -1).float()
+        output_sums = output.sum(dim=2)
+        true_positive_values = output.gather(1, labels.unsqueeze(1)).squeeze(1)
+    true_positives = torch.zeros_like(target_sums).scatter_add_(
+        1, labels, true_positive_values
+    )
+    return true_positives, output_sums, target_sums, voxels
+
+
+def complement_empty_targets(true_positives, output_sums, target_sums, voxels):
+    """
+    Replaces statistics of pairs with an empty target by those of the complements (1 - output, 1 - target), using
+    tensor ops only, so no device synchronization is needed.
+    """
+    empty = target_sums == 0
+    return (
+        torch.where(
+            empty, voxels - output_sums - target_sums + true_positives, true_positives
+        ),
+        torch.where(empty, voxels - output_sums, output_sums),
+        torch.where(empty, voxels - target_sums, target_sums),
+    )
+
 
-        dice_score = 2 * torch.sum(output * target) / torch.sum(output + target + 1e-7)
-        return 1.0 - dice_score
+def _count_labels(labels, num_classes):
+    counts = torch.zeros(
+        (labels.shape[0], num_classes), dtype=torch.float32, device=labels.device
+    )
+    return counts.scatter_add_(
+        1, labels, torch.ones(labels.shape, dtype=torch.float32, device=labels.device)
+    )
@@ -0,0 +1,130 @@
+import itertools
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import torch
+
+from volseg.metrics.volumetric import compute_case_metrics, summarize
+
+
+class AsyncEvaluator:
+    def __init__(
+        self,
+        num_workers=None,
+        classes=None,
+        spacing=None,
+        threshold=0.5,
+        max_pending_cases=None,
+    ):
+        """
+        Computes volumetric metrics (see volseg.metrics.volumetric) of predicted batches in a pool of worker processes.
+        submit() only reduces outputs to uint8 labels on the calling thread and returns, so metrics of one validation
+        epoch or inference batch are computed while the next one runs. collect() waits for the submitted cases.
+        Workers are spawned rather than forked, which is safe with CUDA and OpenMP thread pools of the parent.
+        :param num_workers: worker processes, defaults to the number of CPUs
+        :param classes: labels the metrics are computed for, defaults to 1 for single-class outputs and every class
+                        except background 0 otherwise
+        :param spacing: voxel size along (depth, height, width) used for surface distances, defaults to 1
+        :param threshold: binarization threshold of single-class outputs, multi-class outputs are reduced by argmax
+        :param max_pending_cases: submit() blocks while this many cases are being evaluated, bounding the memory held
+                                  by queued labels, None for no limit
+        """
+        self.classes = tuple(classes) if classes is not None else None
+        self.spacing = spacing
+        self.threshold = threshold
+        self.max_pending_cases = max_pending_cases
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.futures = []
+        self.case_counter = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, outputs, targets, case_ids=None, spacing=None):
+        """
+        :param outputs: (batch, classes, depth, height, width) probabilities, tensor or array
+        :param targets: (batch, [1,] depth, height, width) labels or binary masks, or one-hot targets of the shape of
+                        outputs
+        :param case_ids: identifiers of the cases, defaults to consecutive integers over all submitted cases
+        :param spacing: voxel size of these cases, overrides the one given to the constructor
+        """
+        num_classes = outputs.shape[1]
+        predictions = to_labels(outputs, self.threshold)
+        labels = to_labels(targets, is_target=True)
+        if predictions.shape != labels.shape:
+            raise ValueError(
+                f"Outputs of shape {tuple(outputs.shape)} do not match targets of shape {tuple(targets.shape)}"
+            )
+        if case_ids is None:
+            case_ids = [next(self.case_counter) for _ in range(len(predictions))]
+        classes = self.classes
+        if classes is None:
+            classes = (1,) if num_classes == 1 else tuple(range(1, num_classes))
+        spacing = spacing if spacing is not None else self.spacing
+        for case_id, prediction, label in zip(case_ids, predictions, labels):
+            self.__wait_for_capacity()
+            self.futures.append(
+                (
+                    case_id,
+                    self.executor.submit(
+                        compute_case_metrics, prediction, label, classes, spacing
+                    ),
+                )
+            )
+
+    def collect(self):
+        """
+        Waits for all cases submitted since the last call.
+        :return: (results, summary): dict of case id -> class -> metric name -> value, in submission order, and the
+                 per-class means over cases, see volseg.metrics.volumetric.summarize
+        """
+        futures, self.futures = self.futures, []
+        try:
+            results = {case_id: future.result() for case_id, future in futures}
+        except Exception as error:
+            raise RuntimeError("Evaluating a case failed") from error
+        return results, summarize(list(results.values()))
+
+    def has_pending(self):
+        return bool(self.futures)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __wait_for_capacity(self):
+        if self.max_pending_cases is None:
+            return
+        running = [future for _, future in self.futures if not future.done()]
+        while len(running) >= self.max_pending_cases:
+            wait(running, return_when=FIRST_COMPLETED)
+            running = [future for future in running if not future.done()]
+
+
+def to_labels(volumes, threshold=0.5, is_target=False):
+    """
+    :param volumes: (batch, classes, depth, height, width) probabilities, or if is_target:
+                    (batch, [1,] depth, height, width) labels or (batch, num_classes, depth, height, width) one-hot masks
+    :return: (batch, ...) uint8 array of labels
+    """
+    if not torch.is_tensor(volumes):
+        volumes = torch.from_numpy(np.asarray(volumes))
+    volumes = volumes.detach()
+    if not is_target:
+        if volumes.shape[1] == 1:
+            labels = volumes[:, 0] > threshold
+        else:
+            labels = volumes.argmax(dim=1)
+    elif volumes.dim() == 5 and volumes.shape[1] > 1:
+        labels = volumes.argmax(dim=1)
+    elif volumes.dim() == 5:
+        labels = volumes[:, 0]
+    else:
+        labels = volumes
+    # Reduced on the device, so only one byte per voxel is copied to the host and sent to the workers
+    return labels.to(torch.uint8).cpu().numpy()
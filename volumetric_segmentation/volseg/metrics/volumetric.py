@@ -0,0 +1,151 @@
+import numpy as np
+from scipy import ndimage
+
+METRICS = (
+    "dice",
+    "iou",
+    "precision",
+    "recall",
+    "average_surface_distance",
+    "hausdorff_95",
+)
+# Faces only, so a voxel belongs to the surface if any of its 6 neighbours is background
+_SURFACE_STRUCTURE = ndimage.generate_binary_structure(3, 1)
+
+
+def compute_case_metrics(prediction, target, classes=(1,), spacing=None):
+    """
+    Per-class metrics of one case. A class absent from both prediction and target scores 1 for the overlap metrics and 0
+    for the distances. If it is absent from only one of them, overlap metrics are 0 and distances are the worst case,
+    the length of the volume's diagonal, so missed and hallucinated classes penalize the means of summarize().
+    :param prediction: (depth, height, width) integer labels, or a binary mask
+    :param target: integer labels or binary mask of the same shape
+    :param classes: labels the metrics are computed for
+    :param spacing: voxel size along (depth, height, width), e.g. in millimeters, defaults to 1 along every axis
+    :return: dict of class -> dict of metric name -> value
+    """
+    if prediction.shape != target.shape:
+        raise ValueError(
+            f"Prediction shape {prediction.shape} does not match target shape {target.shape}"
+        )
+    return {
+        label: compute_mask_metrics(prediction == label, target == label, spacing)
+        for label in classes
+    }
+
+
+def compute_mask_metrics(prediction, target, spacing=None):
+    """
+    :param prediction: boolean (depth, height, width) mask
+    :param target: boolean mask of the same shape
+    :return: dict of metric name -> value, see compute_case_metrics
+    """
+    true_positives = int(np.count_nonzero(prediction & target))
+    predicted = int(np.count_nonzero(prediction))
+    actual = int(np.count_nonzero(target))
+    if predicted == 0 and actual == 0:
+        return {
+            "dice": 1.0,
+            "iou": 1.0,
+            "precision": 1.0,
+            "recall": 1.0,
+            "average_surface_distance": 0.0,
+            "hausdorff_95": 0.0,
+        }
+    metrics = {
+        "dice": 2 * true_positives / (predicted + actual),
+        "iou": true_positives / (predicted + actual - true_positives),
+        "precision": true_positives / predicted if predicted else 0.0,
+        "recall": true_positives / actual if actual else 0.0,
+    }
+    if predicted == 0 or actual == 0:
+        worst_distance = get_diagonal_length(prediction.shape, spacing)
+        metrics["average_surface_distance"] = worst_distance
+        metrics["hausdorff_95"] = worst_distance
+        return metrics
+    prediction_distances, target_distances = get_surface_distances(
+        prediction, target, spacing
+    )
+    metrics["average_surface_distance"] = float(
+        (prediction_distances.sum() + target_distances.sum())
+        / (prediction_distances.size + target_distances.size)
+    )
+    metrics["hausdorff_95"] = float(
+        max(
+            np.percentile(prediction_distances, 95),
+            np.percentile(target_distances, 95),
+        )
+    )
+    return metrics
+
+
+def get_surface_distances(prediction, target, spacing=None):
+    """
+    Distances from every surface voxel of one non-empty mask to the nearest surface voxel of the other, computed with
+    two Euclidean distance transforms. Both are restricted to the bounding box of the two masks: every surface voxel
+    lies inside it, so the distances are exact while the transforms skip the (usually much larger) background.
+    :return: (distances from the prediction surface, distances from the target surface), 1D arrays in units of spacing
+    """
+    crop = _get_bounding_box(prediction | target)
+    prediction_surface = _get_surface(prediction[crop])
+    target_surface = _get_surface(target[crop])
+    sampling = tuple(spacing) if spacing is not None else None
+    # Distance of every voxel to the nearest surface voxel, which are the zeros of the inverted surface
+    distance_to_target = ndimage.distance_transform_edt(
+        ~target_surface, sampling=sampling
+    )
+    distance_to_prediction = ndimage.distance_transform_edt(
+        ~prediction_surface, sampling=sampling
+    )
+    return (
+        distance_to_target[prediction_surface],
+        distance_to_prediction[target_surface],
+    )
+
+
+def get_diagonal_length(shape, spacing=None):
+    """
+    :return: length of the diagonal of a volume of the given shape in units of spacing, an upper bound on any distance
+             between two of its voxels
+    """
+    spacing = spacing if spacing is not None else (1.0,) * len(shape)
+    return float(np.sqrt(sum((size * step) ** 2 for size, step in zip(shape, spacing))))
+
+
+def summarize(results):
+    """
+    :param results: list of per-case dicts as returned by compute_case_metrics
+    :return: dict of class -> dict of metric name -> mean over cases, NaN values are skipped
+    """
+    summary = {}
+    for case_metrics in results:
+        for label, metrics in case_metrics.items():
+            values = summary.setdefault(label, {name: [] for name in METRICS})
+            for name in METRICS:
+                values[name].append(metrics[name])
+    return {
+        label: {name: _nan_mean(class_values) for name, class_values in values.items()}
+        for label, values in summary.items()
+    }
+
+
+def _get_surface(mask):
+    # Voxels on the border of the crop count as surface, as outside of the crop is background
+    return mask & ~ndimage.binary_erosion(
+        mask, structure=_SURFACE_STRUCTURE, border_value=0
+    )
+
+
+def _get_bounding_box(mask):
+    bounds = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(other for other in range(mask.ndim) if other != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other_axes))
+        bounds.append(slice(indices[0], indices[-1] + 1))
+    return tuple(bounds)
+
+
+def _nan_mean(values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if values.size else float("nan")
@@ -0,0 +1,104 @@
+import importlib
+import inspect
+import os
+
+import torch
+
+from volseg.utils.serialization import torch_load
+
+FORMAT_VERSION = 1
+# Architectures are imported on load, so loading a VNet does not import UNet3d and vice versa
+ARCHITECTURES = {
+    "VNet": "volseg.vnet.model",
+    "UNet3d": "volseg.unet_3d.model",
+}
+
+
+def save_artifact(model, path, metadata=None):
+    """
+    Saves a single file holding everything needed to rebuild the model: architecture, constructor config, the output
+    paddings of its transposed convolutions and the weights.
+    :param model: VNet or UNet3d
+    :param metadata: JSON-serializable dict stored alongside, e.g. the normalization used in training
+    """
+    architecture = type(model).__name__
+    if architecture not in ARCHITECTURES:
+        raise ValueError(
+            f"Unknown architecture {architecture}, expected one of {sorted(ARCHITECTURES)}"
+        )
+    artifact = {
+        "format_version": FORMAT_VERSION,
+        "architecture": architecture,
+        "config": model.get_config(),
+        "output_paddings": {
+            name: list(module.output_padding)
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.ConvTranspose3d)
+        },
+        "state_dict": {
+            name: tensor.detach().cpu() for name, tensor in model.state_dict().items()
+        },
+        "metadata": metadata or {},
+    }
+    # Written next to the destination and renamed, so readers never see a partially written file
+    temporary_path = f"{path}.tmp"
+    torch.save(artifact, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_artifact(path, map_location="cpu"):
+    """
+    :return: artifact dict as written by save_artifact
+    """
+    artifact = torch_load(path, map_location=map_location)
+    version = artifact.get("format_version")
+    if version != FORMAT_VERSION:
+        raise RuntimeError(
+            f"Unsupported artifact format version {version} in {path}, expected {FORMAT_VERSION}"
+        )
+    return artifact
+
+
+def load_model(path, map_location="cpu"):
+    """
+    Builds a ready model from a file written by save_artifact in one call, without knowing its configuration.
+    :return: model in eval mode, with the artifact's metadata in model.metadata
+    """
+    artifact = load_artifact(path, map_location)
+    architecture = artifact["architecture"]
+    if architecture not in ARCHITECTURES:
+        raise RuntimeError(
+            f"Unknown architecture {architecture} in {path}, expected one of {sorted(ARCHITECTURES)}"
+        )
+    model_class = getattr(
+        importlib.import_module(ARCHITECTURES[architecture]), architecture
+    )
+    model = _build(model_class, artifact["config"], artifact["state_dict"])
+    modules = dict(model.named_modules())
+    for name, output_padding in artifact["output_paddings"].items():
+        modules[name].output_padding = tuple(output_padding)
+    model.metadata = artifact["metadata"]
+    return model.eval()
+
+
+def _build(model_class, config, state_dict):
+    if _supports_meta_initialization():
+        # Parameters are created without memory or random initialization and then replaced by the stored ones,
+        # which skips initializing weights that would be overwritten anyway
+        with torch.device("meta"):
+            model = model_class(**config)
+        model.load_state_dict(state_dict, assign=True)
+        if not any(
+            tensor.is_meta for tensor in (*model.parameters(), *model.buffers())
+        ):
+            return model
+    model = model_class(**config)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def _supports_meta_initialization():
+    # Device context managers need PyTorch 2.0, assigning loaded tensors 2.1
+    return hasattr(torch.device, "__enter__") and (
+        "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+    )
@@ -0,0 +1,163 @@
+import torch
+
+from volseg.utils.io_utils import print_info_message
+from volseg.utils.memory import get_storage_pointer
+
+
+def estimate_block_activation_bytes(block, voxels, element_size=4):
+    """
+    Estimates the memory a conv block keeps for backward: every Conv3d, BatchNorm3d and activation of the block saves
+    a tensor the size of its input.
+    :param block: torch.nn.Sequential conv block
+    :param voxels: number of voxels of a single sample at the block's level
+    """
+    channels = None
+    total = 0
+    for layer in block.modules():
+        if len(list(layer.children())) > 0:
+            continue
+        if hasattr(layer, "in_channels"):
+            channels = layer.in_channels
+        elif hasattr(layer, "num_features"):
+            channels = layer.num_features
+        total += (channels or 0) * voxels * element_size
+        if hasattr(layer, "out_channels"):
+            channels = layer.out_channels
+    return total
+
+
+def estimate_activation_bytes(model, batch_size=1, element_size=4):
+    """
+    :return: dict of checkpointable block name -> estimated bytes saved for backward
+    """
+    estimates = {}
+    for name, level in model.get_checkpointable_levels().items():
+        dhw = model.image_dimensions.get_dhw()
+        for _ in range(level - 1):
+            dhw = tuple(size // 2 for size in dhw)
+        voxels = dhw[0] * dhw[1] * dhw[2]
+        estimates[name] = batch_size * estimate_block_activation_bytes(
+            model.layers[name], voxels, element_size
+        )
+    return estimates
+
+
+def select_checkpoint_levels(model, memory_budget, batch_size=1):
+    """
+    Greedily checkpoints the blocks with the largest activations until the estimated activation memory of all
+    checkpointable blocks fits the budget.
+    :param memory_budget: bytes of block activations that may be kept for backward
+    :return: list of block names to checkpoint
+    """
+    estimates = estimate_activation_bytes(model, batch_size)
+    total = sum(estimates.values())
+    selected = []
+    for name in sorted(estimates, key=estimates.get, reverse=True):
+        if total <= memory_budget:
+            break
+        selected.append(name)
+        total -= estimates[name]
+    if total > memory_budget:
+        print_info_message(
+            f"Activation memory estimate of {total} bytes exceeds the budget even with all blocks checkpointed"
+        )
+    return selected
+
+
+def measure_activation_memory(model, batch_size=1):
+    """
+    Runs a training-mode forward pass on zeros and measures the memory of all tensors autograd keeps for backward,
+    i.e. the activation memory that checkpointing reduces. Parameters are not counted. This is not the peak memory of
+    a training step, which also holds the outputs and gradients of the block being run, see measure_peak_memory.
+    :return: saved-tensor bytes
+    """
+    parameter_pointers = {get_storage_pointer(p) for p in model.parameters()}
+    storages = {}
+
+    def pack(tensor):
+        pointer = get_storage_pointer(tensor)
+        if pointer not in parameter_pointers:
+            storages[pointer] = max(
+                storages.get(pointer, 0), tensor.numel() * tensor.element_size()
+            )
+        return tensor
+
+    was_training = model.training
+    model.train()
+    device = next(model.parameters()).device
+    inputs = torch.zeros(
+        batch_size, *model.image_dimensions.get(), dtype=torch.float, device=device
+    )
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            output = model(inputs)
+        del output
+    finally:
+        model.train(was_training)
+    return sum(storages.values())
+
+
+def measure_peak_memory(model, batch_size=1):
+    """
+    Runs a training-mode forward and backward pass on zeros and measures the allocator peak above the memory in use
+    before it, which includes the recomputed forwards of checkpointed blocks and the gradients. Existing gradients
+    are restored afterwards.
+    :return: bytes, or None if the model is not on a CUDA device, where no allocator peak is tracked
+    """
+    device = next(model.parameters()).device
+    if device.type != "cuda":
+        return None
+    gradients = [parameter.grad for parameter in model.parameters()]
+    was_training = model.training
+    model.train()
+    inputs = torch.zeros(
+        batch_size, *model.image_dimensions.get(), dtype=torch.float, device=device
+    )
+    try:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_at_start = torch.cuda.memory_allocated(device)
+        model.zero_grad(set_to_none=True)
+        model(inputs).sum().backward()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - memory_at_start
+    finally:
+        model.train(was_training)
+        for parameter, gradient in zip(model.parameters(), gradients):
+            parameter.grad = gradient
+
+
+def compare_activation_memory(model, batch_size=1):
+    """
+    Compares the memory of tensors saved for backward, as measured by measure_activation_memory, with and without the
+    model's checkpoint levels. These saved-tensor bytes are what checkpointing reduces, not the peak memory of a
+    training step. On CUDA, the allocator peak of a forward and backward pass is reported as well.
+    :return: dict with saved-tensor bytes with and without checkpointing, and peak bytes, None if not on CUDA
+    """
+    checkpoint_levels = model.checkpoint_levels
+    model.checkpoint_levels = set()
+    try:
+        saved_without_checkpointing = measure_activation_memory(model, batch_size)
+        peak_without_checkpointing = measure_peak_memory(model, batch_size)
+    finally:
+        model.checkpoint_levels = checkpoint_levels
+    saved_with_checkpointing = measure_activation_memory(model, batch_size)
+    peak_with_checkpointing = measure_peak_memory(model, batch_size)
+    report = {
+        "checkpoint_levels": sorted(checkpoint_levels),
+        "batch_size": batch_size,
+        "saved_bytes_without_checkpointing": saved_without_checkpointing,
+        "saved_bytes_with_checkpointing": saved_with_checkpointing,
+        "peak_bytes_without_checkpointing": peak_without_checkpointing,
+        "peak_bytes_with_checkpointing": peak_with_checkpointing,
+    }
+    print_info_message(
+        f"Saved-tensor memory: {saved_without_checkpointing / 2**20:.1f} MiB without checkpointing, "
+        f"{saved_with_checkpointing / 2**20:.1f} MiB with {report['checkpoint_levels']}"
+    )
+    if peak_without_checkpointing is not None:
+        print_info_message(
+            f"Peak CUDA memory: {peak_without_checkpointing / 2**20:.1f} MiB without checkpointing, "
+            f"{peak_with_checkpointing / 2**20:.1f} MiB with {report['checkpoint_levels']}"
+        )
+    return report
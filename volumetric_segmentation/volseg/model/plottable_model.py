@@ -1,16 +1,54 @@
+import abc
+
 import torch
-from torchviz import make_dot
+import torch.utils.checkpoint
 
+from volseg.model.profiling import LayerProfiler
 from volseg.utils.image_dimension_wrapper import ImageDimensionsWrapper
 from volseg.utils.io_utils import print_info_message
 
 
-class PlottableModel(torch.nn.Module):
+class PlottableModel(torch.nn.Module, abc.ABC):
     def __init__(self, image_dimensions):
         super().__init__()
         self.image_dimensions = ImageDimensionsWrapper(dims=image_dimensions)
+        self.checkpoint_levels = set()
+
+    @abc.abstractmethod
+    def get_config(self):
+        """
+        :return: JSON-serializable constructor arguments that rebuild this architecture, see volseg.model.artifact
+        """
+
+    @abc.abstractmethod
+    def get_checkpointable_levels(self):
+        """
+        :return: dict of conv block name -> resolution level (1 = full resolution, each next one is halved)
+        """
+
+    def set_checkpoint_levels(self, checkpoint_levels):
+        """
+        :param checkpoint_levels: names of conv blocks whose activations are recomputed during backward instead of
+                                  being kept in memory
+        """
+        checkpoint_levels = set(checkpoint_levels)
+        unknown_levels = checkpoint_levels - set(self.get_checkpointable_levels())
+        if unknown_levels:
+            raise ValueError(f"Unknown checkpoint levels: {sorted(unknown_levels)}")
+        self.checkpoint_levels = checkpoint_levels
+
+    def run_layer(self, name, x):
+        layer = self.layers[name]
+        if name in self.checkpoint_levels and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(
+                _RunOnceWithBufferUpdates(layer), x, use_reentrant=False
+            )
+        return layer(x)
 
     def visualize(self):
+        # torchviz and graphviz are only needed here, importing them on first use keeps model imports fast
+        from torchviz import make_dot
+
         print_info_message(
             "In case of \"Not a directory: PosixPath('dot')\" error, install graphviz manually, "
             "e.g. through apt."
@@ -26,3 +64,63 @@ class PlottableModel(torch.nn.Module):
             show_attrs=True,
             show_saved=True,
         )
+
+    def profile(
+        self, batch_size=1, backward=True, warmup=1, repeats=3, trace_path=None
+    ):
+        """
+        Profiles every layer of self.layers on random inputs of the model's image_dimensions and prints a table of
+        per-step time, FLOPs and memory, slowest layers first.
+        :param backward: also run and time backward passes, as in training
+        :param trace_path: where to save a Chrome trace of the profiled steps, None to not save it
+        :return: LayerProfiler holding the results
+        """
+        device = next(self.parameters()).device
+        inputs = torch.rand(batch_size, *self.image_dimensions.get(), device=device)
+        was_training = self.training
+        self.train(backward)
+        try:
+            with torch.set_grad_enabled(backward):
+                for _ in range(warmup):
+                    self.__profiling_step(inputs, backward)
+                with LayerProfiler(self) as profiler:
+                    for _ in range(repeats):
+                        self.__profiling_step(inputs, backward)
+                        profiler.step()
+        finally:
+            self.train(was_training)
+            self.zero_grad(set_to_none=True)
+        print_info_message(f"Layer profile:\n{profiler.format_table()}")
+        if trace_path is not None:
+            profiler.save_chrome_trace(trace_path)
+            print_info_message(f"Chrome trace saved to {trace_path}")
+        return profiler
+
+    def __profiling_step(self, inputs, backward):
+        output = self(inputs)
+        if backward:
+            output.float().mean().backward()
+
+
+class _RunOnceWithBufferUpdates:
+    def __init__(self, layer):
+        """
+        Checkpointed layers run their forward pass again during backward. Buffers, e.g. BatchNorm running statistics
+        and num_batches_tracked, are restored after every call but the first, so each step updates them once.
+        """
+        self.layer = layer
+        self.called = False
+
+    def __call__(self, x):
+        if not self.called:
+            self.called = True
+            return self.layer(x)
+        buffers = list(self.layer.buffers())
+        saved = [buffer.clone() for buffer in buffers]
+        try:
+            return self.layer(x)
+        finally:
+            # Recomputation may stop early by raising once all needed activations are recomputed
+            with torch.no_grad():
+                for buffer, value in zip(buffers, saved):
+                    buffer.copy_(value)
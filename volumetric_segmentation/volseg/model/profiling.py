@@ -0,0 +1,286 @@
+import json
+import time
+
+import numpy as np
+import torch
+
+from volseg.utils.memory import get_peak_rss_bytes, get_storage_pointer
+
+_FLOP_COUNTED_TYPES = (torch.nn.Conv3d, torch.nn.ConvTranspose3d, torch.nn.Linear)
+
+
+class LayerProfiler:
+    def __init__(self, model, layer_names=None):
+        """
+        Records wall time, FLOPs, activation bytes and peak memory of every ModuleDict layer of a PlottableModel, e.g.
+        encoder_level_3 or upsampling_bottom_level. Hooks are attached while the profiler is used as a context manager:
+            with LayerProfiler(model) as profiler:
+                model(inputs).mean().backward()
+                profiler.step()
+            print(profiler.format_table())
+        FLOPs count 2 per multiply-add of convolutions and linear layers, and 1 per output element of every other leaf
+        module. Forward passes recomputed by activation checkpointing during backward are not counted again. Layers whose
+        inputs do not require gradients, like the first one, compute an input gradient anyway while profiled, so that
+        the end of their backward pass can be timed.
+        :param layer_names: names of model.layers to profile, defaults to all of them
+        """
+        self.model = model
+        self.layer_names = (
+            list(layer_names) if layer_names is not None else list(model.layers)
+        )
+        self.records = {name: _LayerRecord() for name in self.layer_names}
+        self.events = []
+        self.steps = 0
+        self.handles = []
+        self.active_layers = []
+        self.forward_starts = {name: [] for name in self.layer_names}
+        self.backward_starts = {name: [] for name in self.layer_names}
+        self.saved_storages = {name: set() for name in self.layer_names}
+        self.origin = None
+        self.parameter_pointers = set()
+        self.saved_tensors_hooks = None
+
+    def __enter__(self):
+        self.origin = time.perf_counter()
+        self.parameter_pointers = {
+            get_storage_pointer(parameter) for parameter in self.model.parameters()
+        }
+        for name in self.layer_names:
+            layer = self.model.layers[name]
+            self.handles += [
+                layer.register_forward_pre_hook(self.__create_forward_pre_hook(name)),
+                layer.register_forward_hook(self.__create_forward_hook(name)),
+                layer.register_full_backward_hook(self.__create_backward_hook(name)),
+            ]
+            for module in layer.modules():
+                if len(list(module.children())) == 0:
+                    self.handles.append(
+                        module.register_forward_hook(self.__create_flop_hook(name))
+                    )
+        self.saved_tensors_hooks = torch.autograd.graph.saved_tensors_hooks(
+            self.__pack, lambda tensor: tensor
+        )
+        self.saved_tensors_hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.saved_tensors_hooks.__exit__(*exc_info)
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def step(self):
+        """
+        Marks the end of a training or inference step, per-step values of the table are averaged over steps.
+        """
+        self.steps += 1
+        for storages in self.saved_storages.values():
+            storages.clear()
+        for starts in self.backward_starts.values():
+            starts.clear()
+
+    def get_results(self):
+        """
+        :return: dict of layer name -> dict of per-step calls, forward/backward seconds, FLOPs, bytes of layer outputs,
+                 bytes saved for backward and peak memory in bytes (allocator peak on CUDA, growth of the process peak
+                 RSS on CPU, which is only non-zero for layers that set a new peak)
+        """
+        steps = max(self.steps, 1)
+        return {
+            name: {
+                "calls": record.calls / steps,
+                "forward_seconds": record.forward_seconds / steps,
+                "backward_seconds": record.backward_seconds / steps,
+                "flops": record.flops / steps,
+                "activation_bytes": record.activation_bytes / steps,
+                "saved_bytes": record.saved_bytes / steps,
+                "peak_memory_bytes": record.peak_memory_bytes,
+            }
+            for name, record in self.records.items()
+        }
+
+    def format_table(self, sort_by="total_seconds"):
+        """
+        :param sort_by: column the layers are sorted by in descending order, or "name" to keep the model order
+        """
+        results = self.get_results()
+        for result in results.values():
+            result["total_seconds"] = (
+                result["forward_seconds"] + result["backward_seconds"]
+            )
+        total_seconds = max(
+            sum(result["total_seconds"] for result in results.values()), 1e-12
+        )
+        names = list(results)
+        if sort_by != "name":
+            names.sort(key=lambda name: results[name][sort_by], reverse=True)
+        width = max(len(name) for name in names + ["layer"])
+        lines = [
+            f"{'layer':<{width}} {'calls':>5} {'fwd ms':>9} {'bwd ms':>9} {'time %':>6} {'GFLOP':>8} "
+            f"{'GFLOP/s':>8} {'act MiB':>8} {'saved MiB':>9} {'peak MiB':>8}"
+        ]
+        for name in names:
+            result = results[name]
+            gflops_per_second = (
+                result["flops"] / result["forward_seconds"] / 1e9
+                if result["forward_seconds"] > 0
+                else 0.0
+            )
+            lines.append(
+                f"{name:<{width}} {result['calls']:>5.0f} {1000 * result['forward_seconds']:>9.2f} "
+                f"{1000 * result['backward_seconds']:>9.2f} "
+                f"{100 * result['total_seconds'] / total_seconds:>6.1f} {result['flops'] / 1e9:>8.3f} "
+                f"{gflops_per_second:>8.2f} {result['activation_bytes'] / 2**20:>8.1f} "
+                f"{result['saved_bytes'] / 2**20:>9.1f} {result['peak_memory_bytes'] / 2**20:>8.1f}"
+            )
+        return "\n".join(lines)
+
+    def save_chrome_trace(self, path):
+        """
+        Saves forward and backward calls of every layer in the Chrome trace event format, viewable in chrome://tracing
+        or https://ui.perfetto.dev. Forward calls are on thread 0, backward calls on thread 1.
+        """
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def __create_forward_pre_hook(self, name):
+        def hook(module, inputs):
+            if _is_backward_running():
+                return
+            self.active_layers.append(name)
+            self.forward_starts[name].append(
+                (time.perf_counter(), _get_memory_in_use())
+            )
+            if torch.is_grad_enabled() and not any(
+                torch.is_tensor(x) and x.requires_grad for x in inputs
+            ):
+                # Full backward hooks only run after the input gradient is computed if some input requires it
+                return tuple(
+                    (
+                        x.detach().requires_grad_()
+                        if torch.is_tensor(x) and x.is_floating_point()
+                        else x
+                    )
+                    for x in inputs
+                )
+
+        return hook
+
+    def __create_forward_hook(self, name):
+        def hook(module, inputs, output):
+            if _is_backward_running():
+                return
+            start, memory_at_start = self.forward_starts[name].pop()
+            end = time.perf_counter()
+            self.active_layers.pop()
+            record = self.records[name]
+            record.calls += 1
+            record.forward_seconds += end - start
+            record.activation_bytes += output.numel() * output.element_size()
+            record.peak_memory_bytes = max(
+                record.peak_memory_bytes, _get_peak_memory(memory_at_start)
+            )
+            self.__add_event(name, "forward", start, end)
+            if output.requires_grad:
+                output.register_hook(self.__create_backward_start_hook(name))
+
+        return hook
+
+    def __create_backward_start_hook(self, name):
+        def hook(grad):
+            self.backward_starts[name].append(time.perf_counter())
+
+        return hook
+
+    def __create_backward_hook(self, name):
+        def hook(module, grad_input, grad_output):
+            if not self.backward_starts[name]:
+                return
+            start = self.backward_starts[name].pop()
+            end = time.perf_counter()
+            self.records[name].backward_seconds += end - start
+            self.__add_event(name, "backward", start, end)
+
+        return hook
+
+    def __create_flop_hook(self, name):
+        def hook(module, inputs, output):
+            if _is_backward_running() or not torch.is_tensor(output):
+                return
+            if isinstance(module, _FLOP_COUNTED_TYPES):
+                flops = 2 * get_multiply_adds(module, inputs, output)
+            else:
+                flops = output.numel()
+            self.records[name].flops += flops
+
+        return hook
+
+    def __pack(self, tensor):
+        if not self.active_layers or _is_backward_running():
+            return tensor
+        name = self.active_layers[-1]
+        pointer = get_storage_pointer(tensor)
+        if (
+            pointer not in self.parameter_pointers
+            and pointer not in self.saved_storages[name]
+        ):
+            self.saved_storages[name].add(pointer)
+            self.records[name].saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def __add_event(self, name, category, start, end):
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": 1e6 * (start - self.origin),
+                "dur": 1e6 * (end - start),
+                "pid": 0,
+                "tid": 0 if category == "forward" else 1,
+            }
+        )
+
+
+class _LayerRecord:
+    def __init__(self):
+        self.calls = 0
+        self.forward_seconds = 0.0
+        self.backward_seconds = 0.0
+        self.flops = 0
+        self.activation_bytes = 0
+        self.saved_bytes = 0
+        self.peak_memory_bytes = 0
+
+
+def get_multiply_adds(module, inputs, output):
+    """
+    :return: multiply-adds of a single call of a Conv3d, ConvTranspose3d or Linear layer
+    """
+    if isinstance(module, torch.nn.Linear):
+        return output.numel() * module.in_features
+    kernel_volume = int(np.prod(module.kernel_size))
+    if isinstance(module, torch.nn.ConvTranspose3d):
+        # Every input voxel is scattered to a kernel-sized block of every output channel
+        return inputs[0].numel() * module.out_channels // module.groups * kernel_volume
+    return output.numel() * module.in_channels // module.groups * kernel_volume
+
+
+def _is_backward_running():
+    # Not available before PyTorch 2.0, where recomputed forwards of checkpointed layers are counted twice
+    get_task_id = getattr(torch._C, "_current_graph_task_id", None)
+    return get_task_id is not None and get_task_id() != -1
+
+
+def _get_memory_in_use():
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated()
+    return get_peak_rss_bytes()
+
+
+def _get_peak_memory(memory_at_start):
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda.max_memory_allocated() - memory_at_start
+    peak = get_peak_rss_bytes()
+    return peak - memory_at_start if peak is not None else 0
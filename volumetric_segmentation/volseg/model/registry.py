@@ -0,0 +1,5 @@
+from volseg.unet_3d.model import UNet3d
+from volseg.vnet.model import VNet
+
+# Model classes by the names command line tools accept
+MODELS = {"vnet": VNet, "unet3d": UNet3d}
@@ -0,0 +1,228 @@
+import json
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from volseg.utils.io_utils import print_info_message
+from volseg.utils.serialization import torch_load
+
+_INDEX_FILE = "checkpoints.json"
+
+
+class CheckpointManager:
+    def __init__(self, directory, keep_best=3, mode="min", max_pending_writes=1):
+        """
+        Keeps the keep_best checkpoints with the best validation metric plus the latest one in a directory. Saving
+        copies the state to CPU memory on the calling thread and serializes it on a background thread, so training
+        only waits for disk I/O when max_pending_writes snapshots are already queued. Files and the index are written
+        next to their destination and renamed, so a killed job never leaves a partially written checkpoint behind.
+        :param keep_best: number of best checkpoints kept besides the latest one
+        :param mode: "min" if lower metrics are better, e.g. a loss, "max" otherwise
+        :param max_pending_writes: snapshots held in memory while waiting to be written, bounds the memory overhead
+        """
+        if mode not in ("min", "max"):
+            raise ValueError(f"mode must be 'min' or 'max', got {mode}")
+        if keep_best < 0:
+            raise ValueError(f"keep_best must not be negative, got {keep_best}")
+        self.directory = directory
+        self.keep_best = keep_best
+        self.mode = mode
+        self.max_pending_writes = max_pending_writes
+        os.makedirs(directory, exist_ok=True)
+        self.index = self.__read_index()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        # Snapshots whose write finished, their tensors are reused to avoid allocating and faulting in fresh memory
+        self.free_snapshots = []
+        # Guards the index and free_snapshots, which the writer thread updates while the training thread uses them
+        self.lock = threading.Lock()
+
+    def save(self, state, epoch, metric=None):
+        """
+        :param state: dict of tensors, state dicts and plain Python values, e.g. as returned by Trainer.get_state()
+        :param metric: validation metric of the epoch, None to only keep the checkpoint as the latest one
+        """
+        self.__raise_write_errors()
+        while len(self.pending) >= self.max_pending_writes:
+            self.pending.pop(0).result()
+        with self.lock:
+            reused = self.free_snapshots.pop() if self.free_snapshots else None
+        snapshot = _copy_to_cpu(state, reused)
+        self.pending.append(
+            self.executor.submit(self.__write_checkpoint, snapshot, epoch, metric)
+        )
+
+    def save_weights(self, state_dict, path):
+        """
+        Writes a copy of the state dict to an arbitrary path on the background thread.
+        """
+        self.__raise_write_errors()
+        snapshot = _copy_to_cpu(state_dict)
+        self.pending.append(self.executor.submit(_atomic_save, snapshot, path))
+
+    def wait(self):
+        """
+        Blocks until all queued checkpoints are written, raising the first error of a background write.
+        """
+        while self.pending:
+            self.pending.pop(0).result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def get_latest_path(self):
+        with self.lock:
+            latest = self.index["latest"]
+        return os.path.join(self.directory, latest["file"]) if latest else None
+
+    def get_best_path(self):
+        with self.lock:
+            best = self.index["best"]
+        return os.path.join(self.directory, best[0]["file"]) if best else None
+
+    def get_checkpoints(self):
+        """
+        :return: index dict with the latest checkpoint and the best ones, best first, each as {file, epoch, metric}
+        """
+        with self.lock:
+            return json.loads(json.dumps(self.index))
+
+    def load_latest(self, map_location="cpu"):
+        """
+        :return: state of the latest written checkpoint, or None if there is none
+        """
+        self.wait()
+        path = self.get_latest_path()
+        return load_checkpoint(path, map_location) if path is not None else None
+
+    def load_best(self, map_location="cpu"):
+        """
+        :return: state of the checkpoint with the best metric, or None if there is none
+        """
+        self.wait()
+        path = self.get_best_path()
+        return load_checkpoint(path, map_location) if path is not None else None
+
+    def __write_checkpoint(self, snapshot, epoch, metric):
+        name = f"epoch_{epoch:04d}.pt"
+        _atomic_save(snapshot, os.path.join(self.directory, name))
+        entry = {"file": name, "epoch": epoch, "metric": metric}
+        with self.lock:
+            self.free_snapshots.append(snapshot)
+            previous_files = self.__get_kept_files()
+            self.index["latest"] = entry
+            best = [item for item in self.index["best"] if item["file"] != name]
+            if metric is not None:
+                best.append(entry)
+                best.sort(key=lambda item: item["metric"], reverse=self.mode == "max")
+            self.index["best"] = best[: self.keep_best]
+            kept_files = self.__get_kept_files()
+            _atomic_write_json(self.index, os.path.join(self.directory, _INDEX_FILE))
+        # Files are only removed once the index no longer references them
+        for removed in previous_files - kept_files:
+            try:
+                os.remove(os.path.join(self.directory, removed))
+            except FileNotFoundError:
+                pass
+
+    def __get_kept_files(self):
+        files = {item["file"] for item in self.index["best"]}
+        if self.index["latest"] is not None:
+            files.add(self.index["latest"]["file"])
+        return files
+
+    def __read_index(self):
+        path = os.path.join(self.directory, _INDEX_FILE)
+        if not os.path.exists(path):
+            return {"latest": None, "best": []}
+        with open(path, "r") as f:
+            index = json.load(f)
+        print_info_message(
+            f"Found checkpoints in {self.directory}, latest: {index['latest']}"
+        )
+        return index
+
+    def __raise_write_errors(self):
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            error = future.exception()
+            if error is not None:
+                raise RuntimeError("Writing a checkpoint failed") from error
+
+
+def load_checkpoint(path, map_location="cpu"):
+    return torch_load(path, map_location=map_location)
+
+
+def get_rng_state():
+    """
+    :return: state of the Python, NumPy and PyTorch random number generators, as plain containers and tensors
+    """
+    numpy_state = np.random.get_state()
+    return {
+        "python": random.getstate(),
+        "numpy": [
+            numpy_state[0],
+            torch.from_numpy(numpy_state[1].astype(np.int64)),
+            *numpy_state[2:],
+        ],
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    version, internal_state, gauss = state["python"]
+    random.setstate((version, tuple(internal_state), gauss))
+    algorithm, keys, *rest = state["numpy"]
+    np.random.set_state((algorithm, keys.numpy().astype(np.uint32), *rest))
+    torch.set_rng_state(state["torch"].cpu())
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state["cuda"]])
+
+
+def _copy_to_cpu(state, reuse=None):
+    """
+    :param reuse: earlier snapshot whose tensors are overwritten where shapes and dtypes match
+    """
+    if torch.is_tensor(state):
+        if (
+            torch.is_tensor(reuse)
+            and reuse.shape == state.shape
+            and reuse.dtype == state.dtype
+        ):
+            return reuse.copy_(state.detach())
+        # Tensors already on CPU are copied too, the live ones keep changing after the snapshot
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        reuse = reuse if isinstance(reuse, dict) else {}
+        return {
+            key: _copy_to_cpu(value, reuse.get(key)) for key, value in state.items()
+        }
+    if isinstance(state, (list, tuple)):
+        reuse = reuse if isinstance(reuse, (list, tuple)) else ()
+        return type(state)(
+            _copy_to_cpu(value, reuse[i] if i < len(reuse) else None)
+            for i, value in enumerate(state)
+        )
+    return state
+
+
+def _atomic_save(state, path):
+    temporary_path = f"{path}.tmp"
+    torch.save(state, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def _atomic_write_json(data, path):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary_path, path)
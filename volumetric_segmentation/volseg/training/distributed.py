@@ -0,0 +1,201 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+from volseg.utils.devices import get_module_device
+from volseg.utils.io_utils import print_info_message
+
+
+def init_distributed(backend="gloo", threads_per_process=None):
+    """
+    Joins the process group set up by torchrun, e.g.
+        torchrun --nproc_per_node=4 train.py
+        torchrun --nnodes=2 --nproc_per_node=4 --rdzv_backend=c10d --rdzv_endpoint=host:29500 train.py
+    Without torchrun the process trains alone and nothing is initialized.
+    :param backend: "gloo" for CPU training, "nccl" for GPUs
+    :param threads_per_process: intra-op threads of each process, defaults to the host's cores divided by the number
+                                of processes on the host, so processes do not oversubscribe the CPU
+    :return: True if running distributed
+    """
+    if "WORLD_SIZE" not in os.environ or int(os.environ["WORLD_SIZE"]) == 1:
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    if threads_per_process is None:
+        local_world_size = int(
+            os.environ.get("LOCAL_WORLD_SIZE", dist.get_world_size())
+        )
+        threads_per_process = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads_per_process)
+    if is_main_process():
+        print_info_message(
+            f"Training on {dist.get_world_size()} processes with {threads_per_process} threads each"
+        )
+    return True
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    """
+    Sums the tensor over all processes, in place. A no-op when not running distributed.
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def wrap_model(model, sync_batch_norm=True):
+    """
+    :param sync_batch_norm: replace BatchNorm3d layers with SyncBatchNorm3d, so statistics cover the global batch
+    :return: model wrapped in DistributedDataParallel, or the model itself when not running distributed
+    """
+    if not is_distributed():
+        return model
+    if sync_batch_norm:
+        model = SyncBatchNorm3d.convert(model)
+    device = get_module_device(model)
+    device_ids = [device.index] if device.type == "cuda" else None
+    return torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+
+
+def unwrap_model(model):
+    return (
+        model.module
+        if isinstance(model, torch.nn.parallel.DistributedDataParallel)
+        else model
+    )
+
+
+def create_sampler(dataset, shuffle=True, seed=0):
+    """
+    :return: DistributedSampler giving every process its own shard of the dataset, or None when not running
+             distributed. Trainer calls its set_epoch() so shards are reshuffled every epoch
+    """
+    if not is_distributed():
+        return None
+    return torch.utils.data.distributed.DistributedSampler(
+        dataset, shuffle=shuffle, seed=seed
+    )
+
+
+class SyncBatchNorm3d(torch.nn.BatchNorm3d):
+    """
+    BatchNorm3d whose training statistics are computed over the batches of all processes. Unlike
+    torch.nn.SyncBatchNorm it works with the gloo backend on CPU.
+    """
+
+    def forward(self, x):
+        if not self.training or not is_distributed():
+            return super().forward(x)
+        y, mean, variance, count = _SyncBatchNormFunction.apply(
+            x, self.weight, self.bias, self.eps
+        )
+        if self.track_running_stats:
+            self.__update_running_stats(mean, variance, count)
+        return y
+
+    @torch.no_grad()
+    def __update_running_stats(self, mean, variance, count):
+        self.num_batches_tracked += 1
+        momentum = (
+            1.0 / float(self.num_batches_tracked)
+            if self.momentum is None
+            else self.momentum
+        )
+        unbiased_variance = variance * count / (count - 1).clamp(min=1)
+        self.running_mean.lerp_(mean.to(self.running_mean.dtype), momentum)
+        self.running_var.lerp_(unbiased_variance.to(self.running_var.dtype), momentum)
+
+    @classmethod
+    def convert(cls, module):
+        """
+        :return: the module with all BatchNorm3d layers replaced by SyncBatchNorm3d layers sharing their state
+        """
+        if isinstance(module, torch.nn.BatchNorm3d) and not isinstance(module, cls):
+            converted = cls(
+                module.num_features,
+                module.eps,
+                module.momentum,
+                module.affine,
+                module.track_running_stats,
+            ).to(get_module_device(module))
+            converted.load_state_dict(module.state_dict())
+            converted.train(module.training)
+            return converted
+        for name, child in module.named_children():
+            module.add_module(name, cls.convert(child))
+        return module
+
+
+class _SyncBatchNormFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, bias, eps):
+        dims = [0] + list(range(2, x.dim()))
+        local_count = x.numel() // x.shape[1]
+        statistics = torch.cat(
+            [
+                x.sum(dims, dtype=torch.float),
+                (x.float() * x.float()).sum(dims),
+                torch.tensor([local_count], dtype=torch.float, device=x.device),
+            ]
+        )
+        all_reduce_sum(statistics)
+        channels = x.shape[1]
+        count = statistics[-1]
+        mean = statistics[:channels] / count
+        variance = (statistics[channels : 2 * channels] / count - mean**2).clamp(min=0)
+        inverse_std = torch.rsqrt(variance + eps)
+
+        shape = (1, channels) + (1,) * (x.dim() - 2)
+        x_hat = (x.float() - mean.view(shape)) * inverse_std.view(shape)
+        y = x_hat
+        if weight is not None:
+            y = y * weight.view(shape) + bias.view(shape)
+        ctx.input_dtype = x.dtype
+        ctx.save_for_backward(x_hat, inverse_std, weight, count)
+        ctx.mark_non_differentiable(mean, variance, count)
+        return y.to(x.dtype), mean, variance, count
+
+    @staticmethod
+    def backward(ctx, grad_y, *_):
+        x_hat, inverse_std, weight, count = ctx.saved_tensors
+        dims = [0] + list(range(2, grad_y.dim()))
+        channels = grad_y.shape[1]
+        shape = (1, channels) + (1,) * (grad_y.dim() - 2)
+        grad_y = grad_y.float()
+        sum_grad = grad_y.sum(dims)
+        sum_grad_x_hat = (grad_y * x_hat).sum(dims)
+        # Parameter gradients stay local, DistributedDataParallel averages them over the processes
+        grad_weight = sum_grad_x_hat.clone() if weight is not None else None
+        grad_bias = sum_grad.clone() if weight is not None else None
+
+        global_sums = all_reduce_sum(torch.cat([sum_grad, sum_grad_x_hat]))
+        mean_grad = (global_sums[:channels] / count).view(shape)
+        mean_grad_x_hat = (global_sums[channels:] / count).view(shape)
+        scale = inverse_std.view(shape)
+        if weight is not None:
+            scale = scale * weight.view(shape)
+        grad_x = scale * (grad_y - mean_grad - x_hat * mean_grad_x_hat)
+        return grad_x.to(ctx.input_dtype), grad_weight, grad_bias, None
@@ -0,0 +1,343 @@
+import contextlib
+
+import torch
+import tqdm
+
+from volseg.training.checkpoint import get_rng_state, set_rng_state
+from volseg.training.distributed import all_reduce_sum, is_main_process, unwrap_model
+from volseg.utils.io_utils import print_info_message
+
+
+class Trainer:
+    def __init__(
+        self,
+        model,
+        criterion,
+        optimizer,
+        device=None,
+        scheduler=None,
+        autocast_dtype=None,
+        channels_last=False,
+        gradient_accumulation_steps=1,
+        terminate_after_no_improvement_epochs=None,
+        input_transform=None,
+        batch_transform=None,
+        best_weights_path=None,
+        checkpoint_manager=None,
+        evaluator=None,
+    ):
+        """
+        Training loop for VNet and UNet3d. Losses are accumulated on the device and read once per epoch, so steps
+        never wait for the device to synchronize. Works with models wrapped by volseg.training.distributed.wrap_model:
+        losses are then averaged over all processes, gradients are only synchronized on optimizer steps and only the
+        main process logs and saves weights.
+        :param device: defaults to the device of the model parameters
+        :param scheduler: learning rate scheduler stepped once per epoch
+        :param autocast_dtype: e.g. torch.bfloat16 to run forward passes in mixed precision, None to disable it
+        :param channels_last: use the channels_last_3d memory format for the model and its inputs
+        :param gradient_accumulation_steps: number of batches whose gradients are summed before an optimizer step
+        :param terminate_after_no_improvement_epochs: stop once the validation loss has not improved for this many
+                                                      epochs, None to always train for all epochs
+        :param input_transform: callable applied to every input batch after moving it to the device
+        :param batch_transform: callable mapping (inputs, labels) to augmented (inputs, labels), applied to training
+                                batches after input_transform, e.g. volseg.augment.transforms.AugmentationPipeline
+        :param best_weights_path: where to save the weights with the lowest validation loss, None to not save them
+        :param checkpoint_manager: volseg.training.checkpoint.CheckpointManager receiving the full training state after
+                                   every epoch, ranked by validation loss. Weights saved to best_weights_path are then
+                                   written on its background thread too. Call resume() to continue from its latest
+                                   checkpoint
+        :param evaluator: volseg.metrics.evaluator.AsyncEvaluator receiving validation outputs. Its metrics are
+                          computed while the next epoch trains and are logged and added to metrics_history after it.
+                          With distributed training, every process evaluates its own shard of the validation set
+        """
+        if gradient_accumulation_steps < 1:
+            raise ValueError(
+                f"gradient_accumulation_steps must be positive, got {gradient_accumulation_steps}"
+            )
+        self.device = (
+            torch.device(device)
+            if device is not None
+            else next(model.parameters()).device
+        )
+        self.memory_format = (
+            torch.channels_last_3d if channels_last else torch.contiguous_format
+        )
+        self.model = model.to(self.device, memory_format=self.memory_format)
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.autocast_dtype = autocast_dtype
+        # Loss scaling is only needed for float16, bfloat16 has the exponent range of float32
+        self.grad_scaler = (
+            _create_grad_scaler()
+            if autocast_dtype == torch.float16 and self.device.type == "cuda"
+            else None
+        )
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.terminate_after_no_improvement_epochs = (
+            terminate_after_no_improvement_epochs
+        )
+        self.input_transform = input_transform
+        self.batch_transform = batch_transform
+        self.best_weights_path = best_weights_path
+        self.checkpoint_manager = checkpoint_manager
+        self.evaluator = evaluator
+
+        self.epoch = 0
+        self.training_history = []
+        self.validation_history = []
+        self.metrics_history = []
+        self.evaluated_epoch = None
+        self.best_loss = float("inf")
+        self.best_epoch = None
+        self.best_state_dict = None
+
+    def fit(self, train_loader, val_loader=None, epochs=10):
+        """
+        :param epochs: total number of epochs, including those completed before resume()
+        :return: (training_history, validation_history) lists of per-epoch mean losses
+        """
+        for epoch in range(self.epoch + 1, epochs + 1):
+            self.__log(f"Epoch {epoch}")
+            for loader in (train_loader, val_loader):
+                _set_sampler_epoch(loader, epoch)
+            training_loss = self.train_epoch(train_loader)
+            self.training_history.append(training_loss)
+            self.__log(f"Training loss: {training_loss:.3f}")
+            if self.scheduler is not None:
+                self.scheduler.step()
+            # Metrics of the previous validation were computed while this epoch trained
+            self.__collect_metrics()
+
+            validation_loss = None
+            stop = False
+            if val_loader is not None:
+                validation_loss = self.validate(val_loader)
+                self.validation_history.append(validation_loss)
+                self.__log(f"Validation loss: {validation_loss:.3f}")
+                if self.evaluator is not None:
+                    self.evaluated_epoch = epoch
+                stop = self.__update_best(epoch, validation_loss)
+            self.epoch = epoch
+            self.__save_checkpoint(validation_loss)
+            if stop:
+                self.__log(f"Stopping training after {epoch} epochs")
+                break
+        self.__collect_metrics()
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.wait()
+        return self.training_history, self.validation_history
+
+    def get_state(self):
+        """
+        :return: everything needed to continue training exactly where it stopped: weights, optimizer, scheduler and
+                 loss scaler state, histories, early stopping state and random number generator states
+        """
+        return {
+            "epoch": self.epoch,
+            "model": unwrap_model(self.model).state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": (
+                self.scheduler.state_dict() if self.scheduler is not None else None
+            ),
+            "grad_scaler": (
+                self.grad_scaler.state_dict() if self.grad_scaler is not None else None
+            ),
+            "training_history": list(self.training_history),
+            "validation_history": list(self.validation_history),
+            "metrics_history": list(self.metrics_history),
+            "best_loss": self.best_loss,
+            "best_epoch": self.best_epoch,
+            "rng": get_rng_state(),
+        }
+
+    def load_state(self, state):
+        unwrap_model(self.model).load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if self.scheduler is not None and state["scheduler"] is not None:
+            self.scheduler.load_state_dict(state["scheduler"])
+        if self.grad_scaler is not None and state["grad_scaler"] is not None:
+            self.grad_scaler.load_state_dict(state["grad_scaler"])
+        self.epoch = state["epoch"]
+        self.training_history = list(state["training_history"])
+        self.validation_history = list(state["validation_history"])
+        self.metrics_history = list(state.get("metrics_history", []))
+        self.best_loss = state["best_loss"]
+        self.best_epoch = state["best_epoch"]
+        set_rng_state(state["rng"])
+
+    def resume(self):
+        """
+        Restores the latest checkpoint of the checkpoint manager, the next fit() continues with the following epoch.
+        :return: True if a checkpoint was restored
+        """
+        if self.checkpoint_manager is None:
+            raise RuntimeError("resume() requires a checkpoint_manager")
+        state = self.checkpoint_manager.load_latest(map_location=self.device)
+        if state is None:
+            return False
+        self.load_state(state)
+        best_state = self.checkpoint_manager.load_best(map_location=self.device)
+        if best_state is not None:
+            self.best_state_dict = best_state["model"]
+        self.__log(f"Resumed training after epoch {self.epoch}")
+        return True
+
+    def train_epoch(self, loader):
+        self.model.train()
+        totals = torch.zeros(2, device=self.device)
+        self.optimizer.zero_grad(set_to_none=True)
+        num_batches = len(loader)
+        # Batches after this one form a shorter accumulation group, whose losses are averaged over its actual size
+        last_full_group_end = (
+            num_batches - num_batches % self.gradient_accumulation_steps
+        )
+        for batch_number, data in enumerate(
+            tqdm.tqdm(loader, disable=not is_main_process()), start=1
+        ):
+            inputs, labels = self.__prepare_batch(data, augment=True)
+            is_step = (
+                batch_number % self.gradient_accumulation_steps == 0
+                or batch_number == num_batches
+            )
+            group_size = (
+                self.gradient_accumulation_steps
+                if batch_number <= last_full_group_end
+                else num_batches - last_full_group_end
+            )
+            with self.__gradient_sync(is_step):
+                with self.__autocast():
+                    outputs = self.model(inputs)
+                    loss = self.criterion(outputs, labels)
+                scaled_loss = loss / group_size
+                if self.grad_scaler is not None:
+                    scaled_loss = self.grad_scaler.scale(scaled_loss)
+                scaled_loss.backward()
+            if is_step:
+                self.__optimizer_step()
+
+            totals[0] += loss.detach() * inputs.shape[0]
+            totals[1] += inputs.shape[0]
+        return self.__mean_loss(totals)
+
+    def validate(self, loader):
+        self.model.eval()
+        totals = torch.zeros(2, device=self.device)
+        with torch.no_grad():
+            for data in tqdm.tqdm(loader, disable=not is_main_process()):
+                inputs, labels = self.__prepare_batch(data)
+                with self.__autocast():
+                    outputs = self.model(inputs)
+                    loss = self.criterion(outputs, labels)
+                if self.evaluator is not None:
+                    self.evaluator.submit(outputs, labels)
+                totals[0] += loss.detach() * inputs.shape[0]
+                totals[1] += inputs.shape[0]
+        return self.__mean_loss(totals)
+
+    def __collect_metrics(self):
+        if self.evaluator is None or self.evaluated_epoch is None:
+            return
+        _, summary = self.evaluator.collect()
+        self.metrics_history.append((self.evaluated_epoch, summary))
+        for label, metrics in summary.items():
+            self.__log(
+                f"Epoch {self.evaluated_epoch} class {label}: "
+                + ", ".join(f"{name} {value:.3f}" for name, value in metrics.items())
+            )
+        self.evaluated_epoch = None
+
+    @staticmethod
+    def __mean_loss(totals):
+        # Sums over all processes, so every process sees the same loss and makes the same early stopping decision
+        total_loss, total_samples = all_reduce_sum(totals).tolist()
+        return total_loss / max(total_samples, 1)
+
+    def __save_checkpoint(self, validation_loss):
+        if self.checkpoint_manager is not None and is_main_process():
+            self.checkpoint_manager.save(
+                self.get_state(), self.epoch, metric=validation_loss
+            )
+
+    def __gradient_sync(self, is_step):
+        # DistributedDataParallel all-reduces gradients on every backward unless told not to
+        if is_step or not hasattr(self.model, "no_sync"):
+            return contextlib.nullcontext()
+        return self.model.no_sync()
+
+    @staticmethod
+    def __log(message):
+        if is_main_process():
+            print_info_message(message)
+
+    def __prepare_batch(self, data, augment=False):
+        inputs, labels = data[0], data[1]
+        non_blocking = self.device.type == "cuda"
+        inputs = inputs.to(self.device, non_blocking=non_blocking)
+        labels = labels.to(self.device, non_blocking=non_blocking)
+        if self.input_transform is not None:
+            inputs = self.input_transform(inputs)
+        inputs = inputs.float()
+        if augment and self.batch_transform is not None:
+            inputs, labels = self.batch_transform(inputs, labels)
+        inputs = inputs.contiguous(memory_format=self.memory_format)
+        return inputs, labels
+
+    def __autocast(self):
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype)
+
+    def __optimizer_step(self):
+        if self.grad_scaler is not None:
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+        else:
+            self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def __update_best(self, epoch, validation_loss):
+        """
+        :return: True if training should stop
+        """
+        if validation_loss < self.best_loss:
+            self.best_epoch = epoch
+            self.best_loss = validation_loss
+            # state_dict() returns references to the live tensors, which the next optimizer step would overwrite
+            self.best_state_dict = {
+                key: value.detach().clone()
+                for key, value in unwrap_model(self.model).state_dict().items()
+            }
+            if self.best_weights_path is not None and is_main_process():
+                if self.checkpoint_manager is not None:
+                    self.checkpoint_manager.save_weights(
+                        self.best_state_dict, self.best_weights_path
+                    )
+                else:
+                    torch.save(self.best_state_dict, self.best_weights_path)
+            return False
+        if self.terminate_after_no_improvement_epochs is None:
+            return False
+        # Without any finite validation loss so far, e.g. NaN from the first epoch on, epochs count from the start
+        last_improvement = self.best_epoch if self.best_epoch is not None else 0
+        epochs_without_improvement = epoch - last_improvement
+        return epochs_without_improvement >= self.terminate_after_no_improvement_epochs
+
+
+def _create_grad_scaler():
+    # torch.cuda.amp.GradScaler is deprecated in favor of the device-generic torch.amp.GradScaler since PyTorch 2.3
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda")
+    return torch.cuda.amp.GradScaler()
+
+
+def _set_sampler_epoch(loader, epoch):
+    """
+    Reshuffles the shards of distributed samplers, which otherwise repeat the same order every epoch.
+    """
+    for sampler in (
+        getattr(loader, "sampler", None),
+        getattr(loader, "batch_sampler", None),
+    ):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
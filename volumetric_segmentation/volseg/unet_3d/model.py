@@ -1,15 +1,31 @@
 import torch
+import torch.fx
 
+from volseg.model.checkpointing import select_checkpoint_levels
 from volseg.model.plottable_model import PlottableModel
 from volseg.unet_3d.parts import UNet3dParts
-from volseg.utils.padding import calculate_required_paddings
+from volseg.utils.padding import calculate_required_paddings, match_spatial_size
+
+# Keeps the shape-dependent size matching a single opaque call when the model is symbolically traced
+torch.fx.wrap("match_spatial_size")
 
 
 class UNet3d(PlottableModel):
-    def __init__(self, num_classes, image_dimensions=(3, 116, 132, 132)):
+    def __init__(
+        self,
+        num_classes,
+        image_dimensions=(3, 116, 132, 132),
+        checkpoint_levels=None,
+        activation_memory_budget=None,
+    ):
         """
-        :param image_dimensions: (channels, depth, height, width) or ImageDimensionsWrapper
+        :param image_dimensions: (channels, depth, height, width) or ImageDimensionsWrapper. Inputs of other sizes are
+                                 accepted too, as long as each spatial dimension is at least 8
         :param num_classes: number of classes to segment (e.g. liver, pancreas, lung...)
+        :param checkpoint_levels: names of conv blocks (see get_checkpointable_levels) whose activations are recomputed
+                                  during backward instead of being stored
+        :param activation_memory_budget: if given, checkpoint_levels are chosen automatically so that the estimated
+                                         conv block activations of a single sample fit in this many bytes
         """
 
         super().__init__(image_dimensions=image_dimensions)
@@ -21,13 +37,29 @@ class UNet3d(PlottableModel):
         self.layers = UNet3dParts.build_layers(
             self.image_dimensions.channels, num_classes, conv3d_transpose_paddings
         )
+        if activation_memory_budget is not None:
+            checkpoint_levels = select_checkpoint_levels(self, activation_memory_budget)
+        self.set_checkpoint_levels(checkpoint_levels or ())
+
+    def get_config(self):
+        return {
+            "num_classes": self.num_classes,
+            "image_dimensions": list(self.image_dimensions.get()),
+        }
+
+    def get_checkpointable_levels(self):
+        return {
+            **{f"encoder_level_{level}": level for level in range(1, 4)},
+            "not_bottleneck": 4,
+            **{f"decoder_level_{level}": level for level in range(1, 4)},
+        }
 
     def forward(self, x):
         encoder_outputs = self.__encode(x)
 
-        not_bottleneck_output = self.layers["not_bottleneck"](encoder_outputs[-1])
-        not_bottleneck_upsampled = self.layers["upsampling_level_4"](
-            not_bottleneck_output
+        not_bottleneck_output = self.run_layer("not_bottleneck", encoder_outputs[-1])
+        not_bottleneck_upsampled = self.__upsample(
+            "upsampling_level_4", not_bottleneck_output, encoder_outputs[2]
         )
 
         decoder_output = self.__decode(encoder_outputs, not_bottleneck_upsampled)
@@ -38,7 +70,10 @@ class UNet3d(PlottableModel):
         prev_level_upsampled = not_bottleneck_upsampled
         for level in range(3, 0, -1):
             decoder_level_output = self.__decode_single(
-                encoder_outputs[level - 1], prev_level_upsampled, level
+                encoder_outputs[level - 1],
+                prev_level_upsampled,
+                level,
+                encoder_outputs[level - 2] if level > 1 else None,
             )
             prev_level_upsampled = decoder_level_output
         # noinspection PyUnboundLocalVariable
@@ -48,7 +83,7 @@ class UNet3d(PlottableModel):
         input = x
         outputs = []
         for level in range(1, 4):
-            encoder_level_output = self.layers[f"encoder_level_{level}"](input)
+            encoder_level_output = self.run_layer(f"encoder_level_{level}", input)
             outputs.append(encoder_level_output)
             encoder_level_pooled = self.layers["max_pool"](encoder_level_output)
             input = encoder_level_pooled
@@ -57,17 +92,27 @@ class UNet3d(PlottableModel):
         return outputs
 
     def __decode_single(
-        self, encoder_level_n_output, decoder_level_n_minus_one_upsampled, level
+        self,
+        encoder_level_n_output,
+        decoder_level_n_minus_one_upsampled,
+        level,
+        encoder_level_n_minus_one_output,
     ):
         decoder_level_n_input = torch.concat(
             (encoder_level_n_output, decoder_level_n_minus_one_upsampled), axis=1
         )
-        decoder_level_n_output = self.layers[f"decoder_level_{level}"](
-            decoder_level_n_input
+        decoder_level_n_output = self.run_layer(
+            f"decoder_level_{level}", decoder_level_n_input
         )
         if level > 1:
-            decoder_level_n_upsampled = self.layers[f"upsampling_level_{level}"](
-                decoder_level_n_output
+            decoder_level_n_upsampled = self.__upsample(
+                f"upsampling_level_{level}",
+                decoder_level_n_output,
+                encoder_level_n_minus_one_output,
             )
             return decoder_level_n_upsampled
         return decoder_level_n_output
+
+    def __upsample(self, name, x, encoder_output):
+        layer = self.layers[name]
+        return match_spatial_size(layer(x), encoder_output, layer.bias)
@@ -0,0 +1,10 @@
+import torch
+
+
+def get_module_device(module):
+    """
+    :return: device of the module's first parameter, CPU for modules without parameters, e.g. frozen TorchScript
+             modules or parameter-free layers
+    """
+    parameter = next(module.parameters(), None)
+    return parameter.device if parameter is not None else torch.device("cpu")
@@ -15,3 +15,12 @@ class ImageDimensionsWrapper:
 
     def get_dhw(self):
         return self.depth, self.height, self.width
+
+
+def parse_dimensions(value):
+    """
+    Parses dimensions given on the command line.
+    :param value: sizes separated by "x", e.g. "1x32x64x64" for channels x depth x height x width
+    :return: tuple of ints
+    """
+    return tuple(int(size) for size in value.split("x"))
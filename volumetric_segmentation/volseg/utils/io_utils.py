@@ -1,6 +1,18 @@
+import hashlib
+import json
+
 INFO_COLOR = "\033[92m"
 ENDC = "\033[0m"
 
 
 def print_info_message(message):
     print(f"{INFO_COLOR}INFO: {message}{ENDC}")
+
+
+def hash_parameters(parameters):
+    """
+    :param parameters: JSON-serializable dict
+    :return: short hex digest that changes whenever any of the parameters does
+    """
+    encoded = json.dumps(parameters, sort_keys=True).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
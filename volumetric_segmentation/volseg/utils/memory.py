@@ -0,0 +1,28 @@
+import sys
+
+
+def get_storage_pointer(tensor):
+    """
+    :return: address of the storage behind tensor, shared by all views of the same memory
+    """
+    if hasattr(tensor, "untyped_storage"):
+        return tensor.untyped_storage().data_ptr()
+    return tensor.storage().data_ptr()
+
+
+def get_peak_rss_bytes():
+    """
+    :return: peak resident set size of the current process in bytes, None if it cannot be measured on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        # resource is POSIX-only, psutil, if installed, reports the peak working set on Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
@@ -1,5 +1,10 @@
+import functools
 from collections import defaultdict
 
+import numpy as np
+import torch
+import torch.nn.functional as F
+
 
 def calculate_required_paddings(im_depth, im_height, im_width, num_levels):
     """
@@ -23,3 +28,78 @@ def calculate_required_paddings(im_depth, im_height, im_width, num_levels):
         depth, height, width = depth // 2, height // 2, width // 2
 
     return res
+
+
+def match_spatial_size(x, reference, bias=None):
+    """
+    Crops or pads the spatial dimensions of an upsampled tensor to those of the encoder output it is concatenated with,
+    so models accept inputs of other sizes than the ones their ConvTranspose3d output paddings were computed for.
+    :param bias: bias of the ConvTranspose3d that produced x. Voxels added by output padding only receive the bias,
+                 so padding with it gives exactly the output of a layer built for the reference size
+    """
+    target = reference.shape[2:]
+    if x.shape[2:] == target:
+        return x
+    x = x[..., : target[0], : target[1], : target[2]]
+    if bias is None or x.shape[2:] == target:
+        return pad_to_shape(x, target)
+    bias = bias.view(1, -1, 1, 1, 1)
+    return pad_to_shape(x - bias, target) + bias
+
+
+def pad_to_shape(x, spatial_shape):
+    """
+    Zero-pads the last three axes of x at their end to spatial_shape. Axes at least that large are left as they are.
+    :return: x itself if nothing needs padding
+    """
+    # F.pad lists padding starting from the last axis
+    padding = []
+    for size, target in reversed(list(zip(x.shape[-3:], spatial_shape))):
+        padding += [0, max(target - size, 0)]
+    if not any(padding):
+        return x
+    return F.pad(x, padding)
+
+
+def pad_stack(tensors, spatial_shape):
+    """
+    :param tensors: tensors whose last three axes are spatial with sizes not exceeding spatial_shape, leading axes
+                    (e.g. channels) must match
+    :return: tensor of shape (len(tensors), *leading_axes, *spatial_shape) with each input centered in its slot
+    """
+    dtype = functools.reduce(torch.promote_types, [tensor.dtype for tensor in tensors])
+    output = _zeros((len(tensors), *tensors[0].shape[:-3], *spatial_shape), dtype)
+    for sample, tensor in zip(output, tensors):
+        region = tuple(
+            slice((target - size) // 2, (target - size) // 2 + size)
+            for size, target in zip(tensor.shape[-3:], spatial_shape)
+        )
+        sample[(Ellipsis,) + region] = tensor
+    return output
+
+
+def stack_arrays(arrays):
+    """
+    Stacks numpy arrays of equal shape into one tensor with a single copy. Unlike torch.as_tensor, this also accepts
+    read-only arrays without a warning, as they are only read.
+    """
+    dtype = torch.from_numpy(np.empty(0, dtype=np.result_type(*arrays))).dtype
+    output = _zeros((len(arrays), *arrays[0].shape), dtype)
+    target = output.numpy()
+    for index, array in enumerate(arrays):
+        target[index] = array
+    return output
+
+
+def _zeros(shape, dtype):
+    if torch.utils.data.get_worker_info() is None:
+        return torch.zeros(shape, dtype=dtype)
+    # Inside DataLoader workers the batch is allocated in shared memory, like default_collate does, so sending it to
+    # the main process does not copy it again
+    element = torch.empty(0, dtype=dtype)
+    storage = (
+        element._typed_storage()
+        if hasattr(element, "_typed_storage")
+        else element.storage()
+    )._new_shared(int(np.prod(shape)))
+    return element.new(storage).resize_(shape).zero_()
@@ -0,0 +1,124 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+IMAGE_MODES = ("trilinear", "area", "nearest")
+LABEL_MODES = ("linear", "nearest")
+
+
+def resize_images(images, shape_dhw, mode="trilinear"):
+    """
+    Resizes a batch of volumes with a single F.interpolate call, which runs on all intra-op threads. Integer volumes,
+    e.g. uint8 intensities, are interpolated in float32 and rounded back to their dtype, floating point volumes keep
+    theirs, so the output is as compact as the input.
+    :param images: (batch, channels, depth, height, width) tensor or array
+    :param mode: "trilinear", "area" (averages, better when shrinking a lot) or "nearest"
+    :return: (batch, channels, *shape_dhw) tensor or array, like images
+    """
+    if mode not in IMAGE_MODES:
+        raise ValueError(f"mode must be one of {IMAGE_MODES}, got {mode}")
+    tensor, is_array = _to_tensor(images)
+    dtype = tensor.dtype
+    interpolated = _interpolate(tensor.float(), shape_dhw, mode)
+    if dtype.is_floating_point:
+        resized = interpolated.to(dtype)
+    else:
+        limits = torch.iinfo(dtype)
+        resized = interpolated.round_().clamp_(limits.min, limits.max).to(dtype)
+    return resized.numpy() if is_array else resized
+
+
+def resize_labels(labels, shape_dhw, mode="linear"):
+    """
+    Resizes a batch of label volumes. Only labels present in the input appear in the output.
+    :param labels: (batch, depth, height, width) integer or boolean tensor or array
+    :param mode: "linear" interpolates the indicator of every label trilinearly and keeps the most likely one per
+                 voxel, which gives smooth boundaries, e.g. a binary mask is thresholded at 0.5. "nearest" copies the
+                 nearest input voxel, which is faster for many labels
+    :return: (batch, *shape_dhw) tensor or array, like labels, of the same dtype
+    """
+    if mode not in LABEL_MODES:
+        raise ValueError(f"mode must be one of {LABEL_MODES}, got {mode}")
+    tensor, is_array = _to_tensor(labels)
+    tensor = tensor.unsqueeze(1)
+    if mode == "nearest":
+        # Bools are not supported by interpolate, one byte per voxel is enough for them
+        source = tensor.to(torch.uint8) if tensor.dtype == torch.bool else tensor
+        resized = _interpolate(source, shape_dhw, "nearest").to(tensor.dtype)
+    else:
+        resized = None
+        # Labels are processed one at a time, so memory is two float volumes regardless of their number
+        for label in torch.unique(tensor):
+            likelihood = _interpolate((tensor == label).float(), shape_dhw, "trilinear")
+            if resized is None:
+                best = likelihood
+                resized = torch.full_like(likelihood, label.item(), dtype=tensor.dtype)
+            else:
+                better = likelihood > best
+                best = torch.where(better, likelihood, best)
+                resized[better] = label
+    resized = resized.squeeze(1)
+    return resized.numpy() if is_array else resized
+
+
+def resize_cases(images, masks, shape_dhw, image_mode="trilinear", label_mode="linear"):
+    """
+    Resizes images and masks of many cases together. Cases of equal shape are stacked and resized in one call each.
+    :param images: list of (channels, depth, height, width) tensors or arrays
+    :param masks: list of (depth, height, width) label tensors or arrays, or None
+    :return: (images, masks) lists in input order, masks is None if not given
+    """
+    resized_images = _resize_grouped(
+        images, lambda batch: resize_images(batch, shape_dhw, image_mode)
+    )
+    resized_masks = (
+        _resize_grouped(
+            masks, lambda batch: resize_labels(batch, shape_dhw, label_mode)
+        )
+        if masks is not None
+        else None
+    )
+    return resized_images, resized_masks
+
+
+def resize_case(image, mask, shape_dhw, image_mode="trilinear", label_mode="linear"):
+    """
+    :param image: (channels, depth, height, width) tensor or array
+    :param mask: (depth, height, width) label tensor or array, or None
+    :return: (image, mask) resized to shape_dhw
+    """
+    images, masks = resize_cases(
+        [image],
+        [mask] if mask is not None else None,
+        shape_dhw,
+        image_mode,
+        label_mode,
+    )
+    return images[0], masks[0] if masks is not None else None
+
+
+def _resize_grouped(volumes, resize):
+    groups = {}
+    for index, volume in enumerate(volumes):
+        groups.setdefault(tuple(volume.shape), []).append(index)
+    resized = [None] * len(volumes)
+    for indices in groups.values():
+        batch = [volumes[index] for index in indices]
+        stacked = torch.stack(batch) if torch.is_tensor(batch[0]) else np.stack(batch)
+        for index, volume in zip(indices, resize(stacked)):
+            resized[index] = volume
+    return resized
+
+
+def _interpolate(tensor, shape_dhw, mode):
+    kwargs = {} if mode in ("nearest", "area") else {"align_corners": False}
+    if mode == "nearest":
+        # Samples voxel centers like the linear modes, plain "nearest" shifts the volume by half a voxel
+        mode = "nearest-exact"
+    return F.interpolate(tensor, size=tuple(shape_dhw), mode=mode, **kwargs)
+
+
+def _to_tensor(volumes):
+    if torch.is_tensor(volumes):
+        return volumes, False
+    return torch.from_numpy(np.ascontiguousarray(volumes)), True
@@ -0,0 +1,14 @@
+import inspect
+
+import torch
+
+
+def torch_load(path, map_location="cpu"):
+    """
+    Loads a file holding only tensors and plain containers, e.g. state dicts, checkpoints or artifacts, with the
+    restricted unpickler where this PyTorch version has it, so loading cannot run arbitrary code.
+    """
+    kwargs = {}
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        kwargs["weights_only"] = True
+    return torch.load(path, map_location=map_location, **kwargs)
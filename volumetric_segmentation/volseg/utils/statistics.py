@@ -0,0 +1,144 @@
+import json
+import math
+import os
+
+import numpy as np
+
+from volseg.utils.io_utils import hash_parameters
+
+
+class RunningStatistics:
+    """
+    Per-channel count, mean and sum of squared deviations, merged with the parallel algorithm of Chan et al., along with
+    a 256-bin histogram of 8-bit intensities used for percentiles. Partials computed per volume (possibly in different
+    processes) are combined with merge(), so the data only has to be read once.
+    """
+
+    HISTOGRAM_BINS = 256
+
+    def __init__(self, channels):
+        self.count = np.zeros(channels, dtype=np.int64)
+        self.channel_means = np.zeros(channels, dtype=np.float64)
+        self.channel_m2 = np.zeros(channels, dtype=np.float64)
+        self.histogram = np.zeros(
+            (channels, RunningStatistics.HISTOGRAM_BINS), dtype=np.int64
+        )
+
+    @classmethod
+    def from_array(cls, image):
+        """
+        :param image: (channels, ...) array of intensities in [0, 255]
+        """
+        flat = image.reshape(image.shape[0], -1)
+        statistics = cls(channels=flat.shape[0])
+        statistics.count[:] = flat.shape[1]
+        statistics.channel_means[:] = flat.mean(axis=1, dtype=np.float64)
+        statistics.channel_m2[:] = flat.var(axis=1, dtype=np.float64) * flat.shape[1]
+        for channel, values in enumerate(flat):
+            statistics.histogram[channel] = np.bincount(
+                np.clip(values, 0, RunningStatistics.HISTOGRAM_BINS - 1).astype(
+                    np.intp, copy=False
+                ),
+                minlength=RunningStatistics.HISTOGRAM_BINS,
+            )
+        return statistics
+
+    def merge(self, other):
+        count = self.count + other.count
+        safe_count = np.maximum(count, 1)
+        delta = other.channel_means - self.channel_means
+        self.channel_means = self.channel_means + delta * other.count / safe_count
+        self.channel_m2 = (
+            self.channel_m2
+            + other.channel_m2
+            + delta**2 * self.count * other.count / safe_count
+        )
+        self.count = count
+        self.histogram = self.histogram + other.histogram
+        return self
+
+    @property
+    def mean(self):
+        total = self.count.sum()
+        return float((self.channel_means * self.count).sum() / total)
+
+    @property
+    def variance(self):
+        """
+        Unbiased variance over all channels pooled together.
+        """
+        total = self.count.sum()
+        mean = self.mean
+        m2 = (
+            self.channel_m2.sum()
+            + (self.count * (self.channel_means - mean) ** 2).sum()
+        )
+        return float(m2 / (total - 1))
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def channel_variances(self):
+        return self.channel_m2 / np.maximum(self.count - 1, 1)
+
+    @property
+    def channel_stdevs(self):
+        return np.sqrt(self.channel_variances)
+
+    def percentiles(self, q, per_channel=False):
+        """
+        :param q: percentile or sequence of percentiles in [0, 100]
+        :param per_channel: if True, returns an array of shape (channels, len(q)) instead of pooling channels
+        """
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        histograms = self.histogram if per_channel else self.histogram.sum(axis=0)[None]
+        cumulative = np.cumsum(histograms, axis=1)
+        # At least one voxel has to be covered, so that the 0th percentile is the minimum rather than bin 0
+        targets = np.maximum(q[None, :] / 100 * cumulative[:, -1:], 1)
+        result = np.stack(
+            [
+                np.searchsorted(channel_cumulative, channel_targets, side="left")
+                for channel_cumulative, channel_targets in zip(cumulative, targets)
+            ]
+        ).astype(np.float64)
+        return result if per_channel else result[0]
+
+    def to_dict(self):
+        return {
+            "count": self.count.tolist(),
+            "channel_means": self.channel_means.tolist(),
+            "channel_m2": self.channel_m2.tolist(),
+            "histogram": self.histogram.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        statistics = cls(channels=len(data["count"]))
+        statistics.count = np.asarray(data["count"], dtype=np.int64)
+        statistics.channel_means = np.asarray(data["channel_means"], dtype=np.float64)
+        statistics.channel_m2 = np.asarray(data["channel_m2"], dtype=np.float64)
+        statistics.histogram = np.asarray(data["histogram"], dtype=np.int64)
+        return statistics
+
+
+def get_statistics_cache_path(cache_dir, **key):
+    """
+    :param key: JSON-serializable values identifying the data the statistics were computed on
+    """
+    return os.path.join(cache_dir, f"volseg_statistics_{hash_parameters(key)}.json")
+
+
+def load_statistics(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return RunningStatistics.from_dict(json.load(f))
+
+
+def save_statistics(statistics, path):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(statistics.to_dict(), f)
+    os.replace(tmp_path, path)
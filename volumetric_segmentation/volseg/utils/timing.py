@@ -0,0 +1,45 @@
+import time
+
+import torch
+
+from volseg.utils.io_utils import print_info_message
+
+
+class TimingMixin:
+    """
+    Accumulates the time spent in named steps, e.g. the transforms of an AugmentationPipeline or the views of a
+    TestTimeAugmentation. Classes using it call reset_timings() in __init__ and record_time() for every step.
+    """
+
+    def reset_timings(self):
+        self.total_seconds = {}
+        self.calls = {}
+
+    def record_time(self, name, seconds, calls=1):
+        """
+        :param calls: added to the call count of name, 0 to add time to a call that has already been counted
+        """
+        self.total_seconds[name] = self.total_seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def get_timings(self):
+        """
+        :return: dict of step name -> mean milliseconds per call
+        """
+        return {
+            name: 1000 * seconds / self.calls[name]
+            for name, seconds in self.total_seconds.items()
+        }
+
+    def print_timings(self):
+        for name, milliseconds in self.get_timings().items():
+            print_info_message(f"{name}: {milliseconds:.2f} ms per batch")
+
+
+def get_synchronized_time(tensor):
+    """
+    :return: time.perf_counter() once the work queued on the device of tensor has finished
+    """
+    if tensor.is_cuda:
+        torch.cuda.synchronize(tensor.device)
+    return time.perf_counter()
@@ -1,29 +1,73 @@
 import torch
+import torch.fx
 
+from volseg.model.checkpointing import select_checkpoint_levels
 from volseg.model.plottable_model import PlottableModel
-from volseg.utils.padding import calculate_required_paddings
+from volseg.utils.padding import calculate_required_paddings, match_spatial_size
 from volseg.vnet.parts import VNetParts
 
+# Keeps the shape-dependent size matching a single opaque call when the model is symbolically traced
+torch.fx.wrap("match_spatial_size")
+
 
 class VNet(PlottableModel):
-    def __init__(self, num_classes, image_dimensions=(1, 64, 128, 128)):
+    def __init__(
+        self,
+        num_classes,
+        image_dimensions=(1, 64, 128, 128),
+        checkpoint_levels=None,
+        activation_memory_budget=None,
+        conv_block="dense",
+    ):
         """
-        :param image_dimensions: (channels, depth, height, width) or ImageDimensionsWrapper
+        :param image_dimensions: (channels, depth, height, width) or ImageDimensionsWrapper. Inputs of other sizes are
+                                 accepted too, as long as each spatial dimension is at least 16
         :param num_classes: number of classes to segment (e.g. liver, pancreas, lung...)
+        :param checkpoint_levels: names of conv blocks (see get_checkpointable_levels) whose activations are recomputed
+                                  during backward instead of being stored
+        :param activation_memory_budget: if given, checkpoint_levels are chosen automatically so that the estimated
+                                         conv block activations of a single sample fit in this many bytes
+        :param conv_block: convolutions of the conv blocks, one of volseg.vnet.parts.CONV_BLOCKS. "dense" uses the
+                           5x5x5 kernels of the paper, "separable" depthwise 5x5x5 followed by pointwise 1x1x1
+                           convolutions and "factorized" 5x1x1, 1x5x1 and 1x1x5 convolutions, which are several times
+                           cheaper at the cost of some accuracy (see volseg.bench.vnet_variants)
         """
         super().__init__(image_dimensions=image_dimensions)
         self.num_classes = num_classes
+        self.conv_block = conv_block
         conv3d_transpose_paddings = calculate_required_paddings(
             *self.image_dimensions.get_dhw(), num_levels=5
         )
         self.layers = VNetParts.build_layers(
-            self.image_dimensions.channels, num_classes, conv3d_transpose_paddings
+            self.image_dimensions.channels,
+            num_classes,
+            conv3d_transpose_paddings,
+            conv_block,
         )
+        if activation_memory_budget is not None:
+            checkpoint_levels = select_checkpoint_levels(self, activation_memory_budget)
+        self.set_checkpoint_levels(checkpoint_levels or ())
+
+    def get_config(self):
+        return {
+            "num_classes": self.num_classes,
+            "image_dimensions": list(self.image_dimensions.get()),
+            "conv_block": self.conv_block,
+        }
+
+    def get_checkpointable_levels(self):
+        return {
+            **{f"encoder_level_{level}": level for level in range(1, 5)},
+            "bottom_level": 5,
+            **{f"decoder_level_{level}": level for level in range(1, 5)},
+        }
 
     def forward(self, x):
         encoder_level_outputs, bottom_level_input = self.__encode(x)
 
-        bottom_level_conv_block_output = self.layers["bottom_level"](bottom_level_input)
+        bottom_level_conv_block_output = self.run_layer(
+            "bottom_level", bottom_level_input
+        )
         bottom_level_output = bottom_level_conv_block_output + bottom_level_input
         decoder_output = self.__decode(encoder_level_outputs, bottom_level_output)
         decoder_output_adjusted_channels = self.layers["output_channels_adjust"](
@@ -35,8 +79,8 @@ class VNet(PlottableModel):
         layer_input = self.layers["input_channels_adjust"](x)
         level_outputs = {}
         for level in range(1, 5):
-            encoder_conv_block_output = self.layers[f"encoder_level_{level}"](
-                layer_input
+            encoder_conv_block_output = self.run_layer(
+                f"encoder_level_{level}", layer_input
             )
             encoder_level_output = encoder_conv_block_output + layer_input
             level_outputs[level] = encoder_level_output
@@ -47,15 +91,23 @@ class VNet(PlottableModel):
         return level_outputs, layer_input
 
     def __decode(self, encoder_level_outputs, bottom_level_output):
-        upsampled = self.layers[f"upsampling_bottom_level"](bottom_level_output)
+        upsampled = self.__upsample(
+            "upsampling_bottom_level", bottom_level_output, encoder_level_outputs[4]
+        )
         for level in range(4, 0, -1):
             encoder_output = encoder_level_outputs[level]
             block_input = torch.concat((upsampled, encoder_output), axis=1)
-            block_output = self.layers[f"decoder_level_{level}"](block_input)
+            block_output = self.run_layer(f"decoder_level_{level}", block_input)
             block_output_residual = upsampled + block_output
             if level > 1:
-                upsampled = self.layers[f"upsampling_level_{level}"](
-                    block_output_residual
+                upsampled = self.__upsample(
+                    f"upsampling_level_{level}",
+                    block_output_residual,
+                    encoder_level_outputs[level - 1],
                 )
         # noinspection PyUnboundLocalVariable
         return block_output
+
+    def __upsample(self, name, x, encoder_output):
+        layer = self.layers[name]
+        return match_spatial_size(layer(x), encoder_output, layer.bias)
@@ -1,18 +1,26 @@
 import torch
 
+CONV_BLOCKS = ("dense", "separable", "factorized")
+
 
 class VNetParts:
     @staticmethod
-    def build_layers(input_channels, num_classes, conv3d_transpose_paddings):
+    def build_layers(
+        input_channels, num_classes, conv3d_transpose_paddings, conv_block="dense"
+    ):
+        if conv_block not in CONV_BLOCKS:
+            raise ValueError(
+                f"Unknown conv_block {conv_block}, expected one of {CONV_BLOCKS}"
+            )
         return torch.nn.ModuleDict(
             {
                 **VNetParts.__create_channels_adjusters(input_channels, num_classes),
-                **VNetParts.__create_encoder_layers(),
-                **VNetParts.__create_decoder_layers(),
+                **VNetParts.__create_encoder_layers(conv_block),
+                **VNetParts.__create_decoder_layers(conv_block),
                 **VNetParts.__create_downsampling_layers(),
                 **VNetParts.__create_upsampling_layers(conv3d_transpose_paddings),
                 "bottom_level": VNetParts.__build_conv_block(
-                    convolutions_count=3, channels=256
+                    convolutions_count=3, channels=256, conv_block=conv_block
                 ),
                 "output_activation": torch.nn.Softmax(dim=1)
                 if num_classes > 1
@@ -21,12 +29,13 @@ class VNetParts:
         )
 
     @staticmethod
-    def __create_encoder_layers():
+    def __create_encoder_layers(conv_block):
         layers = {}
         for level in range(1, 5):
             layers[f"encoder_level_{level}"] = VNetParts.__build_conv_block(
                 convolutions_count=min(level, 3),
                 channels=16 * 2 ** (level - 1),
+                conv_block=conv_block,
             )
         return layers
 
@@ -42,13 +51,14 @@ class VNetParts:
         return layers
 
     @staticmethod
-    def __create_decoder_layers():
+    def __create_decoder_layers(conv_block):
         layers = {}
         for level in range(1, 5):
             layers[f"decoder_level_{level}"] = VNetParts.__build_conv_block(
                 convolutions_count=min(level, 3),
                 in_channels=int(1.5 * 32 * 2 ** (level - 1)),
                 channels=32 * 2 ** (level - 1),
+                conv_block=conv_block,
             )
         return layers
 
@@ -95,17 +105,18 @@ class VNetParts:
         )
 
     @staticmethod
-    def __build_conv_block(convolutions_count, channels, in_channels=None):
+    def __build_conv_block(
+        convolutions_count, channels, in_channels=None, conv_block="dense"
+    ):
         if in_channels is None:
             in_channels = channels
 
         def build_conv_block_helper(is_first_in_sequence):
             return [
-                torch.nn.Conv3d(
+                *VNetParts.__build_convolution(
                     in_channels=in_channels if is_first_in_sequence else channels,
                     out_channels=channels,
-                    kernel_size=5,
-                    padding="same",
+                    conv_block=conv_block,
                 ),
                 torch.nn.PReLU(),
             ]
@@ -117,6 +128,48 @@ class VNetParts:
         ]
         return torch.nn.Sequential(*layers)
 
+    @staticmethod
+    def __build_convolution(in_channels, out_channels, conv_block, kernel_size=5):
+        """
+        Layers replacing a single dense convolution. Multiply-adds per voxel for k=5, with C_in and C_out channels:
+        "dense" 125 C_in C_out, "separable" (depthwise kxkxk, then pointwise 1x1x1) 125 C_in + C_in C_out and
+        "factorized" (kx1x1, 1xkx1, then 1x1xk) 5 C_in C_out + 10 C_out^2. Layers are not nested, so blocks stay flat
+        Sequentials.
+        """
+        if conv_block == "separable":
+            return [
+                torch.nn.Conv3d(
+                    in_channels=in_channels,
+                    out_channels=in_channels,
+                    kernel_size=kernel_size,
+                    padding="same",
+                    groups=in_channels,
+                ),
+                torch.nn.Conv3d(
+                    in_channels=in_channels, out_channels=out_channels, kernel_size=1
+                ),
+            ]
+        if conv_block == "factorized":
+            return [
+                torch.nn.Conv3d(
+                    in_channels=in_channels if axis == 0 else out_channels,
+                    out_channels=out_channels,
+                    kernel_size=tuple(
+                        kernel_size if i == axis else 1 for i in range(3)
+                    ),
+                    padding="same",
+                )
+                for axis in range(3)
+            ]
+        return [
+            torch.nn.Conv3d(
+                in_channels=in_channels,
+                out_channels=out_channels,
+                kernel_size=kernel_size,
+                padding="same",
+            )
+        ]
+
     @staticmethod
     def __build_conv3d_transpose(in_channels, out_channels, output_padding):
         return torch.nn.ConvTranspose3d(